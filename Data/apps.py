@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class DataConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'Data'
+
+    def ready(self):
+        # Register signal receivers that keep in-memory indexes in sync
+        import helpers.gazetteer  # noqa: F401
+        import helpers.spatial  # noqa: F401
+        import Data.rollups  # noqa: F401
+        # Queues event extraction when a TelegramMessage is saved
+        import Data.extraction_queue  # noqa: F401
+        # Hooks the SQL query counter into every new database connection
+        import helpers.metrics  # noqa: F401
@@ -0,0 +1,60 @@
+import os
+from multiprocessing import Pool
+
+import django
+from django.db import connections
+
+from helpers.object_helpers import chunked
+from helpers.gazetteer import get_gazetteer
+from helpers.nlp_messages import get_nlp
+from Data.import_data import extract_message_rows, persist_MessageEvents
+from Data.models import TelegramMessage
+
+
+def _init_worker():
+    ''' Runs once per worker - loads the heavy, read-only state up front '''
+    django.setup()
+    get_nlp()
+    get_gazetteer()
+    # Worker only reads the gazetteer on start-up - the parent does all writes
+    connections.close_all()
+
+
+def _extract_chunk(rows):
+    ''' `rows`: [(message id, text, date), ...] -> list of extraction results '''
+    return extract_message_rows(rows)
+
+
+def run_parallel_extraction(messages=None, workers: int = None, chunk_size: int = 200, write_batch_size: int = 1000):
+    ''' Extracts `MessageEvent`s for `messages` (a `TelegramMessage` queryset - defaults to
+        every message that has not been parsed yet) across `workers` processes.
+        Each worker holds its own spaCy pipeline and gazetteer and returns plain results,
+        this (parent) process is the single db writer.
+        `chunk_size` messages are sent to a worker at a time, and results are written
+        `write_batch_size` at a time. Returns the number of events written.
+    '''
+    if messages is None:
+        messages = TelegramMessage.objects.filter(parsed__isnull=True)
+    workers = workers or os.cpu_count() or 1
+
+    rows = messages.order_by('id').values_list('id', 'text', 'date').iterator()
+
+    # Built before the pool starts so forked workers share the parent's copy
+    get_gazetteer()
+    # Forked workers must not share the parent's open db connections
+    connections.close_all()
+
+    written = 0
+    pending = []
+    with Pool(workers, initializer=_init_worker) as pool:
+        for results in pool.imap_unordered(_extract_chunk, chunked(rows, chunk_size)):
+            pending.extend(results)
+            if len(pending) >= write_batch_size:
+                written += len(persist_MessageEvents(pending))
+                pending = []
+                print(f'Wrote {written} MESSAGE EVENTS')
+
+    if pending:
+        written += len(persist_MessageEvents(pending))
+    print(f'Wrote {written} MESSAGE EVENTS')
+    return written
@@ -0,0 +1,164 @@
+from datetime import timedelta
+import os
+import socket
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, Min, Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from helpers.metrics import REGISTRY
+from helpers.object_helpers import chunked
+from Data.models import ExtractionJob, MessageEvent, TelegramMessage
+from Data.rollups import delete_events
+
+
+REGISTRY.describe('rus_ukr_extraction_queue_jobs', 'Extraction jobs in the queue per state')
+REGISTRY.describe('rus_ukr_extraction_queue_oldest_seconds', 'Age of the oldest claimable extraction job')
+REGISTRY.describe('rus_ukr_extraction_jobs_total', 'Extraction jobs finished by this worker per result')
+
+States = ExtractionJob.States
+
+
+def queue_option(name: str):
+    return settings.EXTRACTION_QUEUE[name]
+
+
+def worker_name():
+    ''' Unique lease owner of this worker process '''
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+# ################################# Producers #################################
+def enqueue_messages(message_ids):
+    ''' Queues (or re-queues, ie: after an edit) extraction of the `TelegramMessage`s with `message_ids` '''
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+    with transaction.atomic():
+        for chunk in chunked(message_ids, 500):
+            ExtractionJob.objects.bulk_create([ExtractionJob(message_id=m_id) for m_id in chunk],
+                                              ignore_conflicts=True)
+            # Already queued, running or dead - start over with the new text
+            ExtractionJob.objects.filter(message_id__in=chunk) \
+                .exclude(state=States.PENDING, attempts=0) \
+                .update(state=States.PENDING, attempts=0, available_at=timezone.now(),
+                        lease_owner=None, lease_expires=None, last_error=None)
+
+
+def wait_for_capacity(max_depth: int = None, poll_seconds: float = 1.0, timeout: float = None,
+                      report_every: float = 10.0):
+    ''' Backpressure for producers - blocks while more than `max_depth` jobs are waiting, printing the
+        queue depth every `report_every` seconds. Raises after `timeout` seconds (ie: no worker running).
+        Returns the seconds spent waiting.
+    '''
+    max_depth = queue_option('MAX_DEPTH') if max_depth is None else max_depth
+    timeout = queue_option('BACKPRESSURE_TIMEOUT') if timeout is None else timeout
+    waited = reported = 0.0
+    while (depth := ExtractionJob.objects.exclude(state=States.DEAD).count()) > max_depth:
+        if waited >= reported + report_every or not waited:
+            print(f'Extraction queue holds {depth} jobs (max {max_depth}) - waiting for '
+                  f'`manage.py extraction_worker` ({waited:.0f}s)')
+            reported = waited
+        if timeout and waited >= timeout:
+            raise Exception(f'EXTRACTION QUEUE STILL HOLDS {depth} JOBS AFTER {waited:.0f}s!\n'
+                            f'Start `manage.py extraction_worker`, or ingest with `extract_events=False`.')
+        time.sleep(poll_seconds)
+        waited += poll_seconds
+    return waited
+
+
+@receiver(post_save, sender=TelegramMessage)
+def _message_saved(sender, instance, raw=False, **kwargs):
+    # `bulk_create`/`bulk_update` send no signal - bulk ingest calls `enqueue_messages` itself
+    if not raw:
+        enqueue_messages([instance.id])
+
+
+# ################################# Consumers #################################
+def claim_jobs(owner: str, batch_size: int, lease_seconds: int = None, max_attempts: int = None):
+    ''' Leases up to `batch_size` claimable jobs to `owner` - pending ones whose `available_at` has
+        passed, and running ones whose lease expired (their worker died). Returns the claimed jobs.
+    '''
+    lease_seconds = lease_seconds or queue_option('LEASE_SECONDS')
+    max_attempts = max_attempts or queue_option('MAX_ATTEMPTS')
+    now = timezone.now()
+    expired = Q(state=States.RUNNING, lease_expires__lt=now)
+    claimable = Q(state=States.PENDING, available_at__lte=now) | expired
+
+    with transaction.atomic():
+        # Jobs whose worker died on every attempt (ie: a message that crashes the parser)
+        ExtractionJob.objects.filter(expired, attempts__gte=max_attempts) \
+            .update(state=States.DEAD, lease_owner=None, last_error='Lease expired on the last attempt')
+
+        candidates = ExtractionJob.objects.filter(claimable).order_by('available_at', 'id')
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list('id', flat=True)[:batch_size])
+
+        # Re-checks `claimable` - a concurrent worker may have taken some (SQLite has no row locks)
+        expires = now + timedelta(seconds=lease_seconds)
+        ExtractionJob.objects.filter(claimable, id__in=ids) \
+            .update(state=States.RUNNING, lease_owner=owner, lease_expires=expires, attempts=F('attempts') + 1)
+    return list(ExtractionJob.objects.filter(id__in=ids, lease_owner=owner, state=States.RUNNING))
+
+
+def complete_jobs(owner: str, jobs, extracted_events):
+    ''' Writes the `MessageEvent`s of `jobs` and removes the jobs - in one transaction.
+        Events left by an earlier attempt (or an older text) are replaced, so retries never duplicate.
+    '''
+    from Data.import_data import persist_MessageEvents
+
+    message_ids = [job.message_id for job in jobs]
+    with transaction.atomic():
+        delete_events(MessageEvent.objects.filter(original_message_id__in=message_ids))
+        persist_MessageEvents(extracted_events)
+        # Only jobs still leased to `owner` - a re-queued job (edited message) runs again
+        ExtractionJob.objects.filter(id__in=[job.id for job in jobs], lease_owner=owner).delete()
+    REGISTRY.inc('rus_ukr_extraction_jobs_total', len(jobs), result='done')
+
+
+def fail_job(owner: str, job: ExtractionJob, error: str, max_attempts: int = None, backoff: float = None):
+    ''' Schedules a retry of `job` with exponential backoff - or dead-letters it after `max_attempts` '''
+    max_attempts = max_attempts or queue_option('MAX_ATTEMPTS')
+    backoff = backoff or queue_option('RETRY_BACKOFF')
+    jobs = ExtractionJob.objects.filter(id=job.id, lease_owner=owner)
+    if job.attempts >= max_attempts:
+        jobs.update(state=States.DEAD, lease_owner=None, lease_expires=None, last_error=error)
+        REGISTRY.inc('rus_ukr_extraction_jobs_total', result='dead')
+    else:
+        retry_at = timezone.now() + timedelta(seconds=backoff * 2 ** (job.attempts - 1))
+        jobs.update(state=States.PENDING, available_at=retry_at, lease_owner=None, lease_expires=None,
+                    last_error=error)
+        REGISTRY.inc('rus_ukr_extraction_jobs_total', result='retry')
+
+
+def requeue_dead_jobs():
+    ''' Gives every dead-lettered job a new set of attempts - returns how many '''
+    return ExtractionJob.objects.filter(state=States.DEAD) \
+        .update(state=States.PENDING, attempts=0, available_at=timezone.now(), last_error=None)
+
+
+# ################################## Metrics ##################################
+def queue_depth():
+    ''' {state: number of jobs} '''
+    depth = {state: 0 for state in States.values}
+    depth.update(ExtractionJob.objects.values('state').annotate(n=Count('id')).order_by().values_list('state', 'n'))
+    return depth
+
+
+def update_queue_metrics():
+    ''' Sets the queue depth gauges from the db - returns `queue_depth()` '''
+    depth = queue_depth()
+    for state, n in depth.items():
+        REGISTRY.set('rus_ukr_extraction_queue_jobs', n, state=state)
+
+    oldest = ExtractionJob.objects.filter(state=States.PENDING, available_at__lte=timezone.now()) \
+        .aggregate(oldest=Min('available_at'))['oldest']
+    REGISTRY.set('rus_ukr_extraction_queue_oldest_seconds',
+                 (timezone.now() - oldest).total_seconds() if oldest else 0)
+    return depth
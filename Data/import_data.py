@@ -1,27 +1,82 @@
-import spacy
+import os
 from datetime import datetime
 
-from helpers.object_helpers import search_list_for_obj
-from helpers.nlp_messages import setup_spacy, matches_subjVerbDobj, check_token_is_place
+from django.conf import settings
+from django.db import transaction
+
+from helpers.object_helpers import search_list_for_obj, chunked, normalize_place_name
+from helpers.gazetteer import invalidate_gazetteer
+from helpers.gazetteer_file import write_gazetteer_file
+from helpers.metrics import timed, count_queries, start_breakdown, end_breakdown, format_breakdown
+from helpers.spatial import invalidate_place_grid
+from helpers.telegram_export import TelegramExportReader
+from Data.extraction_queue import enqueue_messages, wait_for_capacity
+from helpers.nlp_messages import setup_spacy, pipe_texts, matches_subjVerbDobj, check_token_is_place
 from Data.models import *
+from Data.rollups import apply_rollup_counts, bump_events_version, count_extracted_events, delete_events
 
+# Where `get_json_data` finds the gazetteer & Telegram export json files
+DATA_DIR = '../Data'
 
-def create_EventMessage_from_TelegramMessage(telegram_message: TelegramMessage):
+
+def create_EventMessages_from_TelegramMessages(telegram_messages, batch_size: int = 50, n_process: int = 1):
+    ''' Batch version of `create_EventMessage_from_TelegramMessage`.
+        Parses all `telegram_messages` with `nlp.pipe` so the model is used in
+        batches (and optionally across `n_process` processes).
+        Returns a list of the new `MessageEvent` instances.
+    '''
+    telegram_messages = list(telegram_messages)
+    docs = pipe_texts((msg.text for msg in telegram_messages),
+                      batch_size=batch_size, n_process=n_process)
+
+    return [create_EventMessage_from_TelegramMessage(msg, doc)
+            for msg, doc in zip(telegram_messages, docs)]
+
+
+def extract_message_rows(rows, batch_size: int = 50):
+    ''' `rows`: [(message id, text, date), ...] -> `extract_event_from_doc` results with
+        `original_message_id` & `event_date` set - ready for `persist_MessageEvents`.
+        Texts are parsed in batches with `nlp.pipe`.
+    '''
+    rows = list(rows)
+    docs = pipe_texts((text for _, text, _ in rows), batch_size=batch_size)
+
+    results = []
+    for (m_id, text, date), doc in zip(rows, docs):
+        extracted = extract_event_from_doc(doc, text)
+        extracted['original_message_id'] = m_id
+        extracted['event_date'] = datetime.isoformat(date)
+        results.append(extracted)
+    return results
+
+
+def create_EventMessage_from_TelegramMessage(telegram_message: TelegramMessage, doc=None):
     ''' Converts `TelegramMessage` instance into a new `MessageEvent` instance. 
         Attempts to lift relevant keywords from `TelegramMessage.text` for brevity 
         when displaying on maps.
+        `doc` can be passed in when the text was already parsed (ie: by `nlp.pipe`).
     '''
 
     # Start Spacy and convert `telegram_message.text` to a `Spacy...Doc`
-    original_message = telegram_message
-    event_date = datetime.isoformat(telegram_message.date)
-    doc = setup_spacy(telegram_message.text)
+    if doc is None:
+        doc = setup_spacy(telegram_message.text)
+
+    extracted = extract_event_from_doc(doc, telegram_message.text)
+    extracted['original_message_id'] = telegram_message.id
+    extracted['event_date'] = datetime.isoformat(telegram_message.date)
+
+    return persist_MessageEvents([extracted])[0]
 
+
+def extract_event_from_doc(doc, message_text: str):
+    ''' Lifts subject/action/text and City, State, Country ids out of a parsed message.
+        Returns plain data (no model instances) so results can be passed between processes:
+            {subject, action, text, classification, is_multi_sentence, contains_places,
+             cities: [id...], states: [id...], countries: [id...]}
+    '''
     subject = None
     action = None
-    text = telegram_message.text  # Changes if tokens in text matches subjVerbDobj pattern
-    is_multi_sentence = None
-    contains_places = None
+    text = message_text  # Changes if tokens in text matches subjVerbDobj pattern
     cities = []
     states = []
     countries = []
@@ -48,40 +103,73 @@ def create_EventMessage_from_TelegramMessage(telegram_message: TelegramMessage):
             entity = check_token_is_place(token, False)
 
         if entity:
-            if type(entity) == Country:
-                countries.append(entity)
-            if type(entity) == State:
-                states.append(entity)
-            if type(entity) == City:
-                cities.append(entity)
-
-        contains_places = bool(entity)
+            model, place_id = entity
+            if model == Country:
+                countries.append(place_id)
+            if model == State:
+                states.append(place_id)
+            if model == City:
+                cities.append(place_id)
 
         # TODO GET CLASSIFICATION!
         # TODO HANDLE MULTI-SENTENCE CONDITIONS
 
-    # All variables retrieved to create `EventMessage`
-    newME = MessageEvent(text=text,
-                         original_message=original_message,
-                         event_date=event_date,
-                         subject=subject,
-                         action=action,
-                         classification=classification,
-                         is_multi_sentence=is_multi_sentence,
-                         contains_places=contains_places,
-                         )
+    return {'subject': subject,
+            'action': action,
+            'text': text,
+            'classification': classification,
+            'is_multi_sentence': is_multi_sentence,
+            'contains_places': bool(cities or states or countries),
+            'cities': cities,
+            'states': states,
+            'countries': countries,
+            }
+
+
+@timed('persist_events')
+def persist_MessageEvents(extracted_events):
+    ''' Writes `MessageEvent`s from `extract_event_from_doc` results in one transaction.
+        Each result also needs `original_message_id` and `event_date`.
+        Events are inserted with one `bulk_create`, and their City/State/Country links with
+        one (de-duplicated) `bulk_create` per through table.
+        Returns the new `MessageEvent` instances.
+    '''
+    new_events = []
+    links = {'cities': set(), 'states': set(), 'countries': set()}
+
+    for extracted in extracted_events:
+        fields = dict(extracted)
+        place_ids = {relation: fields.pop(relation) for relation in links}
 
-    newME.save()
+        newME = MessageEvent(**fields)  # `id` (uuid) is set here - no db round trip needed
+        new_events.append(newME)
+        for relation, ids in place_ids.items():
+            links[relation].update((newME.id, place_id) for place_id in ids)
 
-    # Reverse relation additions
-    if cities:
-        [city.messageevent_set.add(newME.id) for city in cities]
-    if states:
-        [state.messageevent_set.add(newME.id) for state in states]
-    if countries:
-        [country.messageevent_set.add(newME.id) for country in countries]
+    with transaction.atomic():
+        MessageEvent.objects.bulk_create(new_events)
+        for relation, pairs in links.items():
+            if pairs:
+                bulk_create_place_links(relation, pairs)
+        apply_rollup_counts(count_extracted_events(extracted_events))
+        if new_events:
+            bump_events_version()
 
-    return newME
+    return new_events
+
+
+def bulk_create_place_links(relation: str, pairs):
+    ''' Inserts `(MessageEvent id, place id)` pairs into the through table of
+        `MessageEvent.<relation>` (cities | states | countries) with a single query.
+    '''
+    field = MessageEvent._meta.get_field(relation)
+    through = field.remote_field.through
+    source = field.m2m_field_name()   # ie: 'messageevent'
+    target = field.m2m_reverse_field_name()  # ie: 'city'
+
+    through.objects.bulk_create(
+        [through(**{f'{source}_id': event_id, f'{target}_id': place_id}) for event_id, place_id in pairs],
+        ignore_conflicts=True)
 
 
 def create_TelegramMessage_model(msg_id=1, single_message=None):
@@ -114,6 +202,59 @@ def create_TelegramMessage_model(msg_id=1, single_message=None):
     return Msg
 
 
+def create_TelegramMessage_models(messages, extract_events: bool = True):
+    ''' Batch version of `create_TelegramMessage_model` for already loaded message objects.
+        Writes all of `messages` with one `bulk_create` in a single transaction, and - when
+        `extract_events` - queues event extraction of the ones that were not stored yet
+        (`bulk_create` sends no `post_save`).
+    '''
+    new_messages = []
+    for message in messages:
+        # Transform time value to ISO-UTCz format
+        message['date'] = convert_DT_to_UTC(message['date'])
+        new_messages.append(TelegramMessage.create(**message))
+
+    with transaction.atomic():
+        stored = set(TelegramMessage.objects.filter(id__in=[m.id for m in new_messages])
+                     .values_list('id', flat=True))
+        TelegramMessage.objects.bulk_create(new_messages, ignore_conflicts=True)
+        if extract_events:
+            # Skipped (already stored) rows keep their events
+            enqueue_messages(m.id for m in new_messages if m.id not in stored)
+    return new_messages
+
+
+@timed('store_messages')
+def upsert_TelegramMessage_models(messages):
+    ''' Like `create_TelegramMessage_models` but skips messages that are already stored,
+        and overwrites stored messages whose `edited` timestamp is older than the new copy.
+        `MessageEvent`s of overwritten messages are deleted - they need to be parsed again.
+        Returns the new and changed `TelegramMessage` instances.
+    '''
+    incoming = {}
+    for message in messages:
+        # Transform time values to ISO-UTCz format
+        message['date'] = convert_DT_to_UTC(message['date'])
+        if message.get('edited'):
+            message['edited'] = convert_DT_to_UTC(message['edited'])
+        incoming[message['id']] = TelegramMessage.create(**message)
+
+    stored = dict(TelegramMessage.objects.filter(id__in=incoming.keys()).values_list('id', 'edited'))
+
+    new_messages = [msg for m_id, msg in incoming.items() if m_id not in stored]
+    edited_messages = [msg for m_id, msg in incoming.items()
+                       if m_id in stored and msg.edited and (not stored[m_id] or msg.edited > stored[m_id])]
+
+    with transaction.atomic():
+        TelegramMessage.objects.bulk_create(new_messages, ignore_conflicts=True)
+        if edited_messages:
+            update_fields = [f.name for f in TelegramMessage._meta.concrete_fields if not f.primary_key]
+            TelegramMessage.objects.bulk_update(edited_messages, update_fields)
+            delete_events(MessageEvent.objects.filter(original_message__in=[m.id for m in edited_messages]))
+
+    return new_messages + edited_messages
+
+
 def create_city_model(city_id=1, single_city=None):
     print("\nCITY ID:\t", city_id)
 
@@ -180,10 +321,14 @@ def create_country_model(country_id=1, single_country=None):
 
 #####################################################################################
 ################################## HELPERS/RUNNERS ##################################
+def get_json_path(filename):
+    return f'{DATA_DIR}/{filename}.json'
+
+
 def get_json_data(filename):
     import json
 
-    file = f'../Data/{filename}.json'
+    file = get_json_path(filename)
     with open(file, encoding='utf-8') as df:
         jd = json.loads(df.read())
     return jd
@@ -203,32 +348,180 @@ def convert_DT_to_UTC(dt: str):
     return utc_dt
 
 
-def run_cities():
-    cities = get_json_data('cities')
-    for city in cities:
-        c_id = city['id']
-        create_city_model(c_id, city)
+def bulk_create_in_chunks(model, objs, chunk_size: int = 5000):
+    ''' Writes `objs` with `bulk_create` - one transaction per `chunk_size` rows.
+        Rows that already exist (same primary key) are skipped so reruns are idempotent.
+        Returns the number of rows actually inserted.
+    '''
+    created = attempted = 0
+    for chunk in chunked(objs, chunk_size):
+        with transaction.atomic():
+            # `ignore_conflicts` doesn't report skipped rows - count the stored ones first (pk index)
+            stored = model.objects.filter(pk__in=[obj.pk for obj in chunk]).count()
+            model.objects.bulk_create(chunk, batch_size=chunk_size, ignore_conflicts=True)
+        created += len(chunk) - stored
+        attempted += len(chunk)
+        print(f'Wrote {created} new {model.__name__} rows ({attempted} attempted)')
+    return created
+
+
+def run_countries(chunk_size: int = 5000):
+    countries = get_json_data('countries')
+
+    def build(country):
+        fields = concrete_fields_from_kwargs(Country, country)
+        # `bulk_create` skips `save()` - set the folded name here
+        fields['name_folded'] = normalize_place_name(fields['name'])
+        return Country(**fields)
+
+    return bulk_create_in_chunks(Country, (build(country) for country in countries), chunk_size)
 
 
-def run_states():
+def run_states(chunk_size: int = 5000):
     states = get_json_data('states')
-    for state in states:
-        s_id = state['id']
-        create_state_model(s_id, state)
+    # FK's resolved from ids already in db - no query per row
+    country_ids = set(Country.objects.values_list('id', flat=True))
 
+    def build(state):
+        fields = concrete_fields_from_kwargs(State, state)
+        fields['name_folded'] = normalize_place_name(fields['name'])
+        if fields.get('country_id') not in country_ids:
+            fields['country_id'] = None
+        return State(**fields)
+
+    return bulk_create_in_chunks(State, (build(state) for state in states), chunk_size)
 
-def run_countries():
-    countries = get_json_data('countries')
-    for country in countries:
-        c_id = country['id']
-        create_country_model(c_id)
 
+def run_cities(chunk_size: int = 5000):
+    cities = get_json_data('cities')
+    # FK's resolved from ids already in db - no query per row
+    country_ids = set(Country.objects.values_list('id', flat=True))
+    state_ids = set(State.objects.values_list('id', flat=True))
+
+    def build(city):
+        fields = concrete_fields_from_kwargs(City, city)
+        fields['name_folded'] = normalize_place_name(fields['name'])
+        if fields.get('country_id') not in country_ids:
+            fields['country_id'] = None
+        if fields.get('state_id') not in state_ids:
+            fields['state_id'] = None
+        return City(**fields)
+
+    return bulk_create_in_chunks(City, (build(city) for city in cities), chunk_size)
 
-def run_messages():
-    data = get_json_data('messages')['messages']
-    # Retrieve only the objects with 'type':'message'
-    msg_lst = search_list_for_obj(data, 'type', 'message')
 
-    for msg in msg_lst[0:20]:
-        m_id = msg['id']
-        create_TelegramMessage_model(None, msg)
+def backfill_name_folded(model, chunk_size: int = 5000, refresh: bool = False):
+    ''' Sets `name_folded` on `model` rows stored without it (ie: before the column existed, or skipped
+        by `ignore_conflicts` on a rerun) - or on every row with `refresh`. Returns the rows updated.
+    '''
+    rows = model.objects.only('id', 'name', 'name_folded').order_by('id')
+    if not refresh:
+        rows = rows.filter(name_folded='')
+
+    updated = 0
+    for chunk in chunked(rows.iterator(chunk_size=chunk_size), chunk_size):
+        changed = []
+        for row in chunk:
+            folded = normalize_place_name(row.name)
+            if folded != row.name_folded:
+                row.name_folded = folded
+                changed.append(row)
+        with transaction.atomic():
+            model.objects.bulk_update(changed, ['name_folded'], batch_size=chunk_size)
+        updated += len(changed)
+    if updated:
+        print(f'Backfilled name_folded of {updated} {model.__name__} rows')
+    return updated
+
+
+def run_gazetteer(chunk_size: int = 5000):
+    ''' Imports countries, then states, then cities - parents always exist before children '''
+    run_countries(chunk_size)
+    run_states(chunk_size)
+    run_cities(chunk_size)
+    # Rows that were already stored are skipped by the imports above
+    for model in (Country, State, City):
+        backfill_name_folded(model, chunk_size)
+
+    # `bulk_create` does not send `post_save` - drop the in-memory indexes manually
+    if settings.GAZETTEER_SOURCE == 'file':
+        write_gazetteer_file(settings.GAZETTEER_FILE)
+    invalidate_gazetteer()
+    invalidate_place_grid()
+
+
+def run_messages(batch_size: int = 500, filename: str = 'messages', extract_events: bool = True):
+    ''' Streams the Telegram export and stores its messages in batches of `batch_size`.
+        Resumable & incremental - keeps an `IngestCheckpoint` per channel so only messages
+        that are new, or edited since they were stored, are written - and, when `extract_events`,
+        queued for `manage.py extraction_worker` to parse into `MessageEvent`s. Reading pauses
+        while the queue holds more than `EXTRACTION_QUEUE['MAX_DEPTH']` jobs, and stops (resumable)
+        when it does not drain within `EXTRACTION_QUEUE['BACKPRESSURE_TIMEOUT']` seconds.
+        Prints the time spent per stage (json, sql, spaCy, ...) when done.
+    '''
+    breakdown, token = start_breakdown()
+    try:
+        with count_queries(), timed('run_messages'):
+            stored = _run_messages(batch_size, filename, extract_events)
+    finally:
+        end_breakdown(token)
+    print(f'Stages: {format_breakdown(breakdown)}')
+    return stored
+
+
+def _run_messages(batch_size: int, filename: str, extract_events: bool):
+    path = get_json_path(filename)
+    reader = TelegramExportReader(path)
+    header = reader.read_header()
+    channel_id = str(header.get('id', filename))
+
+    checkpoint, _ = IngestCheckpoint.objects.get_or_create(channel_id=channel_id)
+
+    # Same export file as the last (interrupted) run - continue from its byte offset
+    export_size = os.path.getsize(path)
+    if checkpoint.export_name == filename and checkpoint.export_size == export_size:
+        reader.start_offset = checkpoint.export_offset
+
+    # Edits are only trusted up to the mark of the last *finished* export - a crashed run may have
+    # skipped older edits, so the mark moves once, when this export has been read to the end
+    edited_mark = checkpoint.last_edited
+    newest_edit = edited_mark
+
+    def is_new_or_edited(msg):
+        if msg.get('type') != 'message':
+            return False
+        if msg['id'] > checkpoint.last_message_id:
+            return True
+        edited = msg.get('edited')
+        return bool(edited and (not edited_mark
+                                or transform_iso_to_dt(convert_DT_to_UTC(edited)) > edited_mark))
+
+    stored = 0
+    for batch in chunked(filter(is_new_or_edited, reader), batch_size):
+        with transaction.atomic():
+            changed = upsert_TelegramMessage_models(batch)
+
+            checkpoint.last_message_id = max([checkpoint.last_message_id] + [m.id for m in changed])
+            edits = [m.edited for m in changed if m.edited]
+            if edits:
+                newest_edit = max(edits + [newest_edit or min(edits)])
+            checkpoint.export_name = filename
+            checkpoint.export_size = export_size
+            checkpoint.export_offset = reader.offset
+            checkpoint.save()
+
+            if extract_events:
+                enqueue_messages(m.id for m in changed)
+
+        if extract_events:
+            with timed('queue_backpressure'):
+                wait_for_capacity()
+
+        stored += len(changed)
+        print(f'Stored {stored} NEW/EDITED MESSAGES\tOFFSET: {reader.offset}')
+
+    # Whole export handled - a new export with the same size must not reuse the offset
+    checkpoint.export_size = 0
+    checkpoint.last_edited = newest_edit
+    checkpoint.save()
+    return stored
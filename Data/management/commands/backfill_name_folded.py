@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from Data.import_data import backfill_name_folded
+from Data.models import City, State, Country
+
+
+class Command(BaseCommand):
+    help = 'Sets the indexed name_folded column of City/State/Country rows stored without it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--all', action='store_true', help='recompute every row')
+
+    def handle(self, *args, **options):
+        updated = sum(backfill_name_folded(model, options['chunk_size'], refresh=options['all'])
+                      for model in (Country, State, City))
+        self.stdout.write(self.style.SUCCESS(f'Updated name_folded of {updated} rows'))
@@ -0,0 +1,20 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from helpers.gazetteer_file import write_gazetteer_file
+
+
+class Command(BaseCommand):
+    help = ('Compiles City/State/Country into the memory-mapped gazetteer file read by every process '
+            'when GAZETTEER_SOURCE is "file"')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=settings.GAZETTEER_FILE)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        size = write_gazetteer_file(options['output'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {options["output"]} ({size / 2 ** 20:.1f} MB) in {time.perf_counter() - start:.1f} s'))
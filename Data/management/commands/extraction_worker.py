@@ -0,0 +1,77 @@
+import time
+import traceback
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from helpers.gazetteer import get_gazetteer
+from helpers.nlp_messages import get_nlp
+from Data.extraction_queue import (claim_jobs, complete_jobs, fail_job, requeue_dead_jobs, update_queue_metrics,
+                                   worker_name)
+from Data.models import TelegramMessage
+from Data.near_duplicates import extract_message_rows_deduplicated
+
+
+class Command(BaseCommand):
+    help = ('Drains the extraction queue - parses queued TelegramMessages into MessageEvents in batches. '
+            'Run one per CPU to parse in parallel.')
+
+    def add_arguments(self, parser):
+        queue = settings.EXTRACTION_QUEUE
+        parser.add_argument('--batch-size', type=int, default=queue['BATCH_SIZE'])
+        parser.add_argument('--lease', type=int, default=queue['LEASE_SECONDS'], help='seconds')
+        parser.add_argument('--max-attempts', type=int, default=queue['MAX_ATTEMPTS'])
+        parser.add_argument('--max-idle-sleep', type=float, default=30.0,
+                            help='longest wait between polls of an empty queue (seconds)')
+        parser.add_argument('--once', action='store_true', help='exit when the queue is empty')
+        parser.add_argument('--requeue-dead', action='store_true', help='retry every dead-lettered job and exit')
+
+    def handle(self, *args, **options):
+        if options['requeue_dead']:
+            self.stdout.write(f'Re-queued {requeue_dead_jobs()} dead jobs')
+            return
+
+        self.owner = worker_name()
+        self.options = options
+        # Loaded before the first claim - leases are for parsing only
+        get_nlp()
+        get_gazetteer()
+        self.stdout.write(f'Worker {self.owner} started')
+
+        done, start, idle_sleep = 0, time.perf_counter(), 0.5
+        while True:
+            jobs = claim_jobs(self.owner, options['batch_size'], options['lease'], options['max_attempts'])
+            if not jobs:
+                if options['once']:
+                    break
+                # Empty queue - poll less and less often
+                time.sleep(idle_sleep)
+                idle_sleep = min(idle_sleep * 2, options['max_idle_sleep'])
+                continue
+
+            idle_sleep = 0.5
+            done += self.process(jobs)
+            depth = update_queue_metrics()
+            self.stdout.write(f'Parsed {done} messages ({done / (time.perf_counter() - start):.1f}/s)\t'
+                              f'queue: {depth["pending"]} pending, {depth["running"]} running, '
+                              f'{depth["dead"]} dead')
+
+        self.stdout.write(self.style.SUCCESS(f'Queue empty - parsed {done} messages'))
+
+    def process(self, jobs):
+        ''' Extracts & stores the events of `jobs` - returns the number of jobs completed.
+            Reposts of already extracted messages copy their events instead of being parsed.
+            When a batch fails its jobs are retried one by one, so only the bad message is failed.
+        '''
+        rows = TelegramMessage.objects.filter(id__in=[job.message_id for job in jobs]) \
+            .values_list('id', 'text', 'date', 'simhash')
+        try:
+            complete_jobs(self.owner, jobs, extract_message_rows_deduplicated(rows))
+            return len(jobs)
+        except Exception:
+            if len(jobs) > 1:
+                return sum(self.process([job]) for job in jobs)
+            error = traceback.format_exc(limit=5)
+            self.stderr.write(f'FAILED message {jobs[0].message_id} (attempt {jobs[0].attempts})\n{error}')
+            fail_job(self.owner, jobs[0], error, self.options['max_attempts'])
+            return 0
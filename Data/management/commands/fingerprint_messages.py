@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from helpers.object_helpers import chunked
+from Data.models import TelegramMessage
+
+
+class Command(BaseCommand):
+    help = ('Sets the SimHash fingerprint of TelegramMessages stored before it existed - '
+            'so reposts of them are found as near-duplicates')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--all', action='store_true', help='recompute every fingerprint')
+
+    def handle(self, *args, **options):
+        messages = TelegramMessage.objects.only('id', 'text')
+        if not options['all']:
+            messages = messages.filter(simhash__isnull=True)
+
+        done = 0
+        for chunk in chunked(messages.order_by('id').iterator(chunk_size=options['chunk_size']),
+                             options['chunk_size']):
+            for message in chunk:
+                message.set_fingerprint()
+            with transaction.atomic():
+                TelegramMessage.objects.bulk_update(chunk, ['simhash'])
+            done += len(chunk)
+            self.stdout.write(f'Fingerprinted {done} messages')
+        self.stdout.write(self.style.SUCCESS(f'Fingerprinted {done} messages'))
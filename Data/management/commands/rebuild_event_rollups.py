@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from Data.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Repopulates the EventRollup table (events per day, place & classification) from every MessageEvent'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        created = rebuild_rollups(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {created} EventRollup rows'))
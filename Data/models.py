@@ -2,17 +2,21 @@ from django.db import models
 from django.forms.models import model_to_dict
 from django.core.serializers.json import DjangoJSONEncoder
 from django.core import serializers
+from django.utils import timezone as dj_timezone
 
 import json
 import uuid
 
 from pytz import timezone, utc
+from helpers.object_helpers import normalize_place_name
+from helpers.simhash import simhash, to_signed
 from datetime import datetime
 
 
 class City(models.Model):
     id = models.IntegerField(primary_key=True)
     name = models.CharField(max_length=260)
+    name_folded = models.CharField(max_length=260, db_index=True, default='')  # ## SET ON SAVE
     latitude = models.FloatField(null=True)
     longitude = models.FloatField(null=True)
     wikiDataId = models.CharField(max_length=10)
@@ -39,6 +43,11 @@ class City(models.Model):
 
         return cls(**relevant_kwargs)
 
+    def save(self, *args, **kwargs):
+        # Kept in sync for indexed, case/accent-insensitive name lookups
+        self.name_folded = normalize_place_name(self.name)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return json.dumps(model_to_dict(self))
 
@@ -46,6 +55,7 @@ class City(models.Model):
 class State(models.Model):
     id = models.IntegerField(primary_key=True)
     name = models.CharField(max_length=260)
+    name_folded = models.CharField(max_length=260, db_index=True, default='')  # ## SET ON SAVE
     state_code = models.CharField(max_length=4)
     type = models.CharField(max_length=100, null=True)
     latitude = models.FloatField(null=True)
@@ -67,6 +77,11 @@ class State(models.Model):
 
         return cls(**relevant_kwargs)
 
+    def save(self, *args, **kwargs):
+        # Kept in sync for indexed, case/accent-insensitive name lookups
+        self.name_folded = normalize_place_name(self.name)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return json.dumps(model_to_dict(self))
 
@@ -74,6 +89,7 @@ class State(models.Model):
 class Country(models.Model):
     id = models.IntegerField(primary_key=True)
     name = models.CharField(max_length=260)
+    name_folded = models.CharField(max_length=260, db_index=True, default='')  # ## SET ON SAVE
     iso3 = models.CharField(max_length=4)
     iso2 = models.CharField(max_length=4)
     numeric_code = models.IntegerField()
@@ -97,6 +113,11 @@ class Country(models.Model):
         relevant_kwargs = build_model_fields_from_kwargs(model_fields, kwargs)
         return cls(**relevant_kwargs)
 
+    def save(self, *args, **kwargs):
+        # Kept in sync for indexed, case/accent-insensitive name lookups
+        self.name_folded = normalize_place_name(self.name)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return json.dumps(model_to_dict(self))
 
@@ -104,7 +125,7 @@ class Country(models.Model):
 class TelegramMessage(models.Model):
     id = models.IntegerField(primary_key=True)
     type = models.CharField(max_length=100)
-    date = models.DateTimeField(editable=True)  # ############### TRANSFORMS ON SAVE
+    date = models.DateTimeField(editable=True, db_index=True)  # # TRANSFORMS ON SAVE
     from_name = models.CharField(max_length=260)  # ############# TRANSFORMS ON FIELD: 'from'
     from_id = models.CharField(max_length=260)
     text = models.TextField()
@@ -120,6 +141,18 @@ class TelegramMessage(models.Model):
     height = models.IntegerField(null=True)
     photo = models.CharField(max_length=260, null=True)
     forwarded_from = models.CharField(max_length=260, null=True)
+    # SimHash of `text` (signed) - near-duplicate lookups (see `Data/near_duplicates.py`)
+    simhash = models.BigIntegerField(null=True)  # ################ SET ON SAVE / CREATE
+
+    def set_fingerprint(self):
+        ''' Sets `simhash` from `text` - None for texts too short to fingerprint '''
+        fingerprint = simhash(str(self.text or ''))
+        self.simhash = to_signed(fingerprint) if fingerprint is not None else None
+
+    def save(self, *args, **kwargs):
+        # `create()` sets it too - the bulk ingest paths never call `save()`
+        self.set_fingerprint()
+        super().save(*args, **kwargs)
 
     @classmethod
     def create(cls, **kwargs):
@@ -156,12 +189,63 @@ class TelegramMessage(models.Model):
                 raise Exception(
                     f"FIELD: 'edited' MUST BE IN AN ISO FORMATE TO BE SAVED!\nRECEIVED:\t{relevant_kwargs['edited']}")
 
-        return cls(**relevant_kwargs)
+        message = cls(**relevant_kwargs)
+        message.set_fingerprint()
+        return message
 
     def __str__(self):
         return json.dumps(model_to_dict(self), cls=DjangoJSONEncoder)
 
 
+class IngestCheckpoint(models.Model):
+    ''' High-water marks of `run_messages` for one Telegram channel.
+        Lets ingestion resume after a crash and skip messages already stored.
+    '''
+    channel_id = models.CharField(max_length=260, unique=True)
+    last_message_id = models.IntegerField(default=0)
+    last_edited = models.DateTimeField(null=True)  # Newest `edited` timestamp of the last export read to the end
+    # Position in the export file - only valid while `export_name`/`export_size` match
+    export_name = models.CharField(max_length=260, null=True)
+    export_size = models.BigIntegerField(default=0)
+    export_offset = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return json.dumps(model_to_dict(self), cls=DjangoJSONEncoder)
+
+
+class ExtractionJob(models.Model):
+    ''' Queued event extraction of one `TelegramMessage` - drained by `manage.py extraction_worker`.
+        A worker claims a job by taking its lease; an expired lease makes the job claimable again.
+        Done jobs are deleted - failed ones are retried with backoff, then kept as DEAD (dead letter).
+        See `Data/extraction_queue.py`.
+    '''
+    class States(models.TextChoices):
+        PENDING = 'pending'
+        RUNNING = 'running'
+        DEAD = 'dead'
+
+    message = models.OneToOneField('TelegramMessage', on_delete=models.CASCADE, related_name='extraction_job')
+    state = models.CharField(max_length=10, choices=States.choices, default=States.PENDING)
+    attempts = models.IntegerField(default=0)
+    available_at = models.DateTimeField(default=dj_timezone.now)  # Not claimed before (retry backoff)
+    lease_owner = models.CharField(max_length=100, null=True)
+    lease_expires = models.DateTimeField(null=True)
+    last_error = models.TextField(null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['state', 'available_at'])]
+
+    def __str__(self):
+        return json.dumps(model_to_dict(self), cls=DjangoJSONEncoder)
+
+
+def get_na_event_type():
+    ''' Gets/Creates `EventClassification` with default `EventType` set to NA - returns its id '''
+    return EventClassification.objects.get_or_create(eType="NA")[0].id
+
+
 class MessageEvent(models.Model):
     ''' TelegramMessage that has been parsed/classified via NLP - with City,
         State, Country info extracted - and `classification` of event identified, ready
@@ -191,6 +275,37 @@ class MessageEvent(models.Model):
         # return json.dumps(model_to_dict(self), cls=DjangoJSONEncoder)
 
 
+class EventRollup(models.Model):
+    ''' Number of `MessageEvent`s per day, place, and classification.
+        Kept up to date as events are created/deleted (see `Data/rollups.py`) so timelines
+        and per-place counts don't aggregate the raw events on every request.
+    '''
+    date = models.DateField()
+    place_type = models.CharField(max_length=10)  # 'city' | 'state' | 'country'
+    place_id = models.IntegerField()
+    classification = models.CharField(max_length=4, default='NA')  # `EventClassification.eType`
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('date', 'place_type', 'place_id', 'classification')
+
+    def __str__(self):
+        return json.dumps(model_to_dict(self), cls=DjangoJSONEncoder)
+
+
+class DataVersion(models.Model):
+    ''' Counter bumped whenever a set of rows changes (ie: 'events' - see `Data/rollups.py`).
+        Readers that cache something built from those rows compare one indexed row instead of
+        aggregating the table.
+    '''
+    name = models.CharField(max_length=50, unique=True)
+    version = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return json.dumps(model_to_dict(self), cls=DjangoJSONEncoder)
+
+
 class EventClassification(models.Model):
     class EventTypes(models.TextChoices):
         # TODO Use below (commented-out) specific types - with icons later...
@@ -234,11 +349,6 @@ class EventClassification(models.Model):
 ###############################################################################################
 ###################################### HELPER FUNCTIONS  ######################################
 
-def get_na_event_type(self):
-    ''' Gets/Creates `EventClassification` with default `EventType` set to NA '''
-    return EventClassification.objects.get_or_create(eType="NA")
-
-
 def transform_iso_to_dt(dt_str: str):
     ''' Returns either a datetime.datetime instance or `False` if unable to transform from iso-string '''
     try:
@@ -256,9 +366,10 @@ def query_db_for_country(c_id):
     ''' Helper func. for 'create' methods in classes.
         Returns None if not found.
     '''
-    query = Country.objects.filter(id=c_id)
+    # Single query - evaluate at most 2 rows instead of `exists()` then `len()`
+    query = list(Country.objects.filter(id=c_id)[:2])
 
-    if query.exists() and len(query) == 1:
+    if len(query) == 1:
         return query
     return None
 
@@ -267,9 +378,10 @@ def query_db_for_state(s_id):
     ''' Helper func. for 'create' methods in classes.
         Returns None if not found.
     '''
-    query = State.objects.filter(id=s_id)
+    # Single query - evaluate at most 2 rows instead of `exists()` then `len()`
+    query = list(State.objects.filter(id=s_id)[:2])
 
-    if query.exists() and len(query) == 1:
+    if len(query) == 1:
         return query
     return None
 
@@ -278,13 +390,22 @@ def query_db_for_city(c_id):
     ''' Helper func. for 'create' methods in classes.
         Returns None if not found.
     '''
-    query = City.objects.filter(id=c_id)
+    # Single query - evaluate at most 2 rows instead of `exists()` then `len()`
+    query = list(City.objects.filter(id=c_id)[:2])
 
-    if query.exists() and len(query) == 1:
+    if len(query) == 1:
         return query
     return None
 
 
+def concrete_fields_from_kwargs(model, kwargs):
+    ''' Filters raw input down to `model`s concrete fields (by attname - ie: `state_id`).
+        Used for building instances for `bulk_create`, where related fields are set by id.
+    '''
+    attnames = {f.attname for f in model._meta.concrete_fields}
+    return {key: value for key, value in kwargs.items() if key in attnames}
+
+
 def build_model_fields_from_kwargs(fields, kwargs):
     ''' Intended to be used to filter out kwargs from raw input so `kwargs` 
         match to `fields` before setting related fields and creating Model 
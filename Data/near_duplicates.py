@@ -0,0 +1,170 @@
+''' Skips NLP for reposts - a queued message whose SimHash is within `NEAR_DUPLICATES['MAX_DISTANCE']`
+    bits of an already extracted message (posted within `WINDOW_DAYS`) gets a copy of that message's
+    `MessageEvent`s instead of a spaCy parse. See `helpers/simhash.py`.
+
+    Close fingerprints alone are not enough - the same report about another city is only a few
+    bits away - so a copy also needs the same text, or the same gazetteer places mentioned.
+'''
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from helpers.gazetteer import place_mentions
+from helpers.metrics import REGISTRY, timed
+from helpers.object_helpers import normalize_place_name
+from helpers.simhash import bands, hamming, to_unsigned
+from Data.import_data import extract_message_rows
+from Data.models import MessageEvent, TelegramMessage
+from Data.rollups import PLACE_RELATIONS
+
+
+REGISTRY.describe('rus_ukr_extraction_copies_total',
+                  'Messages whose events were copied from a near-duplicate instead of parsed')
+
+EVENT_FIELDS = ('subject', 'action', 'text', 'is_multi_sentence', 'contains_places')
+
+
+def near_duplicate_option(name: str):
+    return settings.NEAR_DUPLICATES[name]
+
+
+def is_near(a, b, max_distance: int, window: timedelta):
+    ''' `a`, `b`: (fingerprint, date) - True when both are within `max_distance` bits and `window` '''
+    return abs(a[1] - b[1]) <= window and hamming(a[0], b[0]) <= max_distance
+
+
+class SameExtraction:
+    ''' `matches(text, other)` - True when the events of one text can be copied to the other:
+        equal normalized texts, or texts that mention the same gazetteer places.
+        Place mentions are worked out once per text.
+    '''
+
+    def __init__(self):
+        self._mentions = {}
+
+    def mentions(self, text: str):
+        if text not in self._mentions:
+            self._mentions[text] = place_mentions(text)
+        return self._mentions[text]
+
+    def matches(self, text: str, other: str):
+        text, other = str(text or ''), str(other or '')
+        if normalize_place_name(text) == normalize_place_name(other):
+            return True
+        return self.mentions(text) == self.mentions(other)
+
+
+@timed('near_duplicates')
+def find_near_duplicates(rows, max_distance: int = None, window_days: int = None, same=None):
+    ''' `rows`: [(message id, text, date, simhash), ...] -> {message id: id of the closest already
+        extracted message that passes `SameExtraction`}. Rows without such a match are left out.
+    '''
+    max_distance = near_duplicate_option('MAX_DISTANCE') if max_distance is None else max_distance
+    window = timedelta(days=window_days or near_duplicate_option('WINDOW_DAYS'))
+    same = same or SameExtraction()
+    rows = [(m_id, text, (to_unsigned(h), date)) for m_id, text, date, h in rows if h is not None]
+    if not rows:
+        return {}
+
+    # Indexed date window first - the band buckets below do the fingerprint matching
+    dates = [key[1] for _, _, key in rows]
+    candidates = TelegramMessage.objects \
+        .filter(date__range=(min(dates) - window, max(dates) + window), simhash__isnull=False) \
+        .filter(id__in=MessageEvent.objects.values('original_message'), extraction_job__isnull=True) \
+        .exclude(id__in=[m_id for m_id, _, _ in rows]) \
+        .values_list('id', 'simhash', 'date')
+
+    # (band number, band) -> candidates - only candidates sharing a band are compared
+    buckets = {}
+    for c_id, h, date in candidates:
+        key = (to_unsigned(h), date)
+        for i, band in enumerate(bands(key[0])):
+            buckets.setdefault((i, band), []).append((c_id, key))
+
+    near = {}  # message id -> candidate ids, closest (then oldest) first
+    for m_id, _, key in rows:
+        found = {c_id: c_key for i, band in enumerate(bands(key[0])) for c_id, c_key in buckets.get((i, band), ())
+                 if is_near(key, c_key, max_distance, window)}
+        if found:
+            near[m_id] = sorted(found, key=lambda c_id: (hamming(key[0], found[c_id][0]), c_id))
+    if not near:
+        return {}
+
+    texts = dict(TelegramMessage.objects.filter(id__in={c_id for ids in near.values() for c_id in ids})
+                 .values_list('id', 'text'))
+    sources = {}
+    for m_id, text, _ in rows:
+        source = next((c_id for c_id in near.get(m_id, ()) if same.matches(text, texts[c_id])), None)
+        if source is not None:
+            sources[m_id] = source
+    return sources
+
+
+def copy_extractions(sources: dict, dates: dict):
+    ''' `sources`: {message id: source message id}, `dates`: {message id: date} -> `extract_event_from_doc`
+        results for the messages (ready for `persist_MessageEvents`), copied from the source's events.
+    '''
+    events = {}
+    for event in MessageEvent.objects.filter(original_message_id__in=set(sources.values())) \
+            .select_related('classification'):
+        events.setdefault(event.original_message_id, []).append(event)
+
+    event_ids = [event.id for source_events in events.values() for event in source_events]
+    places = {}  # (relation, event id) -> [place id...]
+    for relation in PLACE_RELATIONS:
+        field = MessageEvent._meta.get_field(relation)
+        source, target = f'{field.m2m_field_name()}_id', f'{field.m2m_reverse_field_name()}_id'
+        for event_id, place_id in field.remote_field.through.objects \
+                .filter(**{f'{source}__in': event_ids}).values_list(source, target):
+            places.setdefault((relation, event_id), []).append(place_id)
+
+    copies = []
+    for m_id, source_id in sources.items():
+        for event in events.get(source_id, ()):
+            extracted = {field: getattr(event, field) for field in EVENT_FIELDS}
+            extracted['classification'] = event.classification
+            extracted.update({relation: places.get((relation, event.id), []) for relation in PLACE_RELATIONS})
+            extracted['original_message_id'] = m_id
+            extracted['event_date'] = datetime.isoformat(dates[m_id])
+            copies.append(extracted)
+    return copies
+
+
+def extract_message_rows_deduplicated(rows):
+    ''' `extract_message_rows` for `rows`: [(message id, text, date, simhash), ...] - but only the messages
+        without a near-duplicate are parsed. The others copy the events of an already extracted message,
+        or of the first of `rows` they are close to.
+    '''
+    rows = list(rows)
+    max_distance = near_duplicate_option('MAX_DISTANCE')
+    window = timedelta(days=near_duplicate_option('WINDOW_DAYS'))
+    dates = {m_id: date for m_id, _, date, _ in rows}
+    same = SameExtraction()
+    sources = find_near_duplicates(rows, max_distance, same=same)
+
+    # Near-duplicates within `rows` - only the first of each group is parsed
+    to_parse, same_as = [], {}
+    for row in rows:
+        m_id, text, date, h = row
+        if m_id in sources:
+            continue
+        if h is not None:
+            key = (to_unsigned(h), date)
+            original = next((p[0] for p in to_parse
+                             if p[3] is not None and is_near(key, (to_unsigned(p[3]), p[2]), max_distance, window)
+                             and same.matches(text, p[1])),
+                            None)
+            if original is not None:
+                same_as[m_id] = original
+                continue
+        to_parse.append(row)
+
+    extracted = extract_message_rows((m_id, text, date) for m_id, text, date, _ in to_parse)
+    parsed = {result['original_message_id']: result for result in extracted}
+    for m_id, original in same_as.items():
+        extracted.append(dict(parsed[original], original_message_id=m_id, event_date=datetime.isoformat(dates[m_id])))
+    extracted.extend(copy_extractions(sources, dates))
+
+    if sources or same_as:
+        REGISTRY.inc('rus_ukr_extraction_copies_total', len(sources) + len(same_as))
+    return extracted
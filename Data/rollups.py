@@ -0,0 +1,161 @@
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from helpers.object_helpers import chunked
+from Data.models import DataVersion, MessageEvent, EventRollup
+
+
+# MessageEvent relation -> `EventRollup.place_type` (also the place field on the through table)
+PLACE_RELATIONS = {'cities': 'city', 'states': 'state', 'countries': 'country'}
+
+# `DataVersion` bumped on every MessageEvent write/delete
+EVENTS_VERSION = 'events'
+
+# Set while `delete_events` runs - it already took the deleted events off the rollups
+_bulk_delete = ContextVar('rollups_bulk_delete', default=False)
+
+
+def rollup_key(event_date, place_type: str, place_id: int, classification):
+    ''' (date, place type, place id, classification code) - the `EventRollup` unique key '''
+    if isinstance(event_date, str):
+        event_date = datetime.fromisoformat(event_date.replace('Z', '+00:00'))
+    if isinstance(event_date, datetime):
+        event_date = event_date.date()
+    e_type = getattr(classification, 'eType', classification) or 'NA'
+    return event_date, place_type, place_id, e_type
+
+
+def count_extracted_events(extracted_events):
+    ''' Counter of rollup keys for `extract_event_from_doc` results (with `event_date`) '''
+    counts = Counter()
+    for extracted in extracted_events:
+        if not extracted.get('event_date'):
+            continue
+        for relation, place_type in PLACE_RELATIONS.items():
+            for place_id in set(extracted[relation]):
+                counts[rollup_key(extracted['event_date'], place_type, place_id,
+                                  extracted.get('classification'))] += 1
+    return counts
+
+
+def apply_rollup_counts(counts: Counter, sign: int = 1):
+    ''' Adds (`sign=1`) or removes (`sign=-1`) `counts` from the `EventRollup` rows '''
+    counts = {key: n for key, n in counts.items() if n}
+    if not counts:
+        return
+
+    with transaction.atomic():
+        if sign > 0:
+            # Make sure every row exists - then every key is a plain increment
+            EventRollup.objects.bulk_create(
+                [EventRollup(date=d, place_type=t, place_id=p, classification=c) for d, t, p, c in counts],
+                ignore_conflicts=True)
+
+        for (date, place_type, place_id, classification), n in counts.items():
+            EventRollup.objects.filter(date=date, place_type=place_type, place_id=place_id,
+                                       classification=classification) \
+                .update(count=F('count') + sign * n)
+
+        if sign < 0:
+            # Only the rows just decremented can have dropped to 0
+            for keys in chunked(counts, 100):
+                touched = Q()
+                for date, place_type, place_id, classification in keys:
+                    touched |= Q(date=date, place_type=place_type, place_id=place_id, classification=classification)
+                EventRollup.objects.filter(touched, count__lte=0).delete()
+
+
+def bump_events_version():
+    ''' Marks `MessageEvent`s as changed - call in the transaction that changes them '''
+    DataVersion.objects.get_or_create(name=EVENTS_VERSION)
+    DataVersion.objects.filter(name=EVENTS_VERSION).update(version=F('version') + 1)
+
+
+def events_version():
+    ''' Stamp of the current `MessageEvent`s - changes with every write or delete (one indexed row) '''
+    version = DataVersion.objects.filter(name=EVENTS_VERSION).values_list('version', flat=True).first()
+    return str(version or 0)
+
+
+def rollup_counts(place_type: str, start=None, end=None, classification: str = None):
+    ''' {place id: number of events} for one place type, read from `EventRollup` rows '''
+    rows = EventRollup.objects.filter(place_type=place_type)
+    if start:
+        rows = rows.filter(date__gte=start)
+    if end:
+        rows = rows.filter(date__lte=end)
+    if classification:
+        rows = rows.filter(classification=classification)
+    return dict(rows.values('place_id').annotate(total=Sum('count')).order_by().values_list('place_id', 'total'))
+
+
+def place_counts(relation: str, events=None):
+    ''' Rollup rows ({date, place_id, classification, count}) of the `relation` (cities | states | countries)
+        links of `events` (a `MessageEvent` queryset - default every event), aggregated in the db
+    '''
+    place_type = PLACE_RELATIONS[relation]
+    links = MessageEvent._meta.get_field(relation).remote_field.through.objects \
+        .filter(messageevent__event_date__isnull=False)
+    if events is not None:
+        links = links.filter(messageevent__in=events)
+    return links.values(date=TruncDate('messageevent__event_date'),
+                        place_id=F(f'{place_type}_id'),
+                        classification=Coalesce('messageevent__classification__eType', Value('NA'))) \
+        .annotate(count=Count('messageevent_id')) \
+        .order_by()
+
+
+def delete_events(events):
+    ''' Deletes the `MessageEvent`s of queryset `events` - taking them off the rollups with one
+        aggregate query per place type (instead of one query per event in `pre_delete`)
+    '''
+    with transaction.atomic():
+        counts = Counter()
+        for relation, place_type in PLACE_RELATIONS.items():
+            for row in place_counts(relation, events):
+                counts[(row['date'], place_type, row['place_id'], row['classification'])] += row['count']
+        apply_rollup_counts(counts, sign=-1)
+        bump_events_version()
+
+        token = _bulk_delete.set(True)
+        try:
+            deleted, _ = events.delete()
+        finally:
+            _bulk_delete.reset(token)
+    return deleted
+
+
+def rebuild_rollups(chunk_size: int = 5000):
+    ''' Repopulates `EventRollup` from scratch out of every `MessageEvent` '''
+    with transaction.atomic():
+        EventRollup.objects.all().delete()
+
+        created = 0
+        for relation, place_type in PLACE_RELATIONS.items():
+            for chunk in chunked(place_counts(relation).iterator(), chunk_size):
+                EventRollup.objects.bulk_create([EventRollup(place_type=place_type, **row) for row in chunk])
+                created += len(chunk)
+    return created
+
+
+@receiver(pre_delete, sender=MessageEvent)
+def _event_deleted(sender, instance, **kwargs):
+    # Single deletes & cascades (ie: a deleted TelegramMessage) - `delete_events` did its own counts
+    if _bulk_delete.get():
+        return
+    bump_events_version()
+    if instance.event_date is None:
+        return
+    # Place links still exist before the delete
+    counts = Counter()
+    for relation, place_type in PLACE_RELATIONS.items():
+        for place_id in getattr(instance, relation).values_list('id', flat=True):
+            counts[rollup_key(instance.event_date, place_type, place_id, instance.classification)] += 1
+    apply_rollup_counts(counts, sign=-1)
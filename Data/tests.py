@@ -1,3 +1,404 @@
-from django.test import TestCase
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+import io
+import json
+import os
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from django.utils import timezone as dj_timezone
+
+from Data import import_data
+from Data.extraction_queue import (enqueue_messages, claim_jobs, complete_jobs, fail_job, requeue_dead_jobs,
+                                   wait_for_capacity)
+from Data.import_data import (bulk_create_in_chunks, create_TelegramMessage_models, persist_MessageEvents,
+                              run_messages, upsert_TelegramMessage_models)
+from Data.models import (City, State, Country, TelegramMessage, MessageEvent, EventRollup, ExtractionJob,
+                         IngestCheckpoint)
+from Data.near_duplicates import SameExtraction, copy_extractions, find_near_duplicates
+from Data.rollups import apply_rollup_counts, delete_events, events_version, rebuild_rollups, rollup_counts
+from helpers import gazetteer
+from helpers.gazetteer_file import write_gazetteer_file
+from helpers.metrics import REGISTRY, metric_key
+from helpers.nlp_messages import check_token_is_place
+from helpers.simhash import BANDS, hamming, simhash, to_signed, to_unsigned
+from helpers.telegram_export import TelegramExportReader
+
+
+REPORT = ('Russian troops shelled residential areas and the railway station of Kharkiv overnight, the regional '
+          'governor said on Telegram, adding that two people were wounded and several buildings were damaged')
+
+
+def quiet():
+    ''' Swallows the progress printed by ingest & queue functions '''
+    return redirect_stdout(io.StringIO())
+
+
+def create_places():
+    Country(id=1, name='Ukraine', iso3='UKR', iso2='UA', numeric_code=804, phone_code='380', capital='Kyiv',
+            currency='UAH', currency_name='Hryvnia', currency_symbol='₴', tld='.ua', native='Україна',
+            region='Europe', subregion='Eastern Europe', latitude=49.0, longitude=32.0, emoji='', emojiU='').save()
+    State(id=1, name='Kharkiv Oblast', state_code='63', type='oblast', latitude=49.5, longitude=36.5,
+          country_id=1).save()
+    City(id=1, name='Kharkiv', latitude=49.99, longitude=36.23, wikiDataId='Q42308', state_id=1, country_id=1).save()
+    City(id=2, name='Sumy', latitude=50.91, longitude=34.80, wikiDataId='Q170136', state_id=1, country_id=1).save()
+
+
+def message(m_id: int, text: str, date: str = '2022-03-01T10:00:00', **fields):
+    ''' Message object as found in a Telegram export '''
+    return {'id': m_id, 'type': 'message', 'date': date, 'from': 'Channel', 'from_id': 'channel1234',
+            'text': text, **fields}
+
+
+def store_message(m_id: int, text: str, date: str = '2022-03-01T10:00:00', **fields):
+    ''' Saved `TelegramMessage` - with its extraction job removed (as if already extracted) '''
+    msg = TelegramMessage.create(**message(m_id, text, date + 'Z', **fields))
+    msg.save()
+    ExtractionJob.objects.filter(message_id=m_id).delete()
+    return msg
+
+
+def extracted_event(m_id: int, event_date: str = '2022-03-01T10:00:00Z', cities=(), states=(), countries=()):
+    ''' `extract_event_from_doc` result ready for `persist_MessageEvents` '''
+    return {'subject': 'Russian troops', 'action': 'shelled', 'text': 'Russian troops shelled',
+            'classification': None, 'is_multi_sentence': False,
+            'contains_places': bool(cities or states or countries),
+            'cities': list(cities), 'states': list(states), 'countries': list(countries),
+            'original_message_id': m_id, 'event_date': event_date}
+
+
+class IngestTests(TestCase):
+
+    def test_create_enqueues_only_new_messages(self):
+        create_TelegramMessage_models([message(1, 'First')], extract_events=False)
+        self.assertFalse(ExtractionJob.objects.exists())
+
+        create_TelegramMessage_models([message(1, 'First'), message(2, 'Second')])
+        self.assertEqual(list(ExtractionJob.objects.values_list('message_id', flat=True)), [2])
+        self.assertEqual(TelegramMessage.objects.count(), 2)
+
+    def test_upsert_overwrites_edited_messages_and_drops_their_events(self):
+        store_message(1, 'Old text')
+        store_message(2, 'Other text')
+        persist_MessageEvents([extracted_event(1), extracted_event(2)])
+
+        changed = upsert_TelegramMessage_models([
+            message(1, 'New text', edited='2022-03-02T10:00:00'),
+            message(2, 'Other text'),  # Not edited - skipped
+            message(3, 'Third'),
+        ])
+
+        self.assertEqual(sorted(m.id for m in changed), [1, 3])
+        self.assertEqual(TelegramMessage.objects.get(id=1).text, 'New text')
+        self.assertEqual(list(MessageEvent.objects.values_list('original_message_id', flat=True)), [2])
+
+    def test_bulk_create_in_chunks_counts_inserted_rows(self):
+        create_places()
+        cities = [City(id=c_id, name=f'City {c_id}', wikiDataId='', state_id=1, country_id=1) for c_id in (1, 2, 3)]
+        with quiet():
+            self.assertEqual(bulk_create_in_chunks(City, cities, chunk_size=2), 1)
+            self.assertEqual(bulk_create_in_chunks(City, cities, chunk_size=2), 0)
+
+
+class RunMessagesTests(TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.data_dir.cleanup)
+        patcher = mock.patch.object(import_data, 'DATA_DIR', self.data_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_export(self, messages):
+        with open(os.path.join(self.data_dir.name, 'messages.json'), 'w', encoding='utf-8') as wf:
+            json.dump({'name': 'Channel', 'type': 'public_channel', 'id': 1234, 'messages': messages}, wf)
+
+    def run_messages(self, **kwargs):
+        with quiet():
+            return run_messages(batch_size=1, extract_events=False, **kwargs)
+
+    def test_reruns_only_store_new_and_edited_messages(self):
+        self.write_export([message(1, 'One'), message(2, 'Two'), {'id': 3, 'type': 'service'}])
+        self.assertEqual(self.run_messages(), 2)
+        self.assertEqual(self.run_messages(), 0)
+
+        self.write_export([message(1, 'One'), message(2, 'Two, edited', edited='2022-03-02T10:00:00'),
+                           message(4, 'Four')])
+        self.assertEqual(self.run_messages(), 2)
+
+        checkpoint = IngestCheckpoint.objects.get(channel_id='1234')
+        self.assertEqual(checkpoint.last_message_id, 4)
+        self.assertEqual(checkpoint.last_edited, datetime(2022, 3, 2, 10, tzinfo=timezone.utc))
+        self.assertEqual(TelegramMessage.objects.get(id=2).text, 'Two, edited')
+
+    def test_edited_mark_only_moves_when_the_export_is_finished(self):
+        self.write_export([message(1, 'One', edited='2022-03-02T10:00:00'), message(2, 'Two')])
+        upsert = import_data.upsert_TelegramMessage_models
+
+        def crash_on_second(batch):
+            if batch[0]['id'] == 2:
+                raise RuntimeError('crash')
+            return upsert(batch)
+
+        with mock.patch.object(import_data, 'upsert_TelegramMessage_models', crash_on_second):
+            with self.assertRaises(RuntimeError):
+                self.run_messages()
+
+        checkpoint = IngestCheckpoint.objects.get(channel_id='1234')
+        self.assertEqual(checkpoint.last_message_id, 1)
+        self.assertIsNone(checkpoint.last_edited)
+        self.assertGreater(checkpoint.export_offset, 0)
+
+        # Resumes after message 1 - whose edit was stored by the crashed run, so is not marked as seen
+        self.assertEqual(self.run_messages(), 1)
+        checkpoint.refresh_from_db()
+        self.assertEqual((checkpoint.last_message_id, checkpoint.export_size), (2, 0))
+        self.assertIsNone(checkpoint.last_edited)
+        self.assertEqual(TelegramMessage.objects.get(id=1).edited, datetime(2022, 3, 2, 10, tzinfo=timezone.utc))
+
+
+class ExtractionQueueTests(TestCase):
+
+    def test_saved_messages_are_queued(self):
+        TelegramMessage.create(**message(1, 'One', '2022-03-01T10:00:00Z')).save()
+        self.assertEqual(ExtractionJob.objects.get().message_id, 1)
+
+    def test_failed_jobs_are_retried_then_dead_lettered(self):
+        store_message(1, 'One')
+        enqueue_messages([1])
+
+        job, = claim_jobs('worker', 10, lease_seconds=60, max_attempts=2)
+        self.assertEqual((job.state, job.attempts), (ExtractionJob.States.RUNNING, 1))
+        self.assertEqual(claim_jobs('other', 10), [])
+
+        fail_job('worker', job, 'boom', max_attempts=2, backoff=60)
+        job.refresh_from_db()
+        self.assertEqual(job.state, ExtractionJob.States.PENDING)
+        self.assertGreater(job.available_at, dj_timezone.now())
+        self.assertEqual(claim_jobs('worker', 10), [])
+
+        ExtractionJob.objects.update(available_at=dj_timezone.now())
+        job, = claim_jobs('worker', 10, max_attempts=2)
+        fail_job('worker', job, 'boom again', max_attempts=2)
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.last_error), (ExtractionJob.States.DEAD, 'boom again'))
+
+        self.assertEqual(requeue_dead_jobs(), 1)
+        self.assertEqual(ExtractionJob.objects.get().state, ExtractionJob.States.PENDING)
+
+    def test_expired_leases_are_claimable_again(self):
+        store_message(1, 'One')
+        enqueue_messages([1])
+        claim_jobs('dead worker', 10)
+        ExtractionJob.objects.update(lease_expires=dj_timezone.now() - timedelta(seconds=1))
+
+        job, = claim_jobs('worker', 10)
+        self.assertEqual((job.lease_owner, job.attempts), ('worker', 2))
+
+    def test_complete_jobs_replaces_earlier_events(self):
+        create_places()
+        store_message(1, 'One')
+        persist_MessageEvents([extracted_event(1, cities=[2])])
+        enqueue_messages([1])
+        jobs = claim_jobs('worker', 10)
+
+        complete_jobs('worker', jobs, [extracted_event(1, cities=[1])])
+
+        self.assertFalse(ExtractionJob.objects.exists())
+        self.assertEqual(list(MessageEvent.objects.values_list('cities', flat=True)), [1])
+        self.assertEqual(rollup_counts('city'), {1: 1})
+
+    def test_wait_for_capacity(self):
+        store_message(1, 'One')
+        enqueue_messages([1])
+        self.assertEqual(wait_for_capacity(max_depth=1), 0)
+        with quiet() as out, self.assertRaises(Exception):
+            wait_for_capacity(max_depth=0, poll_seconds=0.01, timeout=0.03)
+        self.assertIn('Extraction queue holds 1 jobs', out.getvalue())
+
+
+class RollupTests(TestCase):
+
+    def setUp(self):
+        create_places()
+        for m_id in (1, 2, 3):
+            store_message(m_id, f'Message {m_id}')
+
+    def test_rollups_follow_event_writes_and_deletes(self):
+        version = events_version()
+        persist_MessageEvents([extracted_event(1, cities=[1], states=[1]),
+                               extracted_event(2, cities=[1, 2]),
+                               extracted_event(3, '2022-03-02T10:00:00Z', cities=[1])])
+        self.assertNotEqual(events_version(), version)
+        self.assertEqual(rollup_counts('city'), {1: 3, 2: 1})
+        self.assertEqual(rollup_counts('city', start=datetime(2022, 3, 2).date()), {1: 1})
+        self.assertEqual(rollup_counts('state'), {1: 1})
+
+        version = events_version()
+        delete_events(MessageEvent.objects.filter(original_message_id=2))
+        self.assertNotEqual(events_version(), version)
+        self.assertEqual(rollup_counts('city'), {1: 2})
+        # Rows that dropped to 0 are removed
+        self.assertFalse(EventRollup.objects.filter(place_type='city', place_id=2).exists())
+
+        # Single deletes (`pre_delete`)
+        MessageEvent.objects.get(original_message_id=3).delete()
+        self.assertEqual(rollup_counts('city'), {1: 1})
+
+        incremental = set(EventRollup.objects.values_list('date', 'place_type', 'place_id', 'classification', 'count'))
+        rebuild_rollups()
+        self.assertEqual(set(EventRollup.objects.values_list('date', 'place_type', 'place_id', 'classification',
+                                                            'count')), incremental)
+
+    def test_removing_counts_only_deletes_touched_rows(self):
+        EventRollup.objects.create(date=datetime(2022, 3, 1).date(), place_type='city', place_id=9, count=0)
+        persist_MessageEvents([extracted_event(1, cities=[1])])
+        delete_events(MessageEvent.objects.all())
+        self.assertEqual(list(EventRollup.objects.values_list('place_id', flat=True)), [9])
+
+        apply_rollup_counts({(datetime(2022, 3, 1).date(), 'city', 9, 'NA'): 0}, sign=-1)
+        self.assertTrue(EventRollup.objects.filter(place_id=9).exists())
+
+
+class SimHashTests(TestCase):
+
+    def test_fingerprints(self):
+        self.assertIsNone(simhash('Too short'))
+        self.assertEqual(simhash(REPORT), simhash(REPORT.upper()))
+        self.assertLess(hamming(simhash(REPORT), simhash('Forwarded: ' + REPORT)), BANDS)
+        self.assertGreater(hamming(simhash(REPORT), simhash(
+            'The ministry of energy announced new rolling blackout schedules for the capital and the '
+            'surrounding region starting next week because of damage to substations')), 2 * BANDS)
+
+        fingerprint = simhash(REPORT)
+        self.assertLess(to_signed(fingerprint), 2 ** 63)
+        self.assertEqual(to_unsigned(to_signed(fingerprint)), fingerprint)
+
+    def test_messages_are_fingerprinted_on_create(self):
+        self.assertEqual(to_unsigned(store_message(1, REPORT).simhash), simhash(REPORT))
+        self.assertIsNone(store_message(2, 'Video').simhash)
+
+
+class NearDuplicateTests(TestCase):
+
+    def setUp(self):
+        create_places()
+        gazetteer.invalidate_gazetteer()
+        self.original = store_message(1, REPORT)
+        persist_MessageEvents([extracted_event(1, cities=[1], states=[1])])
+
+    def rows(self, *messages):
+        return [(m.id, m.text, m.date, m.simhash) for m in messages]
+
+    def test_reposts_copy_the_original_events(self):
+        repost = store_message(2, 'Forwarded: ' + REPORT, '2022-03-03T08:00:00')
+        sources = find_near_duplicates(self.rows(repost))
+        self.assertEqual(sources, {2: 1})
+
+        copies = copy_extractions(sources, {2: repost.date})
+        self.assertEqual([(c['original_message_id'], c['cities'], c['states']) for c in copies], [(2, [1], [1])])
+
+    def test_same_report_about_another_city_is_not_copied(self):
+        other_city = store_message(2, REPORT.replace('Kharkiv', 'Sumy'))
+        self.assertLess(hamming(to_unsigned(self.original.simhash), to_unsigned(other_city.simhash)), BANDS)
+        self.assertEqual(find_near_duplicates(self.rows(other_city)), {})
+
+    def test_only_extracted_messages_in_the_window_are_sources(self):
+        late = store_message(2, REPORT, '2022-04-01T10:00:00')
+        self.assertEqual(find_near_duplicates(self.rows(late), window_days=7), {})
+
+        enqueue_messages([1])  # Being extracted again
+        repost = store_message(3, REPORT)
+        self.assertEqual(find_near_duplicates(self.rows(repost)), {})
+
+    def test_same_extraction(self):
+        same = SameExtraction()
+        self.assertTrue(same.matches('Explosions in KHARKIV', 'explosions in Kharkiv'))
+        self.assertTrue(same.matches('Explosions in Kharkiv tonight', 'Kharkiv: explosions reported'))
+        self.assertFalse(same.matches('Explosions in Kharkiv', 'Explosions in Sumy'))
+
+
+class TelegramExportReaderTests(TestCase):
+
+    def setUp(self):
+        self.messages = [message(i, f'Повідомлення {i} – «{"ї" * i}»') for i in range(1, 6)]
+        handle, self.path = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, self.path)
+        with os.fdopen(handle, 'w', encoding='utf-8') as wf:
+            json.dump({'name': 'Канал', 'type': 'public_channel', 'id': 1234, 'messages': self.messages}, wf,
+                      ensure_ascii=False, indent=1)
+
+    def test_reads_header_and_messages(self):
+        reader = TelegramExportReader(self.path, read_size=16)
+        self.assertEqual(list(reader), self.messages)
+        self.assertEqual(reader.header, {'name': 'Канал', 'type': 'public_channel', 'id': 1234})
+        self.assertEqual(TelegramExportReader(self.path).read_header()['id'], 1234)
+
+    def test_offsets_are_byte_offsets_that_resume(self):
+        reader = TelegramExportReader(self.path, read_size=16)
+        offsets = []
+        for _ in reader:
+            offsets.append(reader.offset)
+
+        with open(self.path, 'rb') as rf:
+            data = rf.read()
+        # Each offset is right after a message - the rest of the array follows
+        for offset in offsets[:-1]:
+            self.assertTrue(data[offset:].lstrip().startswith(b','))
+        self.assertTrue(data[offsets[-1]:].lstrip().startswith(b']'))
+
+        resumed = TelegramExportReader(self.path, read_size=16, start_offset=offsets[1])
+        self.assertEqual(list(resumed), self.messages[2:])
+        self.assertEqual(resumed.offset, offsets[-1])
+
+
+class GazetteerFileTests(TestCase):
+
+    def setUp(self):
+        create_places()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'gazetteer.bin')
+        write_gazetteer_file(self.path)
+
+        gazetteer.invalidate_gazetteer()
+        self.addCleanup(gazetteer.invalidate_gazetteer)
+        settings = override_settings(GAZETTEER_SOURCE='file', GAZETTEER_FILE=self.path)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_replaced_file_is_mapped_again(self):
+        mapped = gazetteer.get_gazetteer()
+        self.assertIn((City, 1), mapped.exact('Kharkiv'))
+        self.assertEqual(mapped.exact('Izium'), [])
+
+        # Written by another process - no signal reaches this one
+        City.objects.bulk_create([City(id=3, name='Izium', wikiDataId='', state_id=1, country_id=1)])
+        write_gazetteer_file(self.path)
+
+        with mock.patch.object(gazetteer, 'FILE_CHECK_SECONDS', 3600):
+            self.assertIs(gazetteer.get_gazetteer(), mapped)
+        with mock.patch.object(gazetteer, 'FILE_CHECK_SECONDS', 0):
+            remapped = gazetteer.get_gazetteer()
+            self.assertIsNot(remapped, mapped)
+            self.assertEqual(remapped.exact('Izium'), [(City, 3)])
+            self.assertIs(gazetteer.get_gazetteer(), remapped)
+
+
+class PlaceLookupTests(TestCase):
+
+    def setUp(self):
+        create_places()
+        gazetteer.invalidate_gazetteer()
+
+    def test_check_token_is_place(self):
+        misses = metric_key('rus_ukr_place_lookup_misses_total', {'match': 'exact'})
+        before = REGISTRY.counters.get(misses, 0)
+        with quiet() as out:
+            self.assertEqual(check_token_is_place(SimpleNamespace(text='Sumy', pos_='PROPN'), True), (City, 2))
+            self.assertFalse(check_token_is_place(SimpleNamespace(text='Zelensky', pos_='PROPN'), True))
+            self.assertFalse(check_token_is_place(SimpleNamespace(text='Sumy', pos_='NOUN'), False))
+        self.assertEqual(out.getvalue(), '')
+        self.assertEqual(REGISTRY.counters[misses], before + 1)
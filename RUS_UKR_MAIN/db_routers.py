@@ -0,0 +1,78 @@
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+
+REPLICA_ALIAS = 'replica'
+
+# Set while a `read_from_replica` view runs
+_read_from_replica = ContextVar('read_from_replica', default=False)
+
+
+class ReplicaRouter:
+    ''' Reads made by `read_from_replica` views go to the 'replica' database (when configured).
+        Every write - and every read of ingestion, admin, and other views - uses 'default'.
+    '''
+
+    def db_for_read(self, model, **hints):
+        if _read_from_replica.get() and REPLICA_ALIAS in settings.DATABASES:
+            return REPLICA_ALIAS
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+def read_from_replica(view):
+    ''' Marks a read-only view - its queries (including the ones of a streamed response) read from the replica '''
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            token = _read_from_replica.set(True)
+            try:
+                response = await view(request, *args, **kwargs)
+            finally:
+                _read_from_replica.reset(token)
+            return replica_streaming(response)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            token = _read_from_replica.set(True)
+            try:
+                response = view(request, *args, **kwargs)
+            finally:
+                _read_from_replica.reset(token)
+            return replica_streaming(response)
+    return wrapper
+
+
+def replica_streaming(response):
+    ''' Streamed content is built after the view returns - keep reading from the replica while it is '''
+    if isinstance(response, StreamingHttpResponse) and not getattr(response, 'is_async', False):
+        response.streaming_content = _iter_from_replica(response.streaming_content)
+    return response
+
+
+def _iter_from_replica(content):
+    content = iter(content)
+    while True:
+        # Set & reset around every chunk - the server may pull chunks from different contexts
+        token = _read_from_replica.set(True)
+        try:
+            chunk = next(content, None)
+        finally:
+            _read_from_replica.reset(token)
+        if chunk is None:
+            return
+        yield chunk
+
@@ -50,6 +50,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'maps.middleware.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'RUS_UKR_MAIN.urls'
@@ -76,12 +77,56 @@ WSGI_APPLICATION = 'RUS_UKR_MAIN.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Configured by DB_* env vars - SQLite (`db.sqlite3`, in WAL mode via `init_command`, Django 5.1+) when DB_ENGINE is not set.
+#   DB_ENGINE: sqlite | postgres (or a backend path)   DB_NAME / DB_USER / DB_PASSWORD / DB_HOST / DB_PORT
+#   DB_CONN_MAX_AGE: seconds a connection is kept open between requests (0 = per request)
+#   DB_POOL=1: psycopg connection pool instead of persistent connections (Postgres, Django 5.1+)
+#   DB_REPLICA_HOST / DB_REPLICA_PORT: read replica - used by read-only `maps` views (RUS_UKR_MAIN/db_routers.py)
+DB_ENGINES = {'sqlite': 'django.db.backends.sqlite3', 'postgres': 'django.db.backends.postgresql'}
+
+
+def database_from_env(host=None, port=None):
+    engine = DB_ENGINES.get(os.environ.get('DB_ENGINE', 'sqlite'), os.environ.get('DB_ENGINE'))
+    if engine == DB_ENGINES['sqlite']:
+        return {
+            'ENGINE': engine,
+            'NAME': os.environ.get('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                # Seconds a writer waits for the file lock before "database is locked"
+                'timeout': 20,
+                # WAL lets map readers keep reading while the ingest writes (run on every new connection)
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+            },
+        }
+
+    database = {
+        'ENGINE': engine,
+        'NAME': os.environ.get('DB_NAME', 'rus_ukr'),
+        'USER': os.environ.get('DB_USER', ''),
+        'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+        'HOST': host or os.environ.get('DB_HOST', ''),
+        'PORT': port or os.environ.get('DB_PORT', ''),
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {},
     }
-}
+    if os.environ.get('DB_POOL') == '1':
+        # Pooled connections replace persistent ones
+        database['CONN_MAX_AGE'] = 0
+        database['OPTIONS']['pool'] = True
+    return database
+
+
+DATABASES = {'default': database_from_env()}
+
+if os.environ.get('DB_REPLICA_HOST'):
+    DATABASES['replica'] = database_from_env(os.environ['DB_REPLICA_HOST'], os.environ.get('DB_REPLICA_PORT'))
+    # Tests run against one database - the replica alias reads from it
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+
+DATABASE_ROUTERS = ['RUS_UKR_MAIN.db_routers.ReplicaRouter']
 
 
 # Password validation
@@ -121,6 +166,63 @@ USE_TZ = True
 STATIC_URL = 'static/'
 MEDIA_ROOT = 'media/'
 
+# Place name lookups (helpers/gazetteer.py)
+# 'db': every process builds its index from the db - 'file': processes share the memory-mapped
+# GAZETTEER_FILE (rebuilt by `manage.py build_gazetteer_file` and by `run_gazetteer()`)
+GAZETTEER_SOURCE = os.environ.get('GAZETTEER_SOURCE', 'db')
+GAZETTEER_FILE = BASE_DIR / 'Data' / 'gazetteer.bin'
+
+# Place boundary geometry (maps/ExtData.py)
+# Offline mode only serves stored geometry - the provider is never called
+GEOMETRY_OFFLINE = os.environ.get('GEOMETRY_OFFLINE', '') == '1'
+GEOMETRY_PROVIDER = os.environ.get('GEOMETRY_PROVIDER', 'maps.ExtData.NominatimProvider')
+# Used by `maps.ExtData.LocalGeometryProvider`
+GEOMETRY_LOCAL_FILE = BASE_DIR / 'Data' / 'geometries.json'
+# HTTP client of the geometry providers (maps/http_client.py) - timeouts in seconds,
+# RATE_LIMIT in requests/second for the whole process (Nominatim allows 1)
+GEOMETRY_HTTP = {
+    'TIMEOUT': float(os.environ.get('GEOMETRY_HTTP_TIMEOUT', 10)),
+    'CONNECT_TIMEOUT': 5,
+    'RETRIES': 3,
+    'BACKOFF': 0.5,
+    'MAX_CONNECTIONS': 10,
+    'RATE_LIMIT': float(os.environ.get('GEOMETRY_RATE_LIMIT', 1.0)),
+    'USER_AGENT': os.environ.get('GEOMETRY_USER_AGENT', 'RUS_UKR_MAIN-maps'),
+}
+
+# Progress of `manage.py prefetch_geometry` - read by `--resume`
+GEOMETRY_PREFETCH_STATE = BASE_DIR / 'geometry_prefetch.json'
+
+# Rendered map HTML (maps/render_cache.py)
+# BACKEND: 'memory' (per process) or 'file' (shared by every process, stored in LOCATION)
+MAP_CACHE = {
+    'BACKEND': os.environ.get('MAP_CACHE_BACKEND', 'memory'),
+    'MAX_ENTRIES': int(os.environ.get('MAP_CACHE_MAX_ENTRIES', 256)),
+    'LOCATION': BASE_DIR / 'map_cache',
+}
+
+# Event extraction queue (Data/extraction_queue.py, `manage.py extraction_worker`)
+EXTRACTION_QUEUE = {
+    'BATCH_SIZE': 100,  # Jobs claimed by a worker at a time
+    'LEASE_SECONDS': 300,  # A claimed job becomes claimable again after this
+    'MAX_ATTEMPTS': 5,  # Then the job is dead-lettered
+    'RETRY_BACKOFF': 30,  # Seconds before the first retry - doubled every attempt
+    'MAX_DEPTH': int(os.environ.get('EXTRACTION_QUEUE_MAX_DEPTH', 50000)),  # Ingest waits above this
+    'BACKPRESSURE_TIMEOUT': 600,  # Seconds ingest waits for the queue to drain before giving up - 0 waits forever
+}
+
+# Near-duplicate messages (Data/near_duplicates.py) - reposts copy the extraction of the original
+NEAR_DUPLICATES = {
+    'MAX_DISTANCE': 7,  # Differing SimHash bits - at most `helpers.simhash.BANDS - 1` (8 bands)
+    'WINDOW_DAYS': 7,  # Originals are looked for this many days around the message
+}
+
+# Request & pipeline metrics (helpers/metrics.py, maps/middleware.py)
+# Maps requests slower than this many seconds are logged with a per-stage breakdown - unset disables the log
+SLOW_REQUEST_SECONDS = float(os.environ['SLOW_REQUEST_SECONDS']) if os.environ.get('SLOW_REQUEST_SECONDS') else None
+# Clients allowed to read the Prometheus text at /maps/metrics/
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
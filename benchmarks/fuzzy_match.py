@@ -0,0 +1,158 @@
+''' Accuracy & latency of place-name matching: the old `compare_strings` scorer vs `TrigramIndex`.
+
+    python -m benchmarks.fuzzy_match            # built-in sample gazetteer
+    python -m benchmarks.fuzzy_match --from-db  # every City/State/Country name in the db
+    python -m benchmarks.fuzzy_match --synthetic 150000  # sample + synthetic names - a larger, noisier gazetteer
+
+    Besides accuracy on `LABELLED_MENTIONS` it reports the false positive rate: the share of
+    `NON_PLACES` (proper nouns of the feeds that are not places) matching any name at the threshold.
+'''
+import argparse
+import os
+import random
+import statistics
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'RUS_UKR_MAIN.settings')
+django.setup()
+
+from helpers.fuzzy import TrigramIndex  # noqa: E402
+from benchmarks.synthetic import synthetic_name  # noqa: E402
+from helpers.gazetteer import FUZZY_MIN_SCORE, normalize_place_name  # noqa: E402
+from helpers.nlp_messages import compare_strings  # noqa: E402
+
+
+# (mention as written in messages, gazetteer name it refers to)
+LABELLED_MENTIONS = [
+    ('Kyiv', 'Kyiv'), ('Kiev', 'Kyiv'),
+    ('Kharkiv', 'Kharkiv'), ('Kharkov', 'Kharkiv'),
+    ('Odesa', 'Odesa'), ('Odessa', 'Odesa'),
+    ('Lviv', 'Lviv'), ('Lvov', 'Lviv'),
+    ('Mykolaiv', 'Mykolaiv'), ('Nikolaev', 'Mykolaiv'),
+    ('Luhansk', 'Luhansk'), ('Lugansk', 'Luhansk'),
+    ('Dnipro', 'Dnipro'), ('Dnepr', 'Dnipro'),
+    ('Zaporizhia', 'Zaporizhia'), ('Zaporozhye', 'Zaporizhia'),
+    ('Chernihiv', 'Chernihiv'), ('Chernigov', 'Chernihiv'),
+    ('Hostomel', 'Hostomel'), ('Gostomel', 'Hostomel'),
+    ('Enerhodar', 'Enerhodar'), ('Energodar', 'Enerhodar'),
+    ('Berdiansk', 'Berdiansk'), ('Berdyansk', 'Berdiansk'),
+    ('Sievierodonetsk', 'Sievierodonetsk'), ('Severodonetsk', 'Sievierodonetsk'),
+    ('Lysychansk', 'Lysychansk'), ('Lisichansk', 'Lysychansk'),
+    ('Izium', 'Izium'), ('Izyum', 'Izium'),
+    ('Mariupol', 'Mariupol'), ('Kherson', 'Kherson'), ('Melitopol', 'Melitopol'),
+    ('Kramatorsk', 'Kramatorsk'), ('Bucha', 'Bucha'), ('Irpin', 'Irpin'), ('Sumy', 'Sumy'),
+    ('Belgorod', 'Belgorod'), ('Moscow', 'Moscow'), ('Ukraine', 'Ukraine'), ('Russia', 'Russia'),
+]
+
+# Names that look like the targets - make the sample gazetteer less forgiving
+DISTRACTORS = [
+    'Kyiv Oblast', 'Kharkiv Oblast', 'Odesa Oblast', 'Lviv Oblast', 'Mykolaiv Oblast', 'Luhansk Oblast',
+    'Dnipropetrovsk Oblast', 'Zaporizhzhia Oblast', 'Chernihiv Oblast', 'Kherson Oblast', 'Sumy Oblast',
+    'Kirovohrad', 'Kyivska', 'Kharkivka', 'Odesskoye', 'Lvovo', 'Nikolayevka', 'Dniprorudne', 'Zaporizke',
+    'Chernivtsi', 'Chernobyl', 'Horlivka', 'Energetik', 'Berdychiv', 'Severomorsk', 'Lysyanka', 'Izmail',
+    'Marinka', 'Khersones', 'Melekhovo', 'Kramatorske', 'Buchach', 'Irpinka', 'Sumskoye', 'Belgorodka',
+    'Moscow Oblast', 'Ukrainka', 'Russkaya Polyana', 'Kupiansk', 'Bakhmut', 'Avdiivka', 'Tokmak',
+]
+
+# PROPN tokens of the feeds that are not places - people, organisations, weapons, media
+NON_PLACES = [
+    'Zelensky', 'Zelenskyy', 'Putin', 'Shoigu', 'Gerasimov', 'Lavrov', 'Peskov', 'Kadyrov', 'Prigozhin',
+    'Zaluzhnyi', 'Syrskyi', 'Budanov', 'Reznikov', 'Kuleba', 'Podolyak', 'Arestovych', 'Klitschko',
+    'Medvedev', 'Surovikin', 'Biden', 'Blinken', 'Austin', 'Scholz', 'Macron', 'Erdogan', 'Stoltenberg',
+    'NATO', 'Pentagon', 'Kremlin', 'Wagner', 'Azov', 'Rosgvardia', 'Roscosmos', 'Rosatom', 'Gazprom',
+    'Naftogaz', 'Ukrenergo', 'Energoatom', 'Bayraktar', 'Himars', 'Javelin', 'Stinger', 'Leopard',
+    'Abrams', 'Patriot', 'Iskander', 'Kalibr', 'Kinzhal', 'Shahed', 'Lancet', 'Starlink', 'Telegram',
+    'Reuters', 'Interfax', 'TASS', 'Ukrinform', 'Monday', 'Sunday', 'March', 'August',
+]
+
+
+def sample_names():
+    return sorted({name for _, name in LABELLED_MENTIONS} | set(DISTRACTORS))
+
+
+def db_names():
+    from Data.models import City, State, Country
+
+    names = set()
+    for model in (Country, State, City):
+        names.update(model.objects.values_list('name', flat=True))
+    return sorted(names)
+
+
+def old_match(mention: str, names: list):
+    ''' What `check_token_is_place.loose()` did: `name__icontains` then best `compare_strings` score '''
+    mention_cf = mention.casefold()
+    candidates = [name for name in names if mention_cf in name.casefold()]
+    if not candidates:
+        return None
+    scored = [compare_strings(name, mention) for name in candidates]
+    return sorted(scored, key=lambda o: o['score'], reverse=True)[0]['string1']
+
+
+def synthetic_names(n: int, seed: int = 1):
+    rng = random.Random(seed)
+    return [synthetic_name(rng) for _ in range(n)]
+
+
+def new_match(mention: str, index: TrigramIndex, min_score: float = FUZZY_MIN_SCORE):
+    found = index.search(normalize_place_name(mention), k=1, min_score=min_score)
+    return found[0][1] if found else None
+
+
+def run(matcher, repeats: int):
+    ''' Returns (accuracy, false positive rate, [latency per mention in ms]) '''
+    correct = 0
+    latencies = []
+    for mention, expected in LABELLED_MENTIONS:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            found = matcher(mention)
+            latencies.append((time.perf_counter() - start) * 1000)
+        correct += found == expected
+    false_positives = sum(matcher(token) is not None for token in NON_PLACES)
+    return correct / len(LABELLED_MENTIONS), false_positives / len(NON_PLACES), latencies
+
+
+def report(label: str, accuracy: float, false_positives: float, latencies: list):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f'{label:<18} accuracy: {accuracy:6.1%}   false positives: {false_positives:6.1%}   '
+          f'p50: {statistics.median(latencies):8.3f} ms   p95: {p95:8.3f} ms')
+
+
+def sweep(index: TrigramIndex, thresholds):
+    ''' Accuracy & false positive rate of `TrigramIndex` at each `min_score` '''
+    print('\nmin_score   accuracy   false positives')
+    for min_score in sorted(set(thresholds)):
+        accuracy, false_positives, _ = run(lambda m: new_match(m, index, min_score), 1)
+        marker = '  <- FUZZY_MIN_SCORE' if min_score == FUZZY_MIN_SCORE else ''
+        print(f'{min_score:9.2f}   {accuracy:8.1%}   {false_positives:15.1%}{marker}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--from-db', action='store_true', help='match against every place name in the db')
+    parser.add_argument('--synthetic', type=int, default=0, help='add this many synthetic names')
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    names = db_names() if args.from_db else sample_names()
+    if args.synthetic:
+        names = sorted(set(names) | set(synthetic_names(args.synthetic)))
+    missing = {name for _, name in LABELLED_MENTIONS} - set(names)
+    if missing:
+        print(f'NOT IN GAZETTEER (always a miss): {", ".join(sorted(missing))}')
+
+    start = time.perf_counter()
+    index = TrigramIndex([normalize_place_name(name) for name in names], names)
+    print(f'{len(names)} names - trigram index built in {(time.perf_counter() - start) * 1000:.1f} ms\n')
+
+    report('compare_strings', *run(lambda m: old_match(m, names), args.repeats))
+    report('TrigramIndex', *run(lambda m: new_match(m, index), args.repeats))
+    sweep(index, [0.35, 0.4, 0.45, 0.5, 0.55, 0.6, 0.65, 0.7, FUZZY_MIN_SCORE])
+
+
+if __name__ == '__main__':
+    main()
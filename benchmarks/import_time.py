@@ -0,0 +1,120 @@
+''' Cold start report - per-module import cost of a fresh process (`python -X importtime`).
+
+    python -m benchmarks.import_time                      # manage.py & wsgi.py start
+    python -m benchmarks.import_time --target wsgi --top 30
+    python -m benchmarks.import_time --save main          # -> benchmarks/baselines/import-main-<target>.json
+    python -m benchmarks.import_time --compare main
+'''
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+BASELINE_DIR = Path(__file__).resolve().parent / 'baselines'
+
+# What a fresh process of each kind runs before it can do any work
+TARGETS = {
+    # `manage.py <command>` - settings, app registry & every app's `ready()`
+    'manage': 'import django; django.setup()',
+    # A web worker - the WSGI application, plus the URLconf (views) it loads for its first request
+    'wsgi': 'import RUS_UKR_MAIN.wsgi; from django.urls import get_resolver; get_resolver().url_patterns',
+}
+# Reported on their own line when they are imported at all
+HEAVY_PACKAGES = ('spacy', 'thinc', 'folium', 'branca', 'numpy', 'httpx', 'requests')
+
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def measure(code: str):
+    ''' Runs `code` in a fresh interpreter - returns (wall seconds, [(module, self us, cumulative us, depth)]) '''
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'RUS_UKR_MAIN.settings')
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=BASE_DIR, env=env,
+                            capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode:
+        errors = '\n'.join(line for line in result.stderr.splitlines() if not line.startswith('import time:'))
+        raise SystemExit(f'Import failed:\n{errors[-2000:]}')
+
+    modules = []
+    for line in result.stderr.splitlines():
+        found = IMPORT_LINE.match(line)
+        if found:
+            own, cumulative, indent, name = found.groups()
+            modules.append((name, int(own), int(cumulative), len(indent) // 2))
+    return seconds, modules
+
+
+def summarize(seconds: float, modules: list, top: int):
+    ''' {wall_ms, import_ms, modules, packages: {heavy package: cumulative ms}, top: [(module, cumulative ms)]} '''
+    packages = {}
+    for name, _, cumulative, _ in modules:
+        package = name.split('.')[0]
+        # Top-most import of the package holds the cost of all its submodules
+        if package in HEAVY_PACKAGES and name == package:
+            packages[package] = round(cumulative / 1000, 1)
+
+    first_level = [(name, cumulative) for name, _, cumulative, depth in modules if depth == 0]
+    return {'wall_ms': round(seconds * 1000, 1),
+            'import_ms': round(sum(cumulative for _, cumulative in first_level) / 1000, 1),
+            'modules': len(modules),
+            'packages': packages,
+            'top': [(name, round(cumulative / 1000, 1))
+                    for name, cumulative in sorted(first_level, key=lambda m: -m[1])[:top]]}
+
+
+def print_report(target: str, summary: dict):
+    print(f'\n{target}: {summary["wall_ms"]} ms wall, {summary["import_ms"]} ms importing '
+          f'{summary["modules"]} modules')
+    for package in HEAVY_PACKAGES:
+        print(f'  {package:<12}{summary["packages"].get(package, "not imported")}'
+              f'{" ms" if package in summary["packages"] else ""}')
+    print(f'  {"top-level imports (cumulative)":<40}{"ms":>8}')
+    for name, ms in summary['top']:
+        print(f'  {name:<40}{ms:>8}')
+
+
+def compare(target: str, summary: dict, baseline: dict):
+    print(f'\n{target} vs baseline: wall {summary["wall_ms"] - baseline["wall_ms"]:+.1f} ms, '
+          f'imports {summary["import_ms"] - baseline["import_ms"]:+.1f} ms, '
+          f'modules {summary["modules"] - baseline["modules"]:+d}')
+    for package in HEAVY_PACKAGES:
+        before, after = baseline['packages'].get(package), summary['packages'].get(package)
+        if before != after:
+            print(f'  {package:<12}{before or "not imported"} -> {after or "not imported"}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=list(TARGETS) + ['all'], default='all')
+    parser.add_argument('--top', type=int, default=15, help='slowest top-level imports listed')
+    parser.add_argument('--runs', type=int, default=3, help='the fastest run is reported')
+    parser.add_argument('--save', metavar='NAME', help='save results as baseline NAME')
+    parser.add_argument('--compare', metavar='NAME', help='compare with baseline NAME')
+    args = parser.parse_args()
+
+    for target in TARGETS if args.target == 'all' else [args.target]:
+        # Fastest run - the others paid for a cold disk cache
+        seconds, modules = min((measure(TARGETS[target]) for _ in range(args.runs)), key=lambda r: r[0])
+        summary = summarize(seconds, modules, args.top)
+        print_report(target, summary)
+
+        if args.save:
+            BASELINE_DIR.mkdir(exist_ok=True)
+            path = BASELINE_DIR / f'import-{args.save}-{target}.json'
+            path.write_text(json.dumps(summary, indent=2))
+            print(f'Saved baseline: {path}')
+        if args.compare:
+            path = BASELINE_DIR / f'import-{args.compare}-{target}.json'
+            compare(target, summary, json.loads(path.read_text()))
+
+
+if __name__ == '__main__':
+    main()
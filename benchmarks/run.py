@@ -0,0 +1,272 @@
+''' Times the ingest & map pipeline on a synthetic Telegram export (see `benchmarks/synthetic.py`).
+    Runs against a throw-away test database.
+
+    python -m benchmarks.run --size 10k
+    python -m benchmarks.run --size 100k --stages json_load,telegram_create
+    python -m benchmarks.run --size 10k --save main        # -> benchmarks/baselines/main-10k.json
+    python -m benchmarks.run --size 10k --compare main     # exits 1 on a regression
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'RUS_UKR_MAIN.settings')
+django.setup()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from django.test.utils import override_settings, setup_test_environment  # noqa: E402
+
+from benchmarks.synthetic import SIZES, write_dataset  # noqa: E402
+
+
+STAGES = ['json_load', 'telegram_create', 'spacy_parse', 'check_token_is_place', 'event_persist', 'geo_map']
+BASELINE_DIR = Path(__file__).resolve().parent / 'baselines'
+DATA_DIR = Path(__file__).resolve().parent / 'data'
+# Slower by more than this (throughput down or p95 up) counts as a regression
+REGRESSION_THRESHOLD = 0.20
+
+
+class StageTimer:
+    ''' Collects the latency of every timed call and the number of items it handled '''
+
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.latencies = []
+        self.items = 0
+
+    def record(self, seconds: float, items: int = 1):
+        self.latencies.append(seconds)
+        self.items += items
+
+    @contextmanager
+    def time(self, items: int = 1):
+        start = time.perf_counter()
+        yield
+        self.record(time.perf_counter() - start, items)
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        seconds = sum(latencies)
+        return {'unit': self.unit,
+                'items': self.items,
+                'seconds': round(seconds, 4),
+                'throughput': round(self.items / seconds, 2) if seconds else None,
+                'p50_ms': round(statistics.median(latencies) * 1000, 3) if latencies else None,
+                'p95_ms': round(latencies[max(0, int(len(latencies) * 0.95) - 1)] * 1000, 3) if latencies else None}
+
+
+# ################################## Stages ##################################
+# Each stage takes the shared `state` dict (paths, parsed docs, ...) and returns a `StageTimer`
+
+def stage_json_load(state):
+    from helpers.telegram_export import TelegramExportReader
+
+    timer = StageTimer('json_load', 'message')
+    reader = iter(TelegramExportReader(state['paths']['messages']))
+    while True:
+        start = time.perf_counter()
+        message = next(reader, None)
+        if message is None:
+            return timer
+        timer.record(time.perf_counter() - start)
+
+
+def stage_telegram_create(state):
+    from Data import import_data
+
+    timer = StageTimer('telegram_create', f'batch of {state["batch_size"]}')
+    reader = import_data.TelegramExportReader(state['paths']['messages'])
+    for batch in import_data.chunked(reader, state['batch_size']):
+        with timer.time(len(batch)):
+            import_data.upsert_TelegramMessage_models(batch)
+    return timer
+
+
+def stage_spacy_parse(state):
+    from Data.models import TelegramMessage
+    from helpers.nlp_messages import get_nlp
+
+    # Model load is reported on its own - not per message
+    start = time.perf_counter()
+    get_nlp()
+    print(f'    spaCy pipeline loaded in {time.perf_counter() - start:.2f} s')
+
+    timer = StageTimer('spacy_parse', 'message')
+
+    messages = list(TelegramMessage.objects.order_by('id')[:state['nlp_sample']])
+    nlp = get_nlp()
+    state['parsed'] = []
+    for msg in messages:
+        with timer.time():
+            doc = nlp(msg.text)
+        state['parsed'].append((msg, doc))
+    return timer
+
+
+def stage_check_token_is_place(state):
+    from helpers.gazetteer import get_gazetteer
+    from helpers.nlp_messages import check_token_is_place
+
+    timer = StageTimer('check_token_is_place', 'token')
+    get_gazetteer()
+    for _, doc in state['parsed']:
+        for token in doc:
+            with timer.time():
+                check_token_is_place(token, token.ent_type_ == 'GPE')
+    return timer
+
+
+def stage_event_persist(state):
+    from datetime import datetime
+    from Data.import_data import extract_event_from_doc, persist_MessageEvents
+    from helpers.object_helpers import chunked
+
+    extracted = []
+    for msg, doc in state['parsed']:
+        result = extract_event_from_doc(doc, msg.text)
+        result['original_message_id'] = msg.id
+        result['event_date'] = datetime.isoformat(msg.date)
+        extracted.append(result)
+
+    timer = StageTimer('event_persist', f'batch of {state["batch_size"]}')
+    for batch in chunked(extracted, state['batch_size']):
+        with timer.time(len(batch)):
+            persist_MessageEvents(batch)
+    return timer
+
+
+def stage_geo_map(state):
+    from Data.models import State
+    from maps.render_cache import get_map_cache
+    from maps.views import geo_map
+
+    rng = random.Random(1)
+    state_ids = list(State.objects.values_list('id', flat=True))
+    sample = [rng.choice(state_ids) for _ in range(state['map_sample'])]
+
+    # Square boundary per state - served by the local provider, never the network
+    geometries = {}
+    for s_id, lat, lon in State.objects.filter(id__in=sample).values_list('id', 'latitude', 'longitude'):
+        ring = [[lon - 1, lat - 1], [lon + 1, lat - 1], [lon + 1, lat + 1], [lon - 1, lat + 1], [lon - 1, lat - 1]]
+        geometries[f'state:{s_id}'] = [{'osm_type': 'relation', 'osm_id': s_id, 'display_name': str(s_id),
+                                        'geojson': {'type': 'Polygon', 'coordinates': [ring]}}]
+    geometry_file = DATA_DIR / 'geometries.json'
+    geometry_file.write_text(json.dumps(geometries))
+
+    timer = StageTimer('geo_map', 'render (no cached HTML)')
+    factory = RequestFactory()
+    with override_settings(GEOMETRY_PROVIDER='maps.ExtData.LocalGeometryProvider',
+                           GEOMETRY_LOCAL_FILE=geometry_file):
+        for s_id in sample:
+            get_map_cache().delete_base(f'geo_map-state-{s_id}')
+            request = factory.get(f'/maps/state/{s_id}/')
+            with timer.time():
+                async_to_sync(geo_map)(request, 'state', str(s_id))
+    return timer
+
+
+STAGE_FUNCS = {
+    'json_load': stage_json_load,
+    'telegram_create': stage_telegram_create,
+    'spacy_parse': stage_spacy_parse,
+    'check_token_is_place': stage_check_token_is_place,
+    'event_persist': stage_event_persist,
+    'geo_map': stage_geo_map,
+}
+
+
+# ################################# Reporting #################################
+def print_report(results: dict):
+    print(f'\n{"stage":<22}{"unit":<26}{"items":>10}{"seconds":>10}{"items/s":>12}{"p50 ms":>10}{"p95 ms":>10}')
+    for name, r in results.items():
+        print(f'{name:<22}{r["unit"]:<26}{r["items"]:>10}{r["seconds"]:>10}'
+              f'{r["throughput"] or "-":>12}{r["p50_ms"] or "-":>10}{r["p95_ms"] or "-":>10}')
+
+
+def compare(results: dict, baseline: dict):
+    ''' Prints the change of every stage against `baseline` - returns the regressed stage names '''
+    regressions = []
+    print(f'\n{"stage":<22}{"items/s change":>16}{"p95 change":>14}')
+    for name, r in results.items():
+        base = baseline['stages'].get(name)
+        if not base or not base['throughput'] or not r['throughput']:
+            print(f'{name:<22}{"(no baseline)":>16}')
+            continue
+        throughput_change = r['throughput'] / base['throughput'] - 1
+        p95_change = r['p95_ms'] / base['p95_ms'] - 1 if base['p95_ms'] else 0
+        regressed = throughput_change < -REGRESSION_THRESHOLD or p95_change > REGRESSION_THRESHOLD
+        if regressed:
+            regressions.append(name)
+        print(f'{name:<22}{throughput_change:>+16.1%}{p95_change:>+14.1%}{"   REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default='10k', help=f'messages in the export: {", ".join(SIZES)} or a number')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated, in pipeline order')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--nlp-sample', type=int, default=2000, help='messages parsed by the NLP stages')
+    parser.add_argument('--map-sample', type=int, default=50, help='geo_map renders')
+    parser.add_argument('--save', metavar='NAME', help='save results as baseline NAME')
+    parser.add_argument('--compare', metavar='NAME', help='compare with baseline NAME')
+    args = parser.parse_args()
+
+    n_messages = SIZES.get(args.size.lower()) or int(args.size)
+    stages = [s for s in STAGES if s in args.stages.split(',')]
+
+    print(f'Writing synthetic dataset ({n_messages} messages) to {DATA_DIR}')
+    paths = write_dataset(DATA_DIR, n_messages)
+    state = {'paths': paths, 'batch_size': args.batch_size,
+             'nlp_sample': args.nlp_sample, 'map_sample': args.map_sample}
+
+    setup_test_environment()
+    old_db_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        from Data import import_data
+
+        import_data.DATA_DIR = str(DATA_DIR)
+        print('Importing synthetic gazetteer')
+        import_data.run_gazetteer()
+
+        results = {}
+        for name in stages:
+            print(f'  {name}')
+            results[name] = STAGE_FUNCS[name](state).summary()
+    finally:
+        connection.creation.destroy_test_db(old_db_name, verbosity=0)
+
+    print_report(results)
+
+    run = {'size': n_messages,
+           'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(),
+           'machine': platform.machine(),
+           'stages': results}
+
+    if args.save:
+        BASELINE_DIR.mkdir(exist_ok=True)
+        path = BASELINE_DIR / f'{args.save}-{args.size.lower()}.json'
+        path.write_text(json.dumps(run, indent=2))
+        print(f'\nSaved baseline: {path}')
+
+    if args.compare:
+        path = BASELINE_DIR / f'{args.compare}-{args.size.lower()}.json'
+        regressions = compare(results, json.loads(path.read_text()))
+        if regressions:
+            raise SystemExit(f'\nREGRESSIONS: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+    main()
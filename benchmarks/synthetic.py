@@ -0,0 +1,128 @@
+''' Synthetic gazetteer and Telegram channel exports for the benchmarks.
+
+    python -m benchmarks.synthetic --messages 100000 --out benchmarks/data
+'''
+import argparse
+import json
+import random
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+
+# Real places (and how channels spell them) so mentions look like the real feeds
+REAL_CITIES = {
+    'Kyiv': ['Kyiv', 'Kiev'], 'Kharkiv': ['Kharkiv', 'Kharkov'], 'Odesa': ['Odesa', 'Odessa'],
+    'Lviv': ['Lviv', 'Lvov'], 'Mykolaiv': ['Mykolaiv', 'Nikolaev'], 'Luhansk': ['Luhansk', 'Lugansk'],
+    'Dnipro': ['Dnipro', 'Dnepr'], 'Zaporizhia': ['Zaporizhia', 'Zaporozhye'], 'Mariupol': ['Mariupol'],
+    'Kherson': ['Kherson'], 'Chernihiv': ['Chernihiv', 'Chernigov'], 'Sumy': ['Sumy'], 'Irpin': ['Irpin'],
+    'Bucha': ['Bucha'], 'Hostomel': ['Hostomel', 'Gostomel'], 'Melitopol': ['Melitopol'],
+    'Kramatorsk': ['Kramatorsk'], 'Izium': ['Izium', 'Izyum'], 'Bakhmut': ['Bakhmut'],
+    'Belgorod': ['Belgorod'], 'Moscow': ['Moscow'],
+}
+SYLLABLES = ['ka', 'ly', 'ro', 'vo', 'mi', 'ne', 'za', 'po', 'che', 'ri', 'hiv', 'sk', 'dan', 'tel', 'bor', 'yev']
+
+SUBJECTS = ['Russian troops', 'Ukrainian forces', 'The army', 'Artillery', 'Officials', 'The mayor', 'Drones']
+VERBS = ['shelled', 'attacked', 'entered', 'left', 'hit', 'evacuated', 'visited', 'reported explosions in']
+OBJECTS = ['the outskirts', 'a bridge', 'the railway station', 'residential areas', 'the airport', 'a depot']
+
+
+def synthetic_name(rng: random.Random):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+
+
+def build_gazetteer(n_cities: int = 20_000, n_states: int = 200, seed: int = 1):
+    ''' Returns (countries, states, cities) lists in the countries-states-cities json format '''
+    rng = random.Random(seed)
+    countries = []
+    for c_id, (name, iso3, lat, lon) in enumerate([('Ukraine', 'UKR', 49.0, 32.0),
+                                                     ('Russia', 'RUS', 60.0, 100.0),
+                                                     ('Belarus', 'BLR', 53.0, 28.0)], start=1):
+        countries.append({'id': c_id, 'name': name, 'iso3': iso3, 'iso2': iso3[:2], 'numeric_code': c_id,
+                          'phone_code': '', 'capital': '', 'currency': '', 'currency_name': '',
+                          'currency_symbol': '', 'tld': '', 'native': name, 'region': 'Europe',
+                          'subregion': 'Eastern Europe', 'latitude': lat, 'longitude': lon,
+                          'emoji': '', 'emojiU': ''})
+
+    states = []
+    for s_id in range(1, n_states + 1):
+        country = countries[s_id % len(countries)]
+        states.append({'id': s_id, 'name': f'{synthetic_name(rng)} Oblast', 'state_code': str(s_id),
+                       'type': 'oblast', 'country_id': country['id'],
+                       'latitude': country['latitude'] + rng.uniform(-4, 4),
+                       'longitude': country['longitude'] + rng.uniform(-8, 8)})
+
+    names = list(REAL_CITIES) + [synthetic_name(rng) for _ in range(max(0, n_cities - len(REAL_CITIES)))]
+    cities = []
+    for ci_id, name in enumerate(names, start=1):
+        state = states[rng.randrange(len(states))]
+        cities.append({'id': ci_id, 'name': name, 'state_id': state['id'], 'country_id': state['country_id'],
+                       'latitude': state['latitude'] + rng.uniform(-1, 1),
+                       'longitude': state['longitude'] + rng.uniform(-1.5, 1.5), 'wikiDataId': ''})
+    return countries, states, cities
+
+
+def message_text(rng: random.Random, city_names: list):
+    ''' A short report - most mention a real place (in any spelling), some a synthetic one '''
+    if rng.random() < 0.7:
+        place = rng.choice(rng.choice(list(REAL_CITIES.values())))
+    else:
+        place = rng.choice(city_names)
+    sentence = f'{rng.choice(SUBJECTS)} {rng.choice(VERBS)} {rng.choice(OBJECTS)} near {place}.'
+    if rng.random() < 0.3:
+        sentence += f' Sirens were heard in {rng.choice(city_names)}.'
+    return sentence
+
+
+def write_export(path, n_messages: int, city_names: list, seed: int = 1):
+    ''' Streams a Telegram channel export with `n_messages` messages to `path` '''
+    rng = random.Random(seed)
+    start = datetime(2022, 2, 24)
+    with open(path, 'w', encoding='utf-8') as wf:
+        wf.write('{\n "name": "Synthetic channel",\n "type": "public_channel",\n "id": 1000000001,\n "messages": [\n')
+        for m_id in range(1, n_messages + 1):
+            date = start + timedelta(seconds=m_id * 37)
+            message = {'id': m_id, 'type': 'message', 'date': date.isoformat(),
+                       'from': 'Synthetic channel', 'from_id': 'channel1000000001',
+                       'text': message_text(rng, city_names)}
+            if rng.random() < 0.05:
+                message['edited'] = (date + timedelta(minutes=5)).isoformat()
+            if rng.random() < 0.1:
+                message['forwarded_from'] = 'Other channel'
+            wf.write(('' if m_id == 1 else ',\n') + '  ' + json.dumps(message, ensure_ascii=False))
+        wf.write('\n ]\n}\n')
+
+
+def write_dataset(out_dir, n_messages: int, n_cities: int = 20_000, seed: int = 1):
+    ''' Writes countries/states/cities/messages json files to `out_dir` - returns the paths '''
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    countries, states, cities = build_gazetteer(n_cities, seed=seed)
+
+    paths = {}
+    for name, rows in (('countries', countries), ('states', states), ('cities', cities)):
+        paths[name] = out_dir / f'{name}.json'
+        with open(paths[name], 'w', encoding='utf-8') as wf:
+            json.dump(rows, wf, ensure_ascii=False)
+
+    paths['messages'] = out_dir / f'messages-{n_messages}.json'
+    if not paths['messages'].exists():
+        write_export(paths['messages'], n_messages, [c['name'] for c in cities], seed)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', default='10k', help=f'{", ".join(SIZES)} or a number')
+    parser.add_argument('--cities', type=int, default=20_000)
+    parser.add_argument('--out', default='benchmarks/data')
+    args = parser.parse_args()
+
+    n_messages = SIZES.get(args.messages.lower()) or int(args.messages)
+    for name, path in write_dataset(args.out, n_messages, args.cities).items():
+        print(f'{name:<10} {path}')
+
+
+if __name__ == '__main__':
+    main()
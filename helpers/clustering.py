@@ -0,0 +1,108 @@
+from math import floor, log, pi, radians, tan, cos
+
+
+TILE_SIZE = 256
+# Points closer than this many screen pixels at a zoom are merged into one cluster
+CLUSTER_RADIUS_PX = 60
+# Above this zoom every point is returned on its own
+CLUSTER_MAX_ZOOM = 14
+# Assumed map size in pixels when only a center & zoom are known (server rendered maps)
+VIEW_SIZE_PX = (1280, 800)
+
+
+def mercator_px(lat: float, lon: float, zoom: int):
+    ''' Web Mercator pixel coordinates (x, y) of a coordinate at `zoom` '''
+    scale = TILE_SIZE * 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = (lon + 180) / 360 * scale
+    y = (1 - log(tan(radians(lat)) + 1 / cos(radians(lat))) / pi) / 2 * scale
+    return x, y
+
+
+class ClusterIndex:
+    ''' Hierarchical grid clustering of points for zooms 0..`max_zoom`.
+        Built once per dataset - every zoom level buckets the points into cells of
+        `radius_px` screen pixels, keeping a count and coordinate sums per cell.
+        `points` are `(latitude, longitude, id)` tuples.
+    '''
+
+    def __init__(self, points, max_zoom: int = CLUSTER_MAX_ZOOM, radius_px: int = CLUSTER_RADIUS_PX):
+        self.max_zoom = max_zoom
+        self.radius_px = radius_px
+        self.points = [p for p in points if p[0] is not None and p[1] is not None]
+        # zoom -> {(cell x, cell y): [count, sum lat, sum lon, id of the first point]}
+        self.levels = {}
+
+        # Projected once - a cell at any zoom is just the zoom 0 pixel scaled by 2 ** zoom
+        projected = [(mercator_px(lat, lon, 0), lat, lon, p_id) for lat, lon, p_id in self.points]
+
+        for zoom in range(max_zoom + 1):
+            scale = 2 ** zoom / radius_px
+            cells = {}
+            for (x, y), lat, lon, p_id in projected:
+                cell = (int(x * scale), int(y * scale))
+                found = cells.get(cell)
+                if found is None:
+                    cells[cell] = [1, lat, lon, p_id]
+                else:
+                    found[0] += 1
+                    found[1] += lat
+                    found[2] += lon
+            self.levels[zoom] = cells
+
+    def _cell(self, lat: float, lon: float, zoom: int):
+        x, y = mercator_px(lat, lon, zoom)
+        return int(floor(x / self.radius_px)), int(floor(y / self.radius_px))
+
+    def _cells_in_bbox(self, zoom: int, bbox):
+        ''' Cells at `zoom` that can hold clusters inside `bbox` - every cell when that is cheaper '''
+        cells = self.levels[zoom]
+        if not bbox:
+            return cells.values()
+        west, south, east, north = bbox
+        (x_min, y_min), (x_max, y_max) = self._cell(north, west, zoom), self._cell(south, east, zoom)
+        if west > east or (x_max - x_min + 1) * (y_max - y_min + 1) > len(cells):
+            return cells.values()
+        # Centroids can sit in a neighbouring cell of the points' cell - search one cell wider
+        return [cells[(x, y)] for x in range(x_min - 1, x_max + 2) for y in range(y_min - 1, y_max + 2)
+                if (x, y) in cells]
+
+    def clusters(self, zoom: int, bbox=None):
+        ''' Clusters at `zoom` inside `bbox` (west, south, east, north) as dicts:
+                {latitude, longitude, count, id}  - `id` is only set for single points.
+            Above `max_zoom` every point is returned on its own.
+        '''
+        zoom = max(0, int(zoom))
+        if zoom > self.max_zoom:
+            return [{'latitude': lat, 'longitude': lon, 'count': 1, 'id': p_id}
+                    for lat, lon, p_id in self.points if in_bbox(lat, lon, bbox)]
+
+        found = []
+        for count, sum_lat, sum_lon, p_id in self._cells_in_bbox(zoom, bbox):
+            lat, lon = sum_lat / count, sum_lon / count
+            if in_bbox(lat, lon, bbox):
+                found.append({'latitude': lat, 'longitude': lon, 'count': count,
+                              'id': p_id if count == 1 else None})
+        return found
+
+
+def in_bbox(lat: float, lon: float, bbox):
+    if not bbox:
+        return True
+    west, south, east, north = bbox
+    lon_inside = west <= lon <= east if west <= east else (lon >= west or lon <= east)
+    return south <= lat <= north and lon_inside
+
+
+def view_bbox(lat: float, lon: float, zoom: int, size_px=VIEW_SIZE_PX):
+    ''' Approximate (west, south, east, north) visible on a `size_px` map centered on lat/lon '''
+    deg_per_px = 360 / (TILE_SIZE * 2 ** zoom)
+    half_lon = min(180.0, size_px[0] / 2 * deg_per_px)
+    half_lat = min(90.0, size_px[1] / 2 * deg_per_px * cos(radians(max(min(lat, 85.0), -85.0))))
+    if half_lon >= 180.0:
+        return -180.0, max(-90.0, lat - half_lat), 180.0, min(90.0, lat + half_lat)
+    west, east = lon - half_lon, lon + half_lon
+    # Wrap across the antimeridian - `in_bbox` handles west > east
+    west = west + 360 if west < -180 else west
+    east = east - 360 if east > 180 else east
+    return west, max(-90.0, lat - half_lat), east, min(90.0, lat + half_lat)
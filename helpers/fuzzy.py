@@ -0,0 +1,82 @@
+import re
+
+import numpy as np
+
+
+VOWEL_RUNS = re.compile(r'[aeiouy]+')
+DOUBLE_LETTERS = re.compile(r'(.)\1+')
+
+
+def transliteration_skeleton(name: str):
+    ''' Folds spellings that differ only by transliteration to one "skeleton":
+        vowel runs -> '*', doubled letters -> single ("kiev"/"kyiv" -> "k*v", "odessa"/"odesa" -> "*d*s*")
+    '''
+    return DOUBLE_LETTERS.sub(r'\1', VOWEL_RUNS.sub('*', name))
+
+
+def trigrams(text: str):
+    ''' Set of character trigrams of `text`, padded so the start and end of words count more '''
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    ''' Fuzzy matcher over a list of (already normalized) names.
+        Precomputes an inverted index of character trigram -> name positions, for the names and
+        for their transliteration skeletons. A query scores every name sharing a trigram at once
+        (numpy) by trigram Jaccard similarity, averaged over both forms.
+    '''
+
+    def __init__(self, names: list, values: list = None):
+        self.names = list(names)
+        self.values = list(values) if values is not None else self.names
+        self.plain = self._build([trigrams(name) for name in self.names])
+        self.skeleton = self._build([trigrams(transliteration_skeleton(name)) for name in self.names])
+
+    @classmethod
+    def from_postings(cls, names, values, plain, skeleton):
+        ''' Index over prebuilt `(postings, sizes)` pairs (see `_build`) - ie: memory-mapped
+            by `helpers.gazetteer_file`. `postings` only needs a `.get(trigram)`.
+        '''
+        index = cls.__new__(cls)
+        index.names = names
+        index.values = values
+        index.plain = plain
+        index.skeleton = skeleton
+        return index
+
+    @staticmethod
+    def _build(grams_per_name: list):
+        postings = {}
+        for i, grams in enumerate(grams_per_name):
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+        sizes = np.array([len(grams) for grams in grams_per_name], dtype=np.float32)
+        return postings, sizes
+
+    @staticmethod
+    def _scores(index, query_grams: set, n_names: int):
+        ''' Jaccard similarity of `query_grams` with every name (0 for names sharing no trigram) '''
+        postings, sizes = index
+        shared = np.zeros(n_names, dtype=np.float32)
+        for gram in query_grams:
+            ids = postings.get(gram)
+            if ids is not None:
+                shared[ids] += 1
+        return shared / (sizes + len(query_grams) - shared)
+
+    def search(self, text: str, k: int = 5, min_score: float = 0.0):
+        ''' Returns up to `k` `(name, value, score)` best matches for `text`, best first.
+            `score` is between 0 (nothing in common) and 1 (same name).
+        '''
+        if not self.names or not text:
+            return []
+        n_names = len(self.names)
+        scores = (self._scores(self.plain, trigrams(text), n_names)
+                  + self._scores(self.skeleton, trigrams(transliteration_skeleton(text)), n_names)) / 2
+
+        k = min(k, n_names)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(self.names[i], self.values[i], float(scores[i])) for i in top if scores[i] > min_score]
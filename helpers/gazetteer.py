@@ -0,0 +1,182 @@
+from bisect import bisect_left
+import os
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from Data.models import City, State, Country
+from helpers.object_helpers import normalize_place_name
+
+
+# Common transliteration variants -> name used in the gazetteer (both normalized)
+PLACE_ALIASES = {
+    'kiev': 'kyiv',
+    'kharkov': 'kharkiv',
+    'odessa': 'odesa',
+    'nikolaev': 'mykolaiv',
+    'nikolayev': 'mykolaiv',
+    'zaporozhye': 'zaporizhia',
+    'zaporizhzhia': 'zaporizhia',
+    'dnepr': 'dnipro',
+    'dnipropetrovsk': 'dnipro',
+    'lugansk': 'luhansk',
+    'lvov': 'lviv',
+    'chernigov': 'chernihiv',
+    'chernobyl': 'chornobyl',
+    'rovno': 'rivne',
+    'zhitomir': 'zhytomyr',
+}
+
+# Trailing words dropped from State names to get an alternate name ("Kyiv Oblast" -> "kyiv")
+STATE_SUFFIXES = ('oblast', 'region', 'province', 'krai', 'raion')
+
+# Stripped from the ends of word runs by `place_mentions` ("Kharkiv," -> "kharkiv")
+PUNCTUATION = '.,;:!?()[]"\'«»“”-–—'
+
+# Lowest trigram similarity (0-1) accepted as a fuzzy place match - every PROPN token is looked up,
+# so lower values match people & organisations to some place (`python -m benchmarks.fuzzy_match`)
+FUZZY_MIN_SCORE = 0.55
+
+# Process-wide index - built on first use by `get_gazetteer()`
+_GAZETTEER = None
+# (inode, mtime, size) of the mapped gazetteer file, and when it was last compared
+_GAZETTEER_FILE_ID = None
+_GAZETTEER_CHECKED = 0.0
+FILE_CHECK_SECONDS = 1.0
+
+
+def lookup_key(text: str):
+    ''' Normalized name `text` is looked up by - with transliteration aliases applied '''
+    key = normalize_place_name(text)
+    return PLACE_ALIASES.get(key, key)
+
+
+class GazetteerIndex:
+    ''' In-memory name index over City, State, and Country rows.
+        Maps a normalized name (or alternate name) to a list of `(model, id)` tuples
+        ordered Country -> State -> City (smallest -> largest table).
+    '''
+
+    def __init__(self):
+        self.names = {}
+        self._sorted_keys = None
+        self._trigrams = None
+
+    def add(self, name: str, model, place_id: int):
+        key = normalize_place_name(name)
+        if not key:
+            return
+        entries = self.names.setdefault(key, [])
+        if (model, place_id) not in entries:
+            entries.append((model, place_id))
+        self._sorted_keys = None
+        self._trigrams = None
+
+    def exact(self, text: str):
+        ''' Returns the `(model, id)` tuples whose name matches `text` exactly (normalized) '''
+        return self.names.get(lookup_key(text), [])
+
+    def prefix(self, text: str, limit: int = 100):
+        ''' Returns up to `limit` `(name, (model, id))` pairs whose name starts with `text`.
+            Shorter (closer) names sort first.
+        '''
+        key = lookup_key(text)
+        if not key:
+            return []
+
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self.names)
+        keys = self._sorted_keys
+
+        found = []
+        i = bisect_left(keys, key)
+        while i < len(keys) and keys[i].startswith(key) and len(found) < limit:
+            found.extend((keys[i], entry) for entry in self.names[keys[i]])
+            i += 1
+        return found[:limit]
+
+    def fuzzy(self, text: str, k: int = 5, min_score: float = FUZZY_MIN_SCORE):
+        ''' Returns up to `k` `(name, (model, id), score)` closest names to `text` by trigram
+            similarity (see `helpers.fuzzy.TrigramIndex`), best first.
+        '''
+        key = lookup_key(text)
+
+        if self._trigrams is None:
+            from helpers.fuzzy import TrigramIndex  # numpy - only loaded once a fuzzy lookup is made
+
+            self._trigrams = TrigramIndex(list(self.names))
+        return [(name, self.names[name][0], score)
+                for name, _, score in self._trigrams.search(key, k=k, min_score=min_score)]
+
+    @classmethod
+    def from_db(cls):
+        ''' Builds the index with one query per table '''
+        index = cls()
+
+        for c_id, name, native, iso3 in Country.objects.values_list('id', 'name', 'native', 'iso3'):
+            index.add(name, Country, c_id)
+            index.add(native, Country, c_id)
+            index.add(iso3, Country, c_id)
+
+        for s_id, name in State.objects.values_list('id', 'name'):
+            index.add(name, State, s_id)
+            words = name.split()
+            if len(words) > 1 and words[-1].casefold() in STATE_SUFFIXES:
+                index.add(' '.join(words[:-1]), State, s_id)
+
+        for c_id, name in City.objects.values_list('id', 'name'):
+            index.add(name, City, c_id)
+
+        return index
+
+
+def place_mentions(text: str, max_words: int = 3):
+    ''' Set of the gazetteer names (normalized) found in `text` - every run of up to `max_words` words '''
+    words = normalize_place_name(text).split()
+    gazetteer = get_gazetteer()
+    found = set()
+    for n in range(1, max_words + 1):
+        for i in range(len(words) - n + 1):
+            key = lookup_key(' '.join(words[i:i + n]).strip(PUNCTUATION))
+            if key and gazetteer.exact(key):
+                found.add(key)
+    return found
+
+
+def get_gazetteer():
+    ''' Returns the shared gazetteer, loading it on first use - a `GazetteerIndex` built from the db,
+        or with `settings.GAZETTEER_SOURCE = 'file'` the memory-mapped `settings.GAZETTEER_FILE`
+        (see `helpers.gazetteer_file`). A mapped file is mapped again once it was replaced - ie: by
+        `build_gazetteer_file` in another process - checked at most every `FILE_CHECK_SECONDS`.
+    '''
+    global _GAZETTEER, _GAZETTEER_FILE_ID, _GAZETTEER_CHECKED
+
+    if settings.GAZETTEER_SOURCE == 'file':
+        now = time.monotonic()
+        if _GAZETTEER is None or now - _GAZETTEER_CHECKED >= FILE_CHECK_SECONDS:
+            _GAZETTEER_CHECKED = now
+            stat = os.stat(settings.GAZETTEER_FILE)
+            # Replaced atomically (`os.replace`) - a new inode, or at least a new mtime
+            file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if _GAZETTEER is None or file_id != _GAZETTEER_FILE_ID:
+                from helpers.gazetteer_file import MappedGazetteer
+
+                _GAZETTEER, _GAZETTEER_FILE_ID = MappedGazetteer(settings.GAZETTEER_FILE), file_id
+    elif _GAZETTEER is None:
+        _GAZETTEER = GazetteerIndex.from_db()
+    return _GAZETTEER
+
+
+def invalidate_gazetteer():
+    ''' Drops the shared index - it will be rebuilt on next `get_gazetteer()` '''
+    global _GAZETTEER
+    _GAZETTEER = None
+
+
+@receiver([post_save, post_delete], sender=City)
+@receiver([post_save, post_delete], sender=State)
+@receiver([post_save, post_delete], sender=Country)
+def _place_changed(sender, **kwargs):
+    invalidate_gazetteer()
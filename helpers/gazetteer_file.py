@@ -0,0 +1,251 @@
+''' Compact, memory-mapped gazetteer file.
+
+    One file of aligned numpy columns: place ids, coordinates, and parent ids per table,
+    the lookup names as a packed string table with their `(model, id)` entries, and the
+    trigram postings of the fuzzy matcher. Processes map it read-only - the OS keeps one
+    copy in memory for all of them and loading takes milliseconds.
+
+    python manage.py build_gazetteer_file
+'''
+from bisect import bisect_left
+import json
+import os
+
+import numpy as np
+
+from Data.models import City, State, Country
+from helpers.fuzzy import TrigramIndex
+from helpers.gazetteer import GazetteerIndex, FUZZY_MIN_SCORE, lookup_key
+
+
+MAGIC = b'GAZETTE1'
+ALIGN = 64
+
+# Entry type code -> model (the order of `GazetteerIndex` entries)
+PLACE_MODELS = (Country, State, City)
+
+# Model -> parent id columns stored with its places
+PARENT_FIELDS = {Country: (), State: ('country_id',), City: ('state_id', 'country_id')}
+
+
+class PackedStrings:
+    ''' Read-only sequence of strings stored as one utf-8 byte array + offsets.
+        Supports `len()`, indexing, and `bisect` (when packed sorted).
+    '''
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    @staticmethod
+    def pack(strings):
+        ''' (uint8 data, int64 offsets) arrays of `strings` '''
+        encoded = [s.encode('utf-8') for s in strings]
+        return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets_of([len(b) for b in encoded])
+
+
+class PackedPostings:
+    ''' trigram -> name positions, `dict.get`-like, over sorted trigram codes (see `trigram_code`) '''
+
+    def __init__(self, codes, offsets, ids):
+        self.codes = codes
+        self.offsets = offsets
+        self.ids = ids
+
+    def get(self, gram: str):
+        code = trigram_code(gram)
+        i = int(np.searchsorted(self.codes, code))
+        if i < len(self.codes) and self.codes[i] == code:
+            return self.ids[self.offsets[i]:self.offsets[i + 1]]
+        return None
+
+    @staticmethod
+    def pack(postings: dict):
+        ''' (codes, ids offsets, ids) arrays of a {trigram: ids array} dict '''
+        grams = sorted(postings, key=trigram_code)
+        codes = np.array([trigram_code(g) for g in grams], dtype=np.int64)
+        offsets = offsets_of([len(postings[g]) for g in grams])
+        ids = np.concatenate([postings[g] for g in grams]) if grams else np.zeros(0, dtype=np.int32)
+        return codes, offsets, ids.astype(np.int32)
+
+
+def trigram_code(gram: str):
+    ''' A 3 character trigram as one int - 21 bits per code point '''
+    c0, c1, c2 = (ord(c) for c in gram)
+    return c0 << 42 | c1 << 21 | c2
+
+
+def offsets_of(lengths: list):
+    ''' Start offsets of consecutive items of `lengths` (+ the end) - int64 array '''
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.array(lengths, dtype=np.int64))
+    return offsets
+
+
+# ################################ File format ################################
+def _aligned(n: int):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def save_arrays(path, arrays: dict):
+    ''' Writes named arrays to one file (replaced atomically - mapped readers keep the old copy) '''
+    header, offset = {}, 0
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    for name, a in arrays.items():
+        header[name] = {'dtype': a.dtype.str, 'shape': a.shape, 'offset': offset}
+        offset = _aligned(offset + a.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header_bytes))
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as wf:
+        wf.write(MAGIC + len(header_bytes).to_bytes(8, 'little') + header_bytes)
+        for name, a in arrays.items():
+            wf.seek(data_start + header[name]['offset'])
+            wf.write(a.tobytes())
+        wf.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_arrays(path):
+    ''' {name: read-only array} views into the memory-mapped file of `save_arrays` '''
+    mapped = np.memmap(path, dtype=np.uint8, mode='r')
+    if mapped[:len(MAGIC)].tobytes() != MAGIC:
+        raise ValueError(f'Not a gazetteer file: {path}')
+    header_size = int.from_bytes(mapped[len(MAGIC):len(MAGIC) + 8].tobytes(), 'little')
+    header_start = len(MAGIC) + 8
+    header = json.loads(mapped[header_start:header_start + header_size].tobytes())
+    data_start = _aligned(header_start + header_size)
+
+    arrays = {}
+    for name, info in header.items():
+        dtype = np.dtype(info['dtype'])
+        start = data_start + info['offset']
+        size = int(np.prod(info['shape'])) * dtype.itemsize
+        arrays[name] = mapped[start:start + size].view(dtype).reshape(info['shape'])
+    return arrays
+
+
+# ################################## Build ##################################
+def place_columns(model):
+    ''' {column: array} of every `model` row - id, latitude, longitude, parent ids & packed names '''
+    fields = ('id', 'name', 'latitude', 'longitude') + PARENT_FIELDS[model]
+    rows = list(model.objects.order_by('id').values_list(*fields))
+    columns = dict(zip(fields, zip(*rows))) if rows else {field: () for field in fields}
+
+    prefix = model._meta.model_name
+    arrays = {
+        f'{prefix}.id': np.array(columns['id'], dtype=np.int32),
+        # Unknown coordinates are NaN, unknown parents -1
+        f'{prefix}.latitude': np.array(columns['latitude'], dtype=np.float64).astype(np.float32),
+        f'{prefix}.longitude': np.array(columns['longitude'], dtype=np.float64).astype(np.float32),
+    }
+    for field in PARENT_FIELDS[model]:
+        arrays[f'{prefix}.{field}'] = np.array([v if v is not None else -1 for v in columns[field]], dtype=np.int32)
+    arrays[f'{prefix}.name_data'], arrays[f'{prefix}.name_offsets'] = PackedStrings.pack(columns['name'])
+    return arrays
+
+
+def write_gazetteer_file(path, index: GazetteerIndex = None):
+    ''' Compiles City/State/Country (and the lookup names of `index`, default built from the db)
+        into a gazetteer file at `path`. Returns the file size in bytes.
+    '''
+    index = index or GazetteerIndex.from_db()
+    arrays = {}
+    for model in PLACE_MODELS:
+        arrays.update(place_columns(model))
+
+    keys = sorted(index.names)
+    arrays['key_data'], arrays['key_offsets'] = PackedStrings.pack(keys)
+
+    entries = [index.names[key] for key in keys]
+    arrays['entry_offsets'] = offsets_of([len(e) for e in entries])
+    arrays['entry_type'] = np.array([PLACE_MODELS.index(model) for e in entries for model, _ in e], dtype=np.uint8)
+    arrays['entry_id'] = np.array([place_id for e in entries for _, place_id in e], dtype=np.int32)
+
+    trigrams = TrigramIndex(keys)
+    for form in ('plain', 'skeleton'):
+        postings, sizes = getattr(trigrams, form)
+        arrays[f'{form}.codes'], arrays[f'{form}.offsets'], arrays[f'{form}.ids'] = PackedPostings.pack(postings)
+        arrays[f'{form}.sizes'] = sizes
+
+    save_arrays(path, arrays)
+    return os.path.getsize(path)
+
+
+# ################################## Read ##################################
+class MappedGazetteer:
+    ''' `GazetteerIndex` lookups (`exact`, `prefix`, `fuzzy`) over a memory-mapped gazetteer file,
+        plus the stored columns of a place with `place()`. Nothing is copied into the process.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.arrays = arrays = load_arrays(path)
+        self.keys = PackedStrings(arrays['key_data'], arrays['key_offsets'])
+
+        forms = []
+        for form in ('plain', 'skeleton'):
+            postings = PackedPostings(arrays[f'{form}.codes'], arrays[f'{form}.offsets'], arrays[f'{form}.ids'])
+            forms.append((postings, arrays[f'{form}.sizes']))
+        # Values are key positions - entries are only decoded for the matches
+        self._trigrams = TrigramIndex.from_postings(self.keys, range(len(self.keys)), *forms)
+
+    def entries(self, i: int):
+        ''' `(model, id)` tuples of key number `i` '''
+        start, end = self.arrays['entry_offsets'][i:i + 2]
+        return [(PLACE_MODELS[t], int(place_id))
+                for t, place_id in zip(self.arrays['entry_type'][start:end], self.arrays['entry_id'][start:end])]
+
+    def exact(self, text: str):
+        ''' Returns the `(model, id)` tuples whose name matches `text` exactly (normalized) '''
+        key = lookup_key(text)
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.entries(i)
+        return []
+
+    def prefix(self, text: str, limit: int = 100):
+        ''' Returns up to `limit` `(name, (model, id))` pairs whose name starts with `text` '''
+        key = lookup_key(text)
+        if not key:
+            return []
+
+        found = []
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and len(found) < limit:
+            name = self.keys[i]
+            if not name.startswith(key):
+                break
+            found.extend((name, entry) for entry in self.entries(i))
+            i += 1
+        return found[:limit]
+
+    def fuzzy(self, text: str, k: int = 5, min_score: float = FUZZY_MIN_SCORE):
+        ''' Returns up to `k` `(name, (model, id), score)` closest names to `text`, best first '''
+        return [(name, self.entries(i)[0], score)
+                for name, i, score in self._trigrams.search(lookup_key(text), k=k, min_score=min_score)]
+
+    def place(self, model, place_id: int):
+        ''' {id, name, latitude, longitude, <parent>_id...} of one place - or None '''
+        prefix = model._meta.model_name
+        ids = self.arrays[f'{prefix}.id']
+        i = int(np.searchsorted(ids, place_id))
+        if i == len(ids) or ids[i] != place_id:
+            return None
+
+        names = PackedStrings(self.arrays[f'{prefix}.name_data'], self.arrays[f'{prefix}.name_offsets'])
+        place = {'id': place_id, 'name': names[i]}
+        for field in ('latitude', 'longitude'):
+            value = float(self.arrays[f'{prefix}.{field}'][i])
+            place[field] = None if np.isnan(value) else value
+        for field in PARENT_FIELDS[model]:
+            parent_id = int(self.arrays[f'{prefix}.{field}'][i])
+            place[field] = parent_id if parent_id >= 0 else None
+        return place
@@ -0,0 +1,120 @@
+# Simplification levels for boundary GeoJSON, smallest payload first:
+#   (name, highest map zoom it is used for, Douglas-Peucker tolerance in degrees, decimal places kept)
+GEOMETRY_LEVELS = [
+    ('z4', 4, 0.05, 2),
+    ('z7', 7, 0.01, 3),
+    ('z10', 10, 0.002, 4),
+    ('z13', 13, 0.0005, 5),
+]
+
+
+def level_for_zoom(zoom: int):
+    ''' Returns the name of the simplification level for map `zoom` - or None for full resolution '''
+    for name, max_zoom, _, _ in GEOMETRY_LEVELS:
+        if zoom <= max_zoom:
+            return name
+    return None
+
+
+def build_simplified_levels(geojson: dict):
+    ''' Returns {level name: simplified geojson} for every level in `GEOMETRY_LEVELS` '''
+    if not geojson:
+        return {}
+    return {name: simplify_geojson(geojson, tolerance, precision)
+            for name, _, tolerance, precision in GEOMETRY_LEVELS}
+
+
+def simplify_geojson(geojson: dict, tolerance: float, precision: int):
+    ''' Douglas-Peucker simplified copy of a GeoJSON geometry with coordinates
+        rounded to `precision` decimal places. Rings that collapse are dropped.
+    '''
+    g_type = geojson['type']
+
+    if g_type == 'GeometryCollection':
+        return {'type': g_type,
+                'geometries': [simplify_geojson(g, tolerance, precision) for g in geojson['geometries']]}
+
+    coords = geojson['coordinates']
+    if g_type == 'Point':
+        simplified = round_point(coords, precision)
+    elif g_type == 'MultiPoint':
+        simplified = [round_point(p, precision) for p in coords]
+    elif g_type == 'LineString':
+        simplified = simplify_line(coords, tolerance, precision)
+    elif g_type == 'MultiLineString':
+        simplified = [simplify_line(line, tolerance, precision) for line in coords]
+    elif g_type == 'Polygon':
+        simplified = simplify_polygon(coords, tolerance, precision)
+    elif g_type == 'MultiPolygon':
+        simplified = [poly for poly in (simplify_polygon(p, tolerance, precision) for p in coords) if poly]
+        # Keep at least the largest polygon so the place is still drawn
+        if not simplified and coords:
+            largest = max(coords, key=lambda p: len(p[0]))
+            simplified = [[[round_point(pt, precision) for pt in largest[0]]]]
+    else:
+        return geojson
+
+    return {'type': g_type, 'coordinates': simplified}
+
+
+def simplify_polygon(rings: list, tolerance: float, precision: int):
+    ''' Simplifies each ring of a polygon - returns [] if the outer ring collapses '''
+    simplified = []
+    for i, ring in enumerate(rings):
+        new_ring = simplify_line(ring, tolerance, precision)
+        if len(new_ring) < 4:  # Not a closed ring anymore
+            if i == 0:
+                return []
+            continue
+        simplified.append(new_ring)
+    return simplified
+
+
+def simplify_line(points: list, tolerance: float, precision: int):
+    ''' Iterative Douglas-Peucker - keeps the end points, then drops every point closer than
+        `tolerance` to the segment between the points kept around it.
+    '''
+    if len(points) < 3:
+        return dedupe_points([round_point(p, precision) for p in points])
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    tolerance_sq = tolerance * tolerance
+
+    while stack:
+        first, last = stack.pop()
+        max_dist, index = 0.0, None
+        for i in range(first + 1, last):
+            dist = segment_distance_sq(points[i], points[first], points[last])
+            if dist > max_dist:
+                max_dist, index = dist, i
+        if index is not None and max_dist > tolerance_sq:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return dedupe_points([round_point(p, precision) for p, k in zip(points, keep) if k])
+
+
+def segment_distance_sq(p, a, b):
+    ''' Squared distance from point `p` to the segment `a`-`b` (planar, in degrees) '''
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return (p[0] - a[0]) ** 2 + (p[1] - a[1]) ** 2
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy)))
+    x, y = a[0] + t * dx, a[1] + t * dy
+    return (p[0] - x) ** 2 + (p[1] - y) ** 2
+
+
+def round_point(point: list, precision: int):
+    return [round(c, precision) for c in point]
+
+
+def dedupe_points(points: list):
+    ''' Drops consecutive duplicates left over after rounding '''
+    deduped = []
+    for p in points:
+        if not deduped or p != deduped[-1]:
+            deduped.append(p)
+    return deduped
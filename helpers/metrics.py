@@ -0,0 +1,199 @@
+from contextlib import ContextDecorator
+from contextvars import ContextVar
+from threading import Lock
+import time
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+# Histogram bucket upper bounds in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for counts (ie: SQL queries per request)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# {stage: [seconds, calls]} of the request/job being handled - see `start_breakdown()`
+_breakdown = ContextVar('metrics_breakdown', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    ''' Per-process counters, gauges, and histograms - rendered as Prometheus text.
+        Each metric is keyed by (name, sorted label items).
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, value: float, buckets=DEFAULT_BUCKETS, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self):
+        ''' Prometheus text exposition format (version 0.0.4) '''
+        lines = []
+        with self.lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({n for n, _ in metrics}):
+                    lines.extend(self._header(name, kind))
+                    for (m_name, labels), value in sorted(metrics.items()):
+                        if m_name == name:
+                            lines.append(f'{name}{format_labels(labels)} {value}')
+
+            for name in sorted({n for n, _ in self.histograms}):
+                lines.extend(self._header(name, 'histogram'))
+                for (m_name, labels), histogram in sorted(self.histograms.items(), key=lambda i: i[0]):
+                    if m_name != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name: str, kind: str):
+        if name in self.help:
+            yield f'# HELP {name} {self.help[name]}'
+        yield f'# TYPE {name} {kind}'
+
+
+def metric_key(name: str, labels: dict):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+REGISTRY = MetricsRegistry()
+REGISTRY.describe('rus_ukr_stage_seconds', 'Time spent in an instrumented pipeline stage')
+REGISTRY.describe('rus_ukr_request_seconds', 'Time to handle a maps request')
+REGISTRY.describe('rus_ukr_request_queries', 'SQL queries run while handling a maps request')
+REGISTRY.describe('rus_ukr_requests_total', 'Handled maps requests')
+REGISTRY.describe('rus_ukr_slow_requests_total', 'Maps requests slower than SLOW_REQUEST_SECONDS')
+
+
+class timed(ContextDecorator):
+    ''' Times a pipeline stage - as a decorator (`@timed('spacy')`) or `with timed('spacy'):`.
+        Observes `rus_ukr_stage_seconds{stage=...}` and adds to the current breakdown.
+    '''
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def record_stage(stage: str, seconds: float):
+    REGISTRY.observe('rus_ukr_stage_seconds', seconds, stage=stage)
+    breakdown = _breakdown.get()
+    if breakdown is not None:
+        totals = breakdown.setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += 1
+
+
+def start_breakdown():
+    ''' Starts collecting per-stage totals for the current request/job - returns (dict, reset token) '''
+    breakdown = {}
+    return breakdown, _breakdown.set(breakdown)
+
+
+def end_breakdown(token):
+    _breakdown.reset(token)
+
+
+def format_breakdown(breakdown: dict):
+    ''' "stage=12.3ms/4 other=1.0ms/1" - slowest stage first '''
+    return ' '.join(f'{stage}={seconds * 1000:.1f}ms/{calls}'
+                    for stage, (seconds, calls) in sorted(breakdown.items(), key=lambda i: -i[1][0]))
+
+
+class count_queries:
+    ''' Counts & times the SQL run while the block is active (`with count_queries() as q:`) - on every
+        database connection, including the ones used by `sync_to_async` threads of an async view.
+        Adds the total time to the current breakdown as the "sql" stage.
+    '''
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self._token = None
+
+    def __enter__(self):
+        self._token = _query_counter.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _query_counter.reset(self._token)
+        if self.queries:
+            record_stage('sql', self.seconds)
+        return False
+
+
+# The active `count_queries` - context variables follow a request into `sync_to_async` threads
+_query_counter = ContextVar('metrics_query_counter', default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _query_counter.get()
+    if counter is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        counter.queries += 1
+        counter.seconds += time.perf_counter() - start
+
+
+@receiver(connection_created)
+def _install_query_counter(sender, connection, **kwargs):
+    # Runs on every (re)connect of the same wrapper - install once
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
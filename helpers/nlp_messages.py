@@ -1,8 +1,12 @@
-from django.forms.models import model_to_dict
-from Data.models import City, State, Country
+from typing import TYPE_CHECKING
+
+from helpers.gazetteer import get_gazetteer
+from helpers.metrics import REGISTRY, timed
 
 import json
-import spacy
+
+if TYPE_CHECKING:
+    from spacy.tokens import Token
 
 
 # TODO Make and run tests to check accuracy of desired outcome for parsers that store!
@@ -10,67 +14,68 @@ import spacy
 TESTINGTEXT = "He did this to John."
 
 
-def setup_spacy(text=TESTINGTEXT):
-    nlp = spacy.load("en_core_web_sm")
-    nlp.add_pipe('merge_entities')
-    nlp.add_pipe('merge_noun_chunks')
-    nlp.add_pipe('emoji', first=True)
+REGISTRY.describe('rus_ukr_place_lookup_misses_total', 'GPE tokens not found in the gazetteer by exact match')
 
-    return nlp(text)  # doc
 
+# Process-wide pipeline - built on first use by `get_nlp()`
+_NLP = None
 
-def check_token_is_place(token: spacy.tokens.token.Token, is_GPE: bool = False):
-    ''' Checks if the token is a Proper-Noun (PROPN).
-        If so, searches to check if the token is a City, State, or Country (in db)
-        Uses the most likely match from `compare_strings()` 
-        Returns: City | State | Country instance -OR- bool(False)
+
+def get_nlp():
+    ''' Returns the shared spaCy pipeline, loading the model and adding the
+        custom pipes only the first time it is called in this process.
+        spaCy itself is only imported here - importing this module stays cheap.
     '''
-    def exact():
-        if token.ent_type_ == 'GPE':  # TODO delete this double check?
-            # Attempt to get db version of GPE
-            found = Country.objects.get(name=token.text)
-            if not found:
-                found = State.objects.get(name=token.text)
-                if not found:
-                    found = City.objects.get(name=token.text)
-            if found:
-                return found
-            else:
-                # Couldn't find with exact search, try again with not exact.
-                print(f"\nCOULD NOT FIND PLACE {token.text} WITH EXACT MATCH!")
-                return False
+    global _NLP
 
-    def loose():
-        if token.pos_ == 'PROPN':
-            possible_place = token.text
+    if _NLP is None:
+        with timed('spacy_load'):
+            import spacy
 
-            # Smallest -> Largest DB
-            country = Country.objects.filter(name__icontains=possible_place)
-            state = State.objects.filter(name__icontains=possible_place)
-            city = City.objects.filter(name__icontains=possible_place)
+            nlp = spacy.load("en_core_web_sm")
+            nlp.add_pipe('merge_entities')
+            nlp.add_pipe('merge_noun_chunks')
+            nlp.add_pipe('emoji', first=True)
+        _NLP = nlp
+    return _NLP
 
-            parent = []
 
-            [parent.append(model_to_dict(p)) for p in country]
-            [parent.append(model_to_dict(p)) for p in state]
-            [parent.append(model_to_dict(p)) for p in city]
+@timed('setup_spacy')
+def setup_spacy(text=TESTINGTEXT):
+    return get_nlp()(text)  # doc
 
-            scored_objs = [compare_strings(p['name'], possible_place) for p in parent]
 
-            best_match = sorted(scored_objs, key=lambda o: o['score'], reverse=True)[0]
+def pipe_texts(texts, batch_size: int = 50, n_process: int = 1):
+    ''' Runs many texts through the shared pipeline with `nlp.pipe`.
+        Yields a `Doc` per text, in the same order as `texts`.
+    '''
+    return get_nlp().pipe(texts, batch_size=batch_size, n_process=n_process)
 
-            new_parent = [el for el in parent if el['name'] == best_match['string1']][0]
 
-            if new_parent:
-                if "state" in new_parent.keys() and "country" in new_parent.keys():  # is City
-                    found = City.objects.get(id=new_parent['id'])
-                elif "country" in new_parent.keys():  # is State
-                    found = State.objects.get(id=new_parent['id'])
-                else:  # is Country
-                    found = Country.objects.get(id=new_parent['id'])
-                return found
+@timed('check_token_is_place')
+def check_token_is_place(token: 'Token', is_GPE: bool = False):
+    ''' Checks if the token is a Proper-Noun (PROPN).
+        If so, searches the in-memory gazetteer to check if the token is a City, State, or Country
+        Uses the most likely match from the gazetteer's trigram index
+        Returns: (City | State | Country, id) tuple -OR- bool(False)
+    '''
+    gazetteer = get_gazetteer()
+
+    def exact():
+        found = gazetteer.exact(token.text)
+        if found:
+            return found[0]
+        else:
+            # Couldn't find with exact search, try again with not exact (counted - most tokens miss).
+            REGISTRY.inc('rus_ukr_place_lookup_misses_total', match='exact')
+            return False
 
-                return found
+    def loose():
+        if token.pos_ == 'PROPN':
+            # [(normalized name, (model, id), score), ...] - best trigram match first
+            found = gazetteer.fuzzy(token.text, k=1)
+            if found:
+                return found[0][1]
             return False
         else:
             return False
@@ -80,8 +85,7 @@ def check_token_is_place(token: spacy.tokens.token.Token, is_GPE: bool = False):
         exact_attempt = exact()
         if exact_attempt:
             return exact_attempt
-    else:
-        return loose()
+    return loose()
 
 
 def compare_strings(string1, string2):
@@ -112,14 +116,14 @@ def compare_strings(string1, string2):
 
 
 # ############################# From `~/spt.py` #############################
-def has_direct_obj(token: spacy.tokens.token.Token):
+def has_direct_obj(token: 'Token'):
     dobj = [w for w in token.rights if w.dep_ == 'dobj']
     if dobj:
         return dobj
     return False
 
 
-def has_preposition(token: spacy.tokens.token.Token):
+def has_preposition(token: 'Token'):
     prep = [w for w in token.rights if w.dep_ in ['prep']]
     if prep:
         pobj = [[w2 for w2 in w.subtree if w2.dep_ in ['pobj']] for w in prep]
@@ -134,7 +138,7 @@ def has_preposition(token: spacy.tokens.token.Token):
     return False
 
 
-def matches_subjVerbDobj(token: spacy.tokens.token.Token):
+def matches_subjVerbDobj(token: 'Token'):
     """ Attempts to extract a phrase from branching from `token` 
         by checking if that token has a `left [child]` with a 
         dependency of `subj`. 
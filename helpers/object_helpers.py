@@ -18,3 +18,27 @@ def search_list_for_obj(lst: list, key: str, value: str):
         return ret_lst[0]
     print('\nFOUND MULTIPLE OR ZERO OBJECTS IN LIST!')
     return ret_lst
+
+
+def chunked(iterable, size: int):
+    ''' Yields lists of up to `size` items from `iterable` without loading it all at once '''
+    from itertools import islice
+
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def normalize_place_name(name: str):
+    ''' Case-folds and strips accents/extra whitespace from `name`
+        so lookups are insensitive to both.
+    '''
+    import unicodedata
+
+    if not name:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.casefold().replace('’', "'").split())
@@ -0,0 +1,70 @@
+''' 64 bit SimHash fingerprints of message texts - near-identical texts get fingerprints that
+    differ in few bits (Hamming distance). Reposts and forwards with small edits of a short
+    message stay within ~10 bits of the original, unrelated texts differ in ~25 or more.
+
+    The fingerprint is split into `BANDS` bands of 8 bits: two fingerprints within `BANDS - 1`
+    bits of each other share at least one whole band, so candidates are found with exact band
+    matches (see `Data/near_duplicates.py`), then confirmed with `hamming()`.
+'''
+from hashlib import blake2b
+import re
+
+from helpers.object_helpers import normalize_place_name
+
+
+BITS = 64
+BANDS = 8
+BAND_BITS = BITS // BANDS
+
+# Too few words for a meaningful fingerprint - ie: captions like 'Video' or a single emoji
+MIN_WORDS = 8
+
+WORD = re.compile(r'\w+')
+
+
+def features(text: str):
+    ''' ({word: count}, number of words) of the case/accent-folded words of `text` '''
+    words = WORD.findall(normalize_place_name(text))
+    counts = {}
+    for word in words:
+        counts[word] = counts.get(word, 0) + 1
+    return counts, len(words)
+
+
+def simhash(text: str, min_words: int = MIN_WORDS):
+    ''' Unsigned 64 bit fingerprint of `text` - or None for texts under `min_words` words '''
+    counts, n_words = features(text or '')
+    if n_words < min_words:
+        return None
+
+    totals = [0] * BITS
+    for word, weight in counts.items():
+        h = int.from_bytes(blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+        for bit in range(BITS):
+            totals[bit] += weight if h >> bit & 1 else -weight
+
+    fingerprint = 0
+    for bit, total in enumerate(totals):
+        if total > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def bands(fingerprint: int):
+    ''' The `BANDS` bands of an (unsigned) fingerprint '''
+    mask = (1 << BAND_BITS) - 1
+    return [fingerprint >> (i * BAND_BITS) & mask for i in range(BANDS)]
+
+
+def hamming(a: int, b: int):
+    ''' Number of bits that differ between two fingerprints '''
+    return bin((a ^ b) & ((1 << BITS) - 1)).count('1')
+
+
+def to_signed(fingerprint: int):
+    ''' Unsigned fingerprint -> the signed 64 bit int a `BigIntegerField` stores '''
+    return fingerprint - (1 << BITS) if fingerprint >= 1 << (BITS - 1) else fingerprint
+
+
+def to_unsigned(value: int):
+    return value & ((1 << BITS) - 1)
@@ -0,0 +1,153 @@
+from math import asin, cos, floor, radians, sin, sqrt
+import heapq
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from Data.models import City, State, Country
+
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.2
+
+# Process-wide index - built on first use by `get_place_grid()`
+_PLACE_GRID = None
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    ''' Great-circle distance between two coordinates in km '''
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(a))
+
+
+class PlaceGrid:
+    ''' In-memory spatial index of City, State, and Country coordinates.
+        Places are bucketed in `cell_size` degree lat/lon cells, so bbox and nearest-place
+        queries only look at the cells around the query instead of every row.
+        Entries are `(latitude, longitude, model, id, name)` tuples.
+    '''
+
+    def __init__(self, cell_size: float = 0.5):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.counts = {}  # model -> number of entries
+        self.rows = int(180 / cell_size)
+        self.cols = int(360 / cell_size)
+
+    def _cell(self, lat: float, lon: float):
+        row = min(int(floor((lat + 90) / self.cell_size)), self.rows - 1)
+        col = int(floor((lon + 180) / self.cell_size)) % self.cols
+        return row, col
+
+    def add(self, lat: float, lon: float, model, place_id: int, name: str):
+        if lat is None or lon is None:
+            return
+        self.cells.setdefault(self._cell(lat, lon), []).append((lat, lon, model, place_id, name))
+        self.counts[model] = self.counts.get(model, 0) + 1
+
+    def bbox(self, west: float, south: float, east: float, north: float, model=None):
+        ''' Returns every entry inside the bounding box (optionally only of `model`) '''
+        row_min, col_min = self._cell(south, west)
+        row_max, col_max = self._cell(north, east)
+        # Box crossing the antimeridian wraps around the columns
+        cols = range(col_min, col_max + 1) if col_min <= col_max else \
+            list(range(col_min, self.cols)) + list(range(0, col_max + 1))
+        lon_inside = (lambda lon: west <= lon <= east) if west <= east else \
+            (lambda lon: lon >= west or lon <= east)
+
+        found = []
+        for row in range(row_min, row_max + 1):
+            for col in cols:
+                for entry in self.cells.get((row, col), ()):
+                    if (model is None or entry[2] == model) and south <= entry[0] <= north and lon_inside(entry[1]):
+                        found.append(entry)
+        return found
+
+    def nearest(self, lat: float, lon: float, k: int = 1, model=None):
+        ''' Returns up to `k` `(distance km, entry)` pairs closest to the coordinate,
+            nearest first - searches rings of cells outwards from the coordinate's cell.
+        '''
+        # Never more than there are - an empty grid (or model) would otherwise search every cell
+        k = min(k, self.counts.get(model, 0) if model is not None else sum(self.counts.values()))
+        if k <= 0:
+            return []
+
+        row0, col0 = self._cell(lat, lon)
+        best = []  # max-heap of (-distance, entry)
+        seen = set()  # Large rings wrap around the columns onto cells already searched
+
+        for ring in range(max(self.rows, self.cols)):
+            for row, col in self._ring_cells(row0, col0, ring):
+                if (row, col) in seen:
+                    continue
+                seen.add((row, col))
+                for entry in self.cells.get((row, col), ()):
+                    if model is not None and entry[2] != model:
+                        continue
+                    dist = haversine_km(lat, lon, entry[0], entry[1])
+                    if len(best) < k:
+                        heapq.heappush(best, (-dist, entry[3], entry))
+                    elif dist < -best[0][0]:
+                        heapq.heapreplace(best, (-dist, entry[3], entry))
+
+            # Anything in the next ring is at least `ring` cells away - stop once that
+            # is further than the current k-th best distance
+            if len(best) == k:
+                lower_bound = ring * self.cell_size * KM_PER_DEGREE
+                # Columns shrink towards the poles - until every column was searched
+                if 2 * ring + 1 < self.cols:
+                    far_lat = min(90.0, abs(lat) + (ring + 1) * self.cell_size)
+                    lower_bound *= cos(radians(far_lat))
+                if lower_bound > -best[0][0]:
+                    break
+            if len(seen) >= self.rows * self.cols:
+                break
+
+        return [(-neg_dist, entry) for neg_dist, _, entry in sorted(best, reverse=True)]
+
+    def _ring_cells(self, row0: int, col0: int, ring: int):
+        ''' Cells exactly `ring` steps from (row0, col0) '''
+        if ring == 0:
+            yield row0, col0
+            return
+        for row in range(row0 - ring, row0 + ring + 1):
+            if not 0 <= row < self.rows:
+                continue
+            if row in (row0 - ring, row0 + ring):
+                cols = range(col0 - ring, col0 + ring + 1)
+            else:
+                cols = (col0 - ring, col0 + ring)
+            for col in cols:
+                yield row, col % self.cols
+
+    @classmethod
+    def from_db(cls, cell_size: float = 0.5):
+        ''' Builds the index with one query per table '''
+        grid = cls(cell_size)
+        for model in (Country, State, City):
+            for p_id, name, lat, lon in model.objects.values_list('id', 'name', 'latitude', 'longitude'):
+                grid.add(lat, lon, model, p_id, name)
+        return grid
+
+
+def get_place_grid():
+    ''' Returns the shared `PlaceGrid`, loading it from the db on first use '''
+    global _PLACE_GRID
+
+    if _PLACE_GRID is None:
+        _PLACE_GRID = PlaceGrid.from_db()
+    return _PLACE_GRID
+
+
+def invalidate_place_grid():
+    ''' Drops the shared index - it will be rebuilt on next `get_place_grid()` '''
+    global _PLACE_GRID
+    _PLACE_GRID = None
+
+
+@receiver([post_save, post_delete], sender=City)
+@receiver([post_save, post_delete], sender=State)
+@receiver([post_save, post_delete], sender=Country)
+def _place_changed(sender, **kwargs):
+    invalidate_place_grid()
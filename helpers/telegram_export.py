@@ -0,0 +1,139 @@
+import codecs
+import json
+
+
+WHITESPACE = ' \t\n\r'
+
+
+class TelegramExportReader:
+    ''' Incremental reader for a Telegram channel history export (`result.json`).
+        Iterating yields the objects of the top-level `messages` array one at a time,
+        reading the file in `read_size` chunks - memory use does not grow with file size.
+
+        Top-level scalar fields seen before `messages` (ie: 'name', 'type', 'id')
+        are collected in `header`. `offset` is the byte offset just past the last
+        yielded message - passing it back as `start_offset` resumes after that message.
+    '''
+
+    def __init__(self, path, read_size: int = 1 << 16, start_offset: int = 0):
+        self.path = path
+        self.read_size = read_size
+        self.start_offset = start_offset
+        self.header = {}
+        self.offset = 0
+
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._buf_start = 0  # byte offset of `self._buf[0]`
+        self._mark = 0  # `self._buf` index up to which `_mark_bytes` counts
+        self._mark_bytes = 0  # utf-8 length of `self._buf[:self._mark]`
+        self._eof = False
+
+    def __iter__(self):
+        with open(self.path, 'rb') as self._file:
+            self._reset(0)
+            yield from self._read_object()
+
+    def read_header(self):
+        ''' Parses only the top-level fields before `messages` - returns `header` '''
+        with open(self.path, 'rb') as self._file:
+            self._reset(0)
+            for _ in self._read_object(stop_at_messages=True):
+                pass
+        return self.header
+
+    def _reset(self, offset: int):
+        self._file.seek(offset)
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._buf_start = offset
+        self._mark = self._mark_bytes = 0
+        self._eof = False
+
+    # ############################# Parsing helpers #############################
+    def _fill(self):
+        ''' Reads the next chunk into the buffer - returns False at end of file '''
+        if self._eof:
+            return False
+
+        # Drop consumed text so the buffer only holds what is still unparsed
+        self._buf_start = self._position()
+        self._buf = self._buf[self._pos:]
+        self._pos = self._mark = self._mark_bytes = 0
+
+        chunk = self._file.read(self.read_size)
+        if not chunk:
+            self._eof = True
+            self._buf += self._text.decode(b'', final=True)
+            return False
+        self._buf += self._text.decode(chunk)
+        return True
+
+    def _peek(self, skip: str = WHITESPACE):
+        ''' Returns the next character that is not in `skip`, without consuming it '''
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in skip:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError(f'UNEXPECTED END OF TELEGRAM EXPORT: {self.path}')
+
+    def _expect(self, char: str):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f'EXPECTED "{char}" IN TELEGRAM EXPORT, FOUND "{found}"')
+        self._pos += 1
+
+    def _value(self):
+        ''' Decodes one complete JSON value, reading more of the file as needed '''
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def _position(self):
+        ''' Byte offset of `self._pos` in the file - only the text consumed since the last call is encoded '''
+        if self._pos != self._mark:
+            self._mark_bytes += len(self._buf[self._mark:self._pos].encode('utf-8'))
+            self._mark = self._pos
+        return self._buf_start + self._mark_bytes
+
+    def _read_object(self, stop_at_messages: bool = False):
+        self._expect('{')
+        while self._peek(WHITESPACE + ',') != '}':
+            key = self._value()
+            self._expect(':')
+
+            if key == 'messages':
+                if stop_at_messages:
+                    return
+                yield from self._read_messages()
+            else:
+                value = self._value()
+                if not isinstance(value, (dict, list)):
+                    self.header[key] = value
+        self._pos += 1
+
+    def _read_messages(self):
+        self._expect('[')
+        # Resuming - jump straight past the last message handled by a previous run
+        if self.start_offset > self._position():
+            self._reset(self.start_offset)
+            self.offset = self.start_offset
+        while self._peek(WHITESPACE + ',') != ']':
+            message = self._value()
+            self.offset = self._position()
+            yield message
+        self._pos += 1
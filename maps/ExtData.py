@@ -1,47 +1,196 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
 from Data.models import City, State, Country
 from helpers.object_helpers import search_list_for_obj
+from helpers.geometry import build_simplified_levels, level_for_zoom
+from helpers.metrics import timed
+from maps.http_client import GeometryFetchError, get_geometry_client
+from maps.models import PlaceGeometry
 
 # from OSMPythonTools.overpass import Overpass, overpassQueryBuilder
 # from OSMPythonTools.nominatim import Nominatim
 
-import requests
 import json
 
 
-def get_city_geometry(loc: City or State or Country, write: bool = False):
+class NominatimProvider:
+    ''' Looks up place boundaries with the public Nominatim search API (through the shared,
+        rate-limited `GeometryHttpClient`)
+    '''
+    name = 'nominatim'
+    url = 'https://nominatim.openstreetmap.org/search'
+
+    def search(self, loc: City or State or Country):
+        return get_geometry_client().get_json(self.url, self.params(loc))
+
+    async def asearch(self, loc: City or State or Country):
+        params = await sync_to_async(self.params)(loc)  # `loc.country` can hit the db
+        return await get_geometry_client().async_get_json(self.url, params)
+
+    def params(self, loc: City or State or Country):
+        params = dict({
+            'q': loc.name,
+            'polygon_geojson': 1,
+            'format': 'jsonv2'
+        })
+        country = getattr(loc, 'country', None)
+        if country:
+            params['country'] = country.name
+        return params
+
+
+class LocalGeometryProvider:
+    ''' Stand-in for `NominatimProvider` that never touches the network (ie: for tests).
+        Reads Nominatim-style results from a json file (`settings.GEOMETRY_LOCAL_FILE`)
+        or `results`, keyed by "<place type>:<id>" or by place name.
+    '''
+    name = 'local'
+
+    def __init__(self, results: dict = None):
+        if results is None:
+            with open(settings.GEOMETRY_LOCAL_FILE, encoding='utf-8') as rf:
+                results = json.load(rf)
+        self.results = results
+
+    def search(self, loc: City or State or Country):
+        key = f'{get_place_type(loc)}:{loc.id}'
+        return self.results.get(key, self.results.get(loc.name, []))
 
-    url = 'https://nominatim.openstreetmap.org/search?'
-    params = dict({
-        'q': loc.name,
-        'polygon_geojson': 1,
-        'format': 'jsonv2'
-    })
-    if loc.country:
-        params['country'] = loc.country
+    async def asearch(self, loc: City or State or Country):
+        return self.search(loc)
 
-    query_string = url + '&'.join([str(k)+'='+str(v) for k, v in params.items()])
 
-    response = requests.get(url, params)
-    data = response.json()
+def get_place_type(loc: City or State or Country):
+    ''' Returns 'city' | 'state' | 'country' for a place instance '''
+    return loc._meta.model_name
+
+
+def get_geometry_provider():
+    return import_string(settings.GEOMETRY_PROVIDER)()
+
+
+@timed('get_city_geometry')
+def get_city_geometry(loc: City or State or Country, write: bool = False, offline: bool = None, provider=None,
+                      zoom: int = None):
+    ''' Returns the boundary GeoJSON of `loc` - or None if there is no match.
+        Served from the `PlaceGeometry` store when the place was resolved before. Otherwise
+        asks `provider` (default `settings.GEOMETRY_PROVIDER`) and stores the result.
+        In `offline` mode (default `settings.GEOMETRY_OFFLINE`) the provider is never used.
+        With a map `zoom`, the simplified level fitting that zoom is returned.
+    '''
+    place_type = get_place_type(loc)
+
+    stored = find_stored_geometry(place_type, loc.id)
+    if stored:
+        return pick_geometry_level(stored, zoom)
+
+    if settings.GEOMETRY_OFFLINE if offline is None else offline:
+        print(f'\nOFFLINE - NO STORED GEOMETRY FOR {place_type.upper()}:\t{loc.name}')
+        return None
+
+    provider = provider or get_geometry_provider()
+    with timed(f'geometry_provider_{provider.name}'):
+        try:
+            data = provider.search(loc)
+        except GeometryFetchError as err:
+            # Nothing is stored - the next request tries again
+            print(f'\nGEOMETRY PROVIDER FAILED FOR {place_type.upper()}:\t{loc.name}\t{err}')
+            return None
 
     if write:
         with open('../Data/Test1-data.json', 'w', encoding='utf-8') as wf:
             json.dump(data, wf, indent=4, ensure_ascii=False)
         print("\nFILE WRITTEN TO:\t~/Data/Test1-data.json")
 
+    match = find_geometry_match(data)
+    stored = store_geometry(loc, match, provider.name)
+
+    # Return geojson for plotting
+    return pick_geometry_level(stored, zoom)
+
+
+async def aget_city_geometry(loc: City or State or Country, offline: bool = None, provider=None,
+                             zoom: int = None):
+    ''' Async `get_city_geometry` - waiting on the provider does not hold a worker thread '''
+    with timed('get_city_geometry'):
+        place_type = get_place_type(loc)
+
+        stored = await sync_to_async(find_stored_geometry)(place_type, loc.id)
+        if stored:
+            return await sync_to_async(pick_geometry_level)(stored, zoom)
+
+        if settings.GEOMETRY_OFFLINE if offline is None else offline:
+            print(f'\nOFFLINE - NO STORED GEOMETRY FOR {place_type.upper()}:\t{loc.name}')
+            return None
+
+        try:
+            stored = await afetch_geometry(loc, provider)
+        except GeometryFetchError as err:
+            # Nothing is stored - the next request tries again
+            print(f'\nGEOMETRY PROVIDER FAILED FOR {place_type.upper()}:\t{loc.name}\t{err}')
+            return None
+        return await sync_to_async(pick_geometry_level)(stored, zoom)
+
+
+async def afetch_geometry(loc: City or State or Country, provider=None):
+    ''' Asks `provider` (default `settings.GEOMETRY_PROVIDER`) for the boundary of `loc` and stores it,
+        replacing any stored geometry. Returns the `PlaceGeometry` - raises `GeometryFetchError`.
+        Providers without an `asearch` method are run in a thread.
+    '''
+    provider = provider or get_geometry_provider()
+    asearch = getattr(provider, 'asearch', None) or sync_to_async(provider.search)
+    with timed(f'geometry_provider_{provider.name}'):
+        data = await asearch(loc)
+
+    match = find_geometry_match(data)
+    return await sync_to_async(store_geometry)(loc, match, provider.name)
+
+
+def find_stored_geometry(place_type: str, place_id: int):
+    return PlaceGeometry.objects.filter(place_type=place_type, place_id=place_id).first()
+
+
+def pick_geometry_level(stored: PlaceGeometry, zoom: int = None):
+    ''' Returns the geometry of `stored` simplified for `zoom` (full resolution if no `zoom`) '''
+    level = level_for_zoom(zoom) if zoom is not None else None
+    if not level or not stored.geojson:
+        return stored.geojson
+
+    # Rows stored before their levels were built - build once and keep them
+    if level not in stored.simplified:
+        stored.simplified = build_simplified_levels(stored.geojson)
+        stored.save(update_fields=['simplified'])
+    return stored.simplified[level]
+
+
+def find_geometry_match(data: list):
+    ''' Picks the result to use out of a provider response - or None '''
     # Attempt to find the right object in response - should be osm_type=relation,geojson.coordinates.count>2
     objs_with_relation = search_list_for_obj(data, 'osm_type', 'relation')
 
     # Multiple matches - Do further matching -- 'error' already printed from search
     if type(objs_with_relation) == list:
-        return
+        return None
 
     # Single match - Continue to get geo data
-    if type(objs_with_relation) == dict:
-        print('\nFOUND CLOSEST MATCH WITH DISPLAY NAME:\t', objs_with_relation['display_name'])
+    print('\nFOUND CLOSEST MATCH WITH DISPLAY NAME:\t', objs_with_relation['display_name'])
+    return objs_with_relation
 
-        # Return geojson for plotting
-        geojson = objs_with_relation['geojson']
-        return geojson
 
-    return print("\n\nSOMETHING WENT VERY WRONG!!!")
+def store_geometry(loc: City or State or Country, match: dict, provider_name: str):
+    ''' Saves (or replaces) the `PlaceGeometry` of `loc` from a provider `match` '''
+    match = match or {}
+    geometry, _ = PlaceGeometry.objects.update_or_create(
+        place_type=get_place_type(loc),
+        place_id=loc.id,
+        defaults={'geojson': match.get('geojson'),
+                  'simplified': build_simplified_levels(match.get('geojson')),
+                  'matched': bool(match),
+                  'provider': provider_name,
+                  'display_name': match.get('display_name'),
+                  'osm_type': match.get('osm_type'),
+                  'osm_id': match.get('osm_id'),
+                  })
+    return geometry
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MapsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'maps'
+
+    def ready(self):
+        # Register signal receivers that drop stored maps when places change
+        import maps.render_cache  # noqa: F401
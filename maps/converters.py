@@ -0,0 +1,32 @@
+class PlaceTypeConverter:
+    ''' `city` | `state` | `country` - the location types of `views.PLACE_MODELS` '''
+    regex = 'city|state|country'
+
+    def to_python(self, value):
+        return value
+
+    def to_url(self, value):
+        return value
+
+
+class CoordinateConverter:
+    ''' Decimal degrees (ie: `50.45`, `-0.1`) -> float. Values outside +-`limit` don't match (404) '''
+    regex = r'-?\d+(?:\.\d+)?'
+    limit = 180.0
+
+    def to_python(self, value):
+        value = float(value)
+        if not -self.limit <= value <= self.limit:
+            raise ValueError(f'Coordinate out of range: {value}')
+        return value
+
+    def to_url(self, value):
+        return str(value)
+
+
+class LatitudeConverter(CoordinateConverter):
+    limit = 90.0
+
+
+class LongitudeConverter(CoordinateConverter):
+    limit = 180.0
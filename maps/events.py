@@ -0,0 +1,207 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import json
+import threading
+import uuid
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import Exists, OuterRef, Q
+from django.utils.dateparse import parse_date, parse_datetime
+
+from Data.models import MessageEvent
+from Data.rollups import events_version
+from helpers.clustering import ClusterIndex
+from helpers.object_helpers import chunked
+
+
+# MessageEvent relation -> place type (also the place field on the through table)
+PLACE_RELATIONS = {'cities': 'city', 'states': 'state', 'countries': 'country'}
+
+EVENT_FIELDS = ('id', 'event_date', 'subject', 'action', 'text', 'classification__eType')
+
+# Process-wide (version, ClusterIndex) - rebuilt by `get_cluster_index()` when events change
+_CLUSTER_INDEX = (None, None)
+_CLUSTER_LOCK = threading.Lock()
+_CLUSTER_REBUILDING = False
+
+
+def parse_bbox(bbox: str):
+    ''' "west,south,east,north" -> (west, south, east, north) floats - or None '''
+    if not bbox:
+        return None
+    west, south, east, north = (float(v) for v in bbox.split(','))
+    return west, south, east, north
+
+
+def encode_cursor(event_date, event_id):
+    return urlsafe_b64encode(f'{event_date.isoformat()}|{event_id}'.encode('utf-8')).decode('ascii')
+
+
+def parse_date_param(value: str, name: str = 'date'):
+    ''' ISO date or datetime query param -> `date`/`datetime` - or None. Raises ValueError when invalid '''
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value) or parse_date(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValueError(f'Invalid {name}: {value!r} - expected an ISO date')
+    return parsed
+
+
+def decode_cursor(cursor: str):
+    ''' Returns (event_date, event id) from `encode_cursor`. Raises ValueError for a malformed cursor '''
+    try:
+        event_date, event_id = urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        event_date, event_id = parse_datetime(event_date), uuid.UUID(event_id)
+    except (ValueError, UnicodeError):
+        event_date = None
+    if event_date is None:
+        raise ValueError(f'Invalid cursor: {cursor!r}')
+    return event_date, event_id
+
+
+def place_in_bbox(field: str, bbox):
+    ''' Filter kwargs for a place (via `field`) with coordinates inside `bbox` '''
+    if not bbox:
+        return {}
+    west, south, east, north = bbox
+    return {f'{field}__longitude__range': (west, east), f'{field}__latitude__range': (south, north)}
+
+
+def filter_events(bbox=None, start=None, end=None, classification=None, cursor=None):
+    ''' `MessageEvent` queryset for the events API, ordered for keyset pagination (event_date, id).
+        `bbox` matches events with any City/State/Country inside it.
+        Raises ValueError for an invalid `start`, `end`, or `cursor`.
+    '''
+    events = MessageEvent.objects.filter(event_date__isnull=False)
+    start, end = parse_date_param(start, 'start'), parse_date_param(end, 'end')
+
+    if start:
+        events = events.filter(event_date__gte=start)
+    if end:
+        events = events.filter(event_date__lte=end)
+    if classification:
+        events = events.filter(classification__eType=classification)
+
+    if bbox:
+        # EXISTS per relation - no joins multiplying rows, no DISTINCT
+        in_bbox = Q()
+        for relation, field in PLACE_RELATIONS.items():
+            through = MessageEvent._meta.get_field(relation).remote_field.through
+            in_bbox |= Exists(through.objects.filter(messageevent=OuterRef('pk'), **place_in_bbox(field, bbox)))
+        events = events.filter(in_bbox)
+
+    if cursor:
+        last_date, last_id = decode_cursor(cursor)
+        events = events.filter(Q(event_date__gt=last_date) | Q(event_date=last_date, id__gt=last_id))
+
+    return events.order_by('event_date', 'id')
+
+
+def event_places(event_ids, bbox=None):
+    ''' {event id: [(place type, id, name, latitude, longitude), ...]} for `event_ids` '''
+    places = {}
+    for relation, field in PLACE_RELATIONS.items():
+        through = MessageEvent._meta.get_field(relation).remote_field.through
+        rows = through.objects.filter(messageevent_id__in=event_ids,
+                                      **{f'{field}__latitude__isnull': False},
+                                      **place_in_bbox(field, bbox)) \
+            .values_list('messageevent_id', f'{field}_id', f'{field}__name', f'{field}__latitude', f'{field}__longitude')
+        for event_id, *place in rows:
+            places.setdefault(event_id, []).append((field, *place))
+    return places
+
+
+def iter_event_features(events, bbox=None, limit: int = 1000, chunk_size: int = 500):
+    ''' Streams a GeoJSON FeatureCollection (as text chunks) of up to `limit` events of the
+        `filter_events` queryset `events` - one Point feature per event place. Ends with a
+        "next" cursor when there are more events.
+    '''
+    rows = events.values_list(*EVENT_FIELDS)[:limit + 1].iterator(chunk_size=chunk_size)
+
+    yield '{"type": "FeatureCollection", "features": ['
+    first = True
+    last_row = None
+    has_more = False
+    count = 0
+
+    for chunk in chunked(rows, chunk_size):
+        if count + len(chunk) > limit:
+            chunk = chunk[:limit - count]
+            has_more = True
+        count += len(chunk)
+
+        places = event_places([row[0] for row in chunk], bbox)
+        for event_id, event_date, subject, action, text, classification in chunk:
+            for place_type, place_id, name, lat, lon in places.get(event_id, []):
+                feature = {'type': 'Feature',
+                           'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+                           'properties': {'event': event_id,
+                                          'event_date': event_date,
+                                          'subject': subject,
+                                          'action': action,
+                                          'text': text,
+                                          'classification': classification,
+                                          'place_type': place_type,
+                                          'place_id': place_id,
+                                          'place_name': name,
+                                          }}
+                yield ('' if first else ',') + json.dumps(feature, cls=DjangoJSONEncoder)
+                first = False
+        if chunk:
+            last_row = chunk[-1]
+
+    next_cursor = encode_cursor(last_row[1], last_row[0]) if has_more and last_row else None
+    yield '], "next": ' + json.dumps(next_cursor) + '}'
+
+
+def event_points():
+    ''' (latitude, longitude, event id) of every event place - one query per place relation '''
+    for relation, field in PLACE_RELATIONS.items():
+        through = MessageEvent._meta.get_field(relation).remote_field.through
+        yield from through.objects.filter(**{f'{field}__latitude__isnull': False}) \
+            .values_list(f'{field}__latitude', f'{field}__longitude', 'messageevent_id') \
+            .iterator(chunk_size=5000)
+
+
+def build_cluster_index(version: str):
+    ''' Builds the `ClusterIndex` of every event and shares it as `version` '''
+    global _CLUSTER_INDEX
+
+    index = ClusterIndex(event_points())
+    with _CLUSTER_LOCK:
+        if _CLUSTER_INDEX[0] is None or int(_CLUSTER_INDEX[0]) <= int(version):
+            _CLUSTER_INDEX = (version, index)
+    return _CLUSTER_INDEX
+
+
+def _rebuild_cluster_index(version: str):
+    global _CLUSTER_REBUILDING
+    try:
+        build_cluster_index(version)
+    finally:
+        _CLUSTER_REBUILDING = False
+        # Own thread, own connection
+        connection.close()
+
+
+def get_cluster_index():
+    ''' Returns (events version, shared `ClusterIndex`). When events changed the current index is
+        returned while a new one is built in a background thread - only the very first call of the
+        process builds it inline.
+    '''
+    global _CLUSTER_REBUILDING
+
+    version = events_version()
+    if _CLUSTER_INDEX[1] is None:
+        return build_cluster_index(version)
+
+    if _CLUSTER_INDEX[0] != version:
+        with _CLUSTER_LOCK:
+            start = not _CLUSTER_REBUILDING
+            _CLUSTER_REBUILDING = True
+        if start:
+            threading.Thread(target=_rebuild_cluster_index, args=(version,), daemon=True).start()
+    return _CLUSTER_INDEX
@@ -0,0 +1,171 @@
+from threading import Lock, Thread
+import asyncio
+import os
+import random
+import time
+
+from django.conf import settings
+
+import httpx
+
+
+# Upstream responses worth another attempt
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Process-wide client - built on first use by `get_geometry_client()`
+_CLIENT = None
+
+
+class GeometryFetchError(Exception):
+    ''' A geometry provider could not be reached, or kept failing after every retry '''
+
+
+class RateLimiter:
+    ''' Spaces out calls to at most `rate` per second - shared by every thread and event loop '''
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self.lock = Lock()
+        self.next_slot = 0.0
+
+    def reserve(self):
+        ''' Books the next free slot - returns the seconds to wait for it '''
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+            return slot - now
+
+    def wait(self):
+        time.sleep(self.reserve())
+
+    async def async_wait(self):
+        await asyncio.sleep(self.reserve())
+
+
+class GeometryHttpClient:
+    ''' Pooled HTTP client for geometry providers - keep-alive connections, timeouts,
+        retries with exponential backoff, and one rate limit for every request of the process.
+        `get_json` is for sync code, `async_get_json` for async views & commands.
+        Async requests run on the client's own event loop thread: `httpx.AsyncClient` is bound to
+        one loop, and under WSGI every request runs on a new one - that would open (and leak) a pool
+        per request instead of reusing keep-alive connections.
+    '''
+
+    def __init__(self, timeout: float = 10, connect_timeout: float = 5, retries: int = 3, backoff: float = 0.5,
+                 max_connections: int = 10, rate_limit: float = 1.0, user_agent: str = 'RUS_UKR_MAIN'):
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(rate_limit)
+        self.options = {'timeout': httpx.Timeout(timeout, connect=connect_timeout),
+                        'limits': httpx.Limits(max_connections=max_connections,
+                                               max_keepalive_connections=max_connections),
+                        'headers': {'User-Agent': user_agent}}
+        self._client = None
+        self._async_client = None  # Only touched on `self._loop`
+        self._loop = None
+        self._loop_pid = None
+        self._lock = Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(**self.options)
+        return self._client
+
+    @property
+    def loop(self):
+        ''' The client's event loop - started on first use (again in a forked worker, which has no threads) '''
+        with self._lock:
+            if self._loop is None or self._loop_pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._loop_pid = os.getpid()
+                self._async_client = None
+                Thread(target=self._loop.run_forever, name='geometry-http', daemon=True).start()
+        return self._loop
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(**self.options)
+        return self._async_client
+
+    async def _on_loop(self, coroutine):
+        ''' Runs `coroutine` on the client's loop and waits for it from the caller's loop '''
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    def retry_delay(self, attempt: int, response=None):
+        ''' Seconds before retry number `attempt` (0 based) - the upstream's Retry-After if it sent one '''
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+
+    def get_json(self, url: str, params: dict = None):
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            try:
+                response = self.client.get(url, params=params)
+            except httpx.TransportError as err:
+                if attempt == self.retries:
+                    raise GeometryFetchError(f'{url}: {err!r}') from err
+                time.sleep(self.retry_delay(attempt))
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                time.sleep(self.retry_delay(attempt, response))
+                continue
+            return self.parse(response)
+
+    async def async_get_json(self, url: str, params: dict = None):
+        return await self._on_loop(self._async_get_json(url, params))
+
+    async def _async_get_json(self, url: str, params: dict = None):
+        for attempt in range(self.retries + 1):
+            await self.limiter.async_wait()
+            try:
+                response = await self.async_client.get(url, params=params)
+            except httpx.TransportError as err:
+                if attempt == self.retries:
+                    raise GeometryFetchError(f'{url}: {err!r}') from err
+                await asyncio.sleep(self.retry_delay(attempt))
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                await asyncio.sleep(self.retry_delay(attempt, response))
+                continue
+            return self.parse(response)
+
+    @staticmethod
+    def parse(response):
+        try:
+            response.raise_for_status()
+            return response.json()
+        except (httpx.HTTPStatusError, ValueError) as err:
+            raise GeometryFetchError(f'{response.url}: {err!r}') from err
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    async def async_close(self):
+        ''' Closes the async pool (ie: at the end of a command) - the next request opens a new one '''
+        if self._loop is not None and self._loop_pid == os.getpid():
+            await self._on_loop(self._async_aclose())
+
+    async def _async_aclose(self):
+        client, self._async_client = self._async_client, None
+        if client is not None:
+            await client.aclose()
+
+
+def get_geometry_client():
+    ''' Returns the shared client configured by `settings.GEOMETRY_HTTP` '''
+    global _CLIENT
+
+    if _CLIENT is None:
+        _CLIENT = GeometryHttpClient(**{key.lower(): value for key, value in settings.GEOMETRY_HTTP.items()})
+    return _CLIENT
@@ -0,0 +1,132 @@
+from datetime import datetime
+import asyncio
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from Data.models import City, State, Country, MessageEvent
+from helpers.object_helpers import chunked
+from maps.ExtData import afetch_geometry, get_geometry_provider
+from maps.events import PLACE_RELATIONS
+from maps.http_client import GeometryFetchError, RateLimiter, get_geometry_client
+from maps.models import PlaceGeometry
+
+
+# Place type -> queryset the places are loaded from (with what the provider query needs)
+PLACE_QUERYSETS = {
+    'city': City.objects.select_related('country'),
+    'state': State.objects.select_related('country'),
+    'country': Country.objects.all(),
+}
+
+
+def referenced_place_ids():
+    ''' {place type: set of ids} of every City/State/Country linked to any `MessageEvent` '''
+    ids = {}
+    for relation, place_type in PLACE_RELATIONS.items():
+        through = MessageEvent._meta.get_field(relation).remote_field.through
+        ids[place_type] = set(through.objects.values_list(f'{place_type}_id', flat=True).distinct())
+    return ids
+
+
+def read_run_state(path):
+    try:
+        with open(path, encoding='utf-8') as rf:
+            return json.load(rf)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_run_state(path, state: dict):
+    with open(path, 'w', encoding='utf-8') as wf:
+        json.dump(state, wf)
+
+
+class Command(BaseCommand):
+    help = ('Fetches and stores the boundary geometry of every City/State/Country linked to a MessageEvent, '
+            'so map views never wait on the geometry provider')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only-missing', action='store_true',
+                            help='skip places that already have stored geometry (matched or not)')
+        parser.add_argument('--resume', action='store_true',
+                            help='continue an interrupted run - skip places it already stored')
+        parser.add_argument('--place-types', default='city,state,country')
+        parser.add_argument('--concurrency', type=int, default=4, help='requests in flight')
+        parser.add_argument('--rate', type=float, default=settings.GEOMETRY_HTTP['RATE_LIMIT'],
+                            help='requests per second')
+        parser.add_argument('--progress-every', type=int, default=50)
+
+    def handle(self, *args, **options):
+        state_path = settings.GEOMETRY_PREFETCH_STATE
+        run_state = read_run_state(state_path)
+        resuming = options['resume'] and run_state.get('started') and not run_state.get('finished')
+        if options['resume'] and not resuming:
+            self.stdout.write('No interrupted run to resume - starting a new one')
+
+        started = datetime.fromisoformat(run_state['started']) if resuming else timezone.now()
+        write_run_state(state_path, {'started': started.isoformat(), 'finished': None})
+
+        places = self.places_to_fetch(options['place_types'].split(','), options['only_missing'],
+                                      started if resuming else None)
+        self.stdout.write(f'{len(places)} places to fetch')
+
+        client = get_geometry_client()
+        client.limiter = RateLimiter(options['rate'])
+        results = asyncio.run(self.prefetch(places, options['concurrency'], options['progress_every']))
+
+        write_run_state(state_path, {'started': started.isoformat(), 'finished': timezone.now().isoformat()})
+        self.stdout.write(self.style.SUCCESS(
+            f'Done: {results["matched"]} matched, {results["no match"]} without a match, '
+            f'{results["failed"]} failed (run again with --only-missing to retry them)'))
+
+    def places_to_fetch(self, place_types: list, only_missing: bool, resumed_from=None):
+        ''' [(place type, place), ...] referenced by events, minus the ones to skip '''
+        places = []
+        for place_type, ids in referenced_place_ids().items():
+            if place_type not in place_types:
+                continue
+
+            stored = PlaceGeometry.objects.filter(place_type=place_type).values_list('place_id', 'fetched')
+            if only_missing:
+                ids -= {place_id for place_id, _ in stored}
+            elif resumed_from:
+                ids -= {place_id for place_id, fetched in stored if fetched >= resumed_from}
+
+            for chunk in chunked(sorted(ids), 500):
+                places.extend((place_type, place) for place in PLACE_QUERYSETS[place_type].filter(id__in=chunk))
+        return places
+
+    async def prefetch(self, places: list, concurrency: int, progress_every: int):
+        ''' Fetches `places` with `concurrency` workers - returns {result: count} '''
+        results = {'matched': 0, 'no match': 0, 'failed': 0}
+        queue = iter(places)
+        provider = get_geometry_provider()
+        start = time.perf_counter()
+
+        async def worker():
+            # Workers share `queue` - every place is fetched once
+            for place_type, place in queue:
+                try:
+                    stored = await afetch_geometry(place, provider)
+                    results['matched' if stored.matched else 'no match'] += 1
+                except GeometryFetchError as err:
+                    results['failed'] += 1
+                    self.stderr.write(f'FAILED {place_type}:{place.id} {place.name}\t{err}')
+
+                done = sum(results.values())
+                if done % progress_every == 0 or done == len(places):
+                    rate = done / (time.perf_counter() - start)
+                    eta = (len(places) - done) / rate if rate else 0
+                    self.stdout.write(f'[{done}/{len(places)}] {rate:.2f} places/s  ETA {eta / 60:.1f} min  '
+                                      f'matched={results["matched"]} no match={results["no match"]} '
+                                      f'failed={results["failed"]}')
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        finally:
+            await get_geometry_client().async_close()
+        return results
@@ -0,0 +1,67 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from helpers.metrics import REGISTRY, COUNT_BUCKETS, count_queries, start_breakdown, end_breakdown, format_breakdown
+
+
+slow_request_log = logging.getLogger('maps.slow_requests')
+
+
+class MetricsMiddleware:
+    ''' Records the time, SQL query count, and per-stage breakdown of every `maps` view request.
+        Requests slower than `settings.SLOW_REQUEST_SECONDS` are logged with their breakdown.
+        Streamed responses (ie: events.geojson) are timed until the response starts.
+        Works in both sync and async stacks - async views (ie: `geo_map`) are not moved to a thread.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        breakdown, token = start_breakdown()
+        start = time.perf_counter()
+        try:
+            with count_queries() as queries:
+                response = self.get_response(request)
+        finally:
+            end_breakdown(token)
+        self.record(request, response, time.perf_counter() - start, queries.queries, breakdown)
+        return response
+
+    async def __acall__(self, request):
+        breakdown, token = start_breakdown()
+        start = time.perf_counter()
+        try:
+            with count_queries() as queries:
+                response = await self.get_response(request)
+        finally:
+            end_breakdown(token)
+        self.record(request, response, time.perf_counter() - start, queries.queries, breakdown)
+        return response
+
+    def record(self, request, response, seconds: float, n_queries: int, breakdown: dict):
+        match = getattr(request, 'resolver_match', None)
+        if match is None or not match._func_path.startswith('maps.') or match.url_name == 'metrics':
+            return
+
+        view = match.url_name or match._func_path
+        REGISTRY.observe('rus_ukr_request_seconds', seconds, view=view)
+        REGISTRY.observe('rus_ukr_request_queries', n_queries, buckets=COUNT_BUCKETS, view=view)
+        REGISTRY.inc('rus_ukr_requests_total', view=view, status=response.status_code)
+
+        threshold = settings.SLOW_REQUEST_SECONDS
+        if threshold is not None and seconds >= threshold:
+            REGISTRY.inc('rus_ukr_slow_requests_total', view=view)
+            slow_request_log.warning('SLOW REQUEST %s %s %.1fms queries=%d %s', request.method,
+                                     request.get_full_path(), seconds * 1000, n_queries,
+                                     format_breakdown(breakdown))
@@ -1,3 +1,31 @@
 from django.db import models
 
-# Create your models here.
+
+class PlaceGeometry(models.Model):
+    ''' Boundary GeoJSON resolved for a City, State, or Country by `get_city_geometry`.
+        Stored so map views are served without asking the geometry provider again.
+        Misses are stored too (`matched=False`, `geojson=None`).
+    '''
+    class PlaceTypes(models.TextChoices):
+        CITY = 'city'
+        STATE = 'state'
+        COUNTRY = 'country'
+
+    place_type = models.CharField(max_length=10, choices=PlaceTypes.choices)
+    place_id = models.IntegerField()
+    geojson = models.JSONField(null=True)
+    # {level name: simplified geojson} - see `helpers.geometry.GEOMETRY_LEVELS`
+    simplified = models.JSONField(default=dict)
+    matched = models.BooleanField(default=False)
+    # Match metadata from the provider
+    provider = models.CharField(max_length=100)
+    display_name = models.TextField(null=True)
+    osm_type = models.CharField(max_length=20, null=True)
+    osm_id = models.BigIntegerField(null=True)
+    fetched = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('place_type', 'place_id')
+
+    def __str__(self):
+        return f'{self.place_type}:{self.place_id} ({self.display_name})'
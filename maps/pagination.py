@@ -0,0 +1,87 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import json
+import sys
+
+from django.db.models import Q
+from django.http import Http404
+from django.views.generic import ListView
+
+from helpers.object_helpers import normalize_place_name
+
+
+class KeysetListView(ListView):
+    ''' ListView paginated by keyset ("rows after the last one shown") instead of OFFSET,
+        so every page costs the same however far in it is.
+        Rows are ordered by `keyset` (unique together - end with the primary key).
+        `?after=<next_cursor>` gets the next page, `?q=` filters by name prefix (`name_folded`).
+        Adds `next_cursor` and `has_next` to the context.
+    '''
+    paginate_by = 10
+    keyset = ('name_folded', 'id')
+
+    def get_queryset(self):
+        queryset = super().get_queryset().order_by(*self.keyset)
+
+        query = self.request.GET.get('q')
+        if query:
+            # Prefix match as a range on the indexed column - `__startswith` is a LIKE that
+            # SQLite can't answer from the index (and `name__icontains` scans every row)
+            queryset = queryset.filter(prefix_range('name_folded', normalize_place_name(query)))
+
+        cursor = self.request.GET.get('after')
+        if cursor:
+            queryset = queryset.filter(self.after_filter(decode_keyset_cursor(cursor, len(self.keyset))))
+
+        # One extra row tells whether there is a next page
+        self.page_rows = list(queryset[:self.paginate_by + 1])
+        return self.page_rows[:self.paginate_by]
+
+    def after_filter(self, last_values):
+        ''' Q for rows after `last_values` in (a, b, ...) order:
+            a > x  OR  (a = x AND b > y)  OR ...
+        '''
+        condition = Q()
+        for i, field in enumerate(self.keyset):
+            equal = {f: v for f, v in zip(self.keyset[:i], last_values[:i])}
+            condition |= Q(**equal, **{f'{field}__gt': last_values[i]})
+        return condition
+
+    def paginate_queryset(self, queryset, page_size):
+        # Already paginated by `get_queryset` - (paginator, page, object_list, is_paginated)
+        return None, None, queryset, self.has_next or bool(self.request.GET.get('after'))
+
+    @property
+    def has_next(self):
+        return len(self.page_rows) > self.paginate_by
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['has_next'] = self.has_next
+        context['next_cursor'] = None
+        if self.has_next:
+            last = self.page_rows[self.paginate_by - 1]
+            context['next_cursor'] = encode_keyset_cursor([getattr(last, f) for f in self.keyset])
+        return context
+
+
+def prefix_range(field: str, prefix: str):
+    ''' Q for `field` values starting with `prefix`: prefix <= value < prefix with its last character + 1 '''
+    if not prefix or ord(prefix[-1]) == sys.maxunicode:
+        return Q(**{f'{field}__startswith': prefix})
+    return Q(**{f'{field}__gte': prefix, f'{field}__lt': prefix[:-1] + chr(ord(prefix[-1]) + 1)})
+
+
+def encode_keyset_cursor(values: list):
+    return urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_keyset_cursor(cursor: str, size: int):
+    ''' List of the `size` keyset values in `cursor` - 404 for anything else '''
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        raise Http404('Invalid page cursor')
+    if not isinstance(values, list) or len(values) != size \
+            or not all(isinstance(v, (str, int)) and not isinstance(v, bool) for v in values):
+        raise Http404('Invalid page cursor')
+    return values
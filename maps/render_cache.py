@@ -0,0 +1,171 @@
+from collections import OrderedDict, namedtuple
+from hashlib import sha1
+from pathlib import Path
+import json
+import os
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.shortcuts import render
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+
+from Data.models import City, State, Country
+from maps.models import PlaceGeometry
+
+
+# Tile layers added to every map - part of the cache key so changing them re-renders
+MAP_LAYERS = ('Stamen Terrain', 'Stamen Toner', 'Stamen Watercolor')
+
+MapEntry = namedtuple('MapEntry', ['html', 'etag', 'last_modified'])
+
+# Process-wide store - built on first use by `get_map_cache()`
+_MAP_CACHE = None
+
+
+class MemoryMapStore:
+    ''' In-process LRU store of rendered map HTML, holding at most `max_entries` maps '''
+
+    def __init__(self, max_entries: int = 256, **kwargs):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key: str, html: str):
+        entry = MapEntry(html, quote_etag(sha1(html.encode('utf-8')).hexdigest()), time.time())
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def delete_base(self, base: str):
+        ''' Deletes every entry whose key (before its "?" params) is `base` '''
+        for key in [k for k in self.entries if k.split('?')[0] == base]:
+            del self.entries[key]
+
+
+class FileMapStore:
+    ''' File-backed LRU store of rendered map HTML - shared by every process on the host.
+        One file per map in `location`, the least recently used files are removed past `max_entries`.
+    '''
+
+    def __init__(self, location, max_entries: int = 1024, **kwargs):
+        self.location = Path(location)
+        self.max_entries = max_entries
+        self.location.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str):
+        # Key base (for `delete_base`) + hash of the whole key
+        return self.location / f'{key.split("?")[0]}-{sha1(key.encode("utf-8")).hexdigest()}.json'
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as rf:
+                entry = MapEntry(**json.load(rf))
+        except (OSError, ValueError):
+            return None
+        os.utime(path)  # Mark as recently used
+        return entry
+
+    def set(self, key: str, html: str):
+        entry = MapEntry(html, quote_etag(sha1(html.encode('utf-8')).hexdigest()), time.time())
+        tmp_path = self._path(key).with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as wf:
+            json.dump(entry._asdict(), wf)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+        return entry
+
+    def delete_base(self, base: str):
+        ''' Deletes every entry whose key (before its "?" params) is `base` '''
+        for path in self.location.glob(f'{base}-*.json'):
+            # Stored file names are "<base>-<40 char hash>.json"
+            if len(path.stem) == len(base) + 41:
+                path.unlink(missing_ok=True)
+
+    def _evict(self):
+        paths = list(self.location.glob('*.json'))
+        if len(paths) <= self.max_entries:
+            return
+        paths.sort(key=lambda p: p.stat().st_mtime)
+        for path in paths[:len(paths) - self.max_entries]:
+            path.unlink(missing_ok=True)
+
+
+MAP_STORES = {'memory': MemoryMapStore, 'file': FileMapStore}
+
+
+def get_map_cache():
+    ''' Returns the shared map store configured by `settings.MAP_CACHE` '''
+    global _MAP_CACHE
+
+    if _MAP_CACHE is None:
+        options = {key.lower(): value for key, value in settings.MAP_CACHE.items()}
+        _MAP_CACHE = MAP_STORES[options.pop('backend')](**options)
+    return _MAP_CACHE
+
+
+def map_cache_key(view_name: str, *args, **params):
+    ''' Key of a rendered map - "<view>-<args>?<params>&layers=..." '''
+    key = '-'.join(str(a) for a in (view_name,) + args)
+    params['layers'] = ','.join(MAP_LAYERS)
+    return key + '?' + '&'.join(f'{k}={v}' for k, v in sorted(params.items()))
+
+
+def cached_map_response(request, key: str, build_map_html, template_name: str):
+    ''' Renders `template_name` with the map HTML stored under `key`, calling `build_map_html()`
+        only when it is not stored yet. Responses carry ETag/Last-Modified headers, and a
+        304 is returned when the client already has the current map.
+    '''
+    store = get_map_cache()
+    entry = store.get(key)
+    if entry is None:
+        entry = store.set(key, build_map_html())
+    return map_entry_response(request, entry, template_name)
+
+
+async def acached_map_response(request, key: str, abuild_map_html, template_name: str):
+    ''' Async `cached_map_response` - `abuild_map_html()` is awaited when the map is not stored yet '''
+    store = get_map_cache()
+    entry = await sync_to_async(store.get)(key)
+    if entry is None:
+        entry = await sync_to_async(store.set)(key, await abuild_map_html())
+    return map_entry_response(request, entry, template_name)
+
+
+def map_entry_response(request, entry: MapEntry, template_name: str):
+    ''' Response for a stored map - a 304 when the client's ETag/Last-Modified is current '''
+    response = get_conditional_response(request, etag=entry.etag, last_modified=int(entry.last_modified))
+    if response is None:
+        response = render(request, template_name, {'map': entry.html})
+
+    response.headers['ETag'] = entry.etag
+    response.headers['Last-Modified'] = http_date(entry.last_modified)
+    return response
+
+
+def invalidate_place_maps(place_type: str, place_id):
+    ''' Drops every stored map of one City/State/Country '''
+    get_map_cache().delete_base(f'geo_map-{place_type}-{place_id}')
+
+
+@receiver([post_save, post_delete], sender=City)
+@receiver([post_save, post_delete], sender=State)
+@receiver([post_save, post_delete], sender=Country)
+def _place_changed(sender, instance, **kwargs):
+    invalidate_place_maps(sender._meta.model_name, instance.id)
+
+
+@receiver([post_save, post_delete], sender=PlaceGeometry)
+def _geometry_changed(sender, instance, **kwargs):
+    invalidate_place_maps(instance.place_type, instance.place_id)
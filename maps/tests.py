@@ -1,3 +1,233 @@
-from django.test import TestCase
+from base64 import urlsafe_b64encode
+import json
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.http import Http404
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import Resolver404, resolve, reverse
+
+from Data.models import City, State
+from Data.import_data import persist_MessageEvents
+from Data.rollups import events_version
+from Data.tests import create_places, extracted_event, store_message
+from helpers.spatial import PlaceGrid
+from maps import events, render_cache, views
+from maps.pagination import decode_keyset_cursor, encode_keyset_cursor, prefix_range
+from maps.render_cache import FileMapStore, MemoryMapStore, cached_map_response, get_map_cache, map_cache_key
+
+
+# The project ships no templates - just enough to render the views
+TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', {
+        'maps/index.html': '{{ map|safe }}',
+        'maps/cities.html': '{% for city in list_of_cities %}{{ city.name }};{% endfor %}|{{ next_cursor|default:"" }}',
+        'maps/states.html': '{% for state in list_of_states %}{{ state.name }};{% endfor %}|{{ next_cursor|default:"" }}',
+    })]},
+}]
+
+
+def streamed_json(response):
+    return json.loads(b''.join(response.streaming_content))
+
+
+def encode(value):
+    return urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+
+class UrlTests(TestCase):
+
+    def test_routes(self):
+        match = resolve('/maps/50.45/-30.5/')
+        self.assertEqual((match.func, match.kwargs), (views.map_view, {'latitude': 50.45, 'longitude': -30.5}))
+        self.assertEqual(resolve('/maps/city/1/').url_name, 'geo_map')
+        self.assertEqual(resolve('/maps/state/1/geometry/').url_name, 'geometry_geojson')
+        self.assertEqual(resolve('/maps/cities/').url_name, 'cities-list')
+        self.assertEqual(resolve('/maps/events/counts/country/').kwargs, {'place_type': 'country'})
+        self.assertEqual(reverse('map_view', args=[50.45, 30.52]), '/maps/50.45/30.52/')
+
+    def test_unknown_place_types_and_coordinates_do_not_match(self):
+        for url in ('/maps/planet/1/', '/maps/events/counts/planet/', '/maps/95/30/', '/maps/50/200/',
+                    '/maps/north/east/'):
+            with self.assertRaises(Resolver404):
+                resolve(url)
+
+    def test_map_view_latitude_out_of_range(self):
+        self.assertEqual(self.client.get('/maps/95/30/').status_code, 404)
+
+
+@override_settings(TEMPLATES=TEMPLATES)
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        create_places()
+        for c_id, name in enumerate(['Kherson', 'Khartsyzk'] + [f'Town {n:02}' for n in range(26)], start=3):
+            City(id=c_id, name=name, wikiDataId='', state_id=1, country_id=1).save()
+
+    def names(self, response):
+        names, cursor = response.content.decode('utf-8').split('|')
+        return names.split(';')[:-1], cursor
+
+    def test_pages_follow_the_cursor(self):
+        first, cursor = self.names(self.client.get('/maps/cities/'))
+        self.assertEqual(len(first), 25)
+        self.assertEqual(first[:3], ['Kharkiv', 'Khartsyzk', 'Kherson'])
+
+        second, next_cursor = self.names(self.client.get('/maps/cities/', {'after': cursor}))
+        self.assertEqual(len(second), 5)
+        self.assertEqual(next_cursor, '')
+        self.assertFalse(set(first) & set(second))
+
+    def test_name_prefix_filter(self):
+        self.assertEqual(self.names(self.client.get('/maps/cities/', {'q': 'KHAR'}))[0], ['Kharkiv', 'Khartsyzk'])
+        self.assertEqual(self.names(self.client.get('/maps/states/', {'q': 'khar'}))[0], ['Kharkiv Oblast'])
+        self.assertEqual(City.objects.filter(prefix_range('name_folded', 'kh')).count(), 3)
+
+    def test_invalid_cursors_are_404(self):
+        for cursor in ('not a cursor', encode({'name_folded': 'a'}), encode(['a']), encode([True, 1]),
+                       encode([['a'], 1])):
+            self.assertEqual(self.client.get('/maps/cities/', {'after': cursor}).status_code, 404)
+            with self.assertRaises(Http404):
+                decode_keyset_cursor(cursor, 2)
+        self.assertEqual(decode_keyset_cursor(encode_keyset_cursor(['kharkiv', 1]), 2), ['kharkiv', 1])
+
+
+class EventViewTests(TestCase):
+
+    def setUp(self):
+        create_places()
+        for m_id in (1, 2, 3):
+            store_message(m_id, f'Message {m_id}')
+        persist_MessageEvents([extracted_event(1, '2022-03-01T10:00:00Z', cities=[1]),
+                               extracted_event(2, '2022-03-02T10:00:00Z', cities=[2]),
+                               extracted_event(3, '2022-03-03T10:00:00Z', cities=[1])])
+
+    def test_events_geojson_pages(self):
+        page = streamed_json(self.client.get('/maps/events.geojson', {'limit': 2}))
+        self.assertEqual([f['properties']['place_name'] for f in page['features']], ['Kharkiv', 'Sumy'])
+        self.assertIsNotNone(page['next'])
+
+        page = streamed_json(self.client.get('/maps/events.geojson', {'limit': 2, 'cursor': page['next']}))
+        self.assertEqual([f['properties']['place_name'] for f in page['features']], ['Kharkiv'])
+        self.assertIsNone(page['next'])
+
+    def test_events_geojson_filters(self):
+        page = streamed_json(self.client.get('/maps/events.geojson', {'bbox': '34,50,35,51.5'}))
+        self.assertEqual([f['geometry']['coordinates'] for f in page['features']], [[34.80, 50.91]])
+
+        page = streamed_json(self.client.get('/maps/events.geojson', {'start': '2022-03-02', 'end': '2022-03-02T23:00'}))
+        self.assertEqual([f['properties']['place_name'] for f in page['features']], ['Sumy'])
+
+    def test_events_geojson_bad_params_are_400(self):
+        for params in ({'limit': 0}, {'limit': 'many'}, {'start': 'yesterday'}, {'end': '2022-13-01'},
+                       {'cursor': 'not a cursor'}, {'cursor': encode('x')}, {'bbox': '1,2,3'}):
+            response = self.client.get('/maps/events.geojson', params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', response.json())
+
+    def test_event_counts(self):
+        self.assertEqual(self.client.get('/maps/events/counts/city/').json(), {'1': 2, '2': 1})
+        self.assertEqual(self.client.get('/maps/events/counts/city/', {'start': '2022-03-02'}).json(),
+                         {'1': 1, '2': 1})
+        self.assertEqual(self.client.get('/maps/events/counts/city/', {'end': 'soon'}).status_code, 400)
+
+    def test_cluster_index_is_rebuilt_off_request(self):
+        with mock.patch.object(events, '_CLUSTER_INDEX', (None, None)), \
+                mock.patch.object(events, '_CLUSTER_REBUILDING', False), \
+                mock.patch.object(events.threading, 'Thread') as thread:
+            response = self.client.get('/maps/events/clusters/', {'zoom': 0})
+            self.assertEqual(response.json()['version'], events_version())
+            self.assertEqual(sum(c['count'] for c in response.json()['clusters']), 3)
+            thread.assert_not_called()
+
+            # Events changed - the current index is served while one thread rebuilds it
+            stale = events_version()
+            store_message(4, 'Message 4')
+            persist_MessageEvents([extracted_event(4, cities=[2])])
+            self.assertEqual(self.client.get('/maps/events/clusters/').json()['version'], stale)
+            self.assertEqual(self.client.get('/maps/events/clusters/').json()['version'], stale)
+            thread.assert_called_once()
+
+            # What the thread runs
+            events.build_cluster_index(events_version())
+            self.assertEqual(events.get_cluster_index()[0], events_version())
+
+    def test_zoom_is_clamped(self):
+        for zoom, expected in (('99999999999', views.MAX_ZOOM), ('-3', 0), ('7', 7), ('far', views.DEFAULT_ZOOM)):
+            self.assertEqual(views.get_zoom(RequestFactory().get('/', {'zoom': zoom})), expected)
+
+        response = self.client.get('/maps/events/clusters/', {'zoom': '99999999999'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['clusters'],
+                         self.client.get('/maps/events/clusters/', {'zoom': views.MAX_ZOOM}).json()['clusters'])
+
+
+@override_settings(TEMPLATES=TEMPLATES)
+class RenderCacheTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(render_cache, '_MAP_CACHE', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cached_map_response(self):
+        build = mock.Mock(return_value='<div>map</div>')
+        request = RequestFactory().get('/')
+        response = cached_map_response(request, 'map_view-1-2', build, 'maps/index.html')
+        self.assertEqual((response.status_code, response.content), (200, b'<div>map</div>'))
+        etag = response.headers['ETag']
+
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(cached_map_response(request, 'map_view-1-2', build, 'maps/index.html').status_code, 304)
+        build.assert_called_once()
+
+    def test_memory_store(self):
+        store = MemoryMapStore(max_entries=2)
+        store.set('a', 'A')
+        store.set('b', 'B')
+        store.get('a')
+        store.set('c', 'C')
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('a').html, 'A')
+        self.assertEqual(store.get('a').etag, store.set('x', 'A').etag)
+
+    def test_file_store(self):
+        with tempfile.TemporaryDirectory() as location:
+            store = FileMapStore(location, max_entries=2)
+            store.set(map_cache_key('geo_map', 'city', 1, zoom=4), 'one')
+            store.set(map_cache_key('geo_map', 'city', 10, zoom=4), 'ten')
+            self.assertEqual(FileMapStore(location).get(map_cache_key('geo_map', 'city', 1, zoom=4)).html, 'one')
+
+            store.delete_base('geo_map-city-1')
+            self.assertIsNone(store.get(map_cache_key('geo_map', 'city', 1, zoom=4)))
+            self.assertEqual(store.get(map_cache_key('geo_map', 'city', 10, zoom=4)).html, 'ten')
+
+    def test_changed_places_drop_their_maps(self):
+        City(id=1, name='Kharkiv', wikiDataId='Q42308').save()
+        City(id=2, name='Sumy', wikiDataId='Q170136').save()
+        store = get_map_cache()
+        kharkiv, sumy = map_cache_key('geo_map', 'city', 1, zoom=4), map_cache_key('geo_map', 'city', 2, zoom=4)
+        store.set(kharkiv, 'Kharkiv')
+        store.set(sumy, 'Sumy')
+
+        City.objects.get(id=1).save()
+        self.assertIsNone(store.get(kharkiv))
+        self.assertIsNotNone(store.get(sumy))
+
+
+class PlaceGridTests(TestCase):
+
+    def test_nearest(self):
+        grid = PlaceGrid()
+        self.assertEqual(grid.nearest(50.0, 36.0, k=3), [])
+
+        grid.add(49.99, 36.23, City, 1, 'Kharkiv')
+        grid.add(50.91, 34.80, City, 2, 'Sumy')
+        grid.add(49.5, 36.5, State, 1, 'Kharkiv Oblast')
+        self.assertEqual([entry[4] for _, entry in grid.nearest(50.0, 36.2, k=5, model=City)], ['Kharkiv', 'Sumy'])
+        self.assertEqual(len(grid.nearest(-33.9, 151.2, k=10)), 3)
+        self.assertEqual(grid.nearest(50.0, 36.2, model=State)[0][1][4], 'Kharkiv Oblast')
+
+        distance, _ = grid.nearest(50.0, 36.2)[0]
+        self.assertLess(distance, 5)
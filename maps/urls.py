@@ -1,9 +1,19 @@
 from django.contrib import admin
-from django.urls import path, include
-from . import views
+from django.urls import path, include, register_converter
+from . import converters, views
+
+register_converter(converters.PlaceTypeConverter, 'place_type')
+register_converter(converters.LatitudeConverter, 'latitude')
+register_converter(converters.LongitudeConverter, 'longitude')
 
 urlpatterns = [
+    path('metrics/', views.metrics, name='metrics'),
     path('states/', views.StatesListView.as_view(), name='states-list'),
-    path('<loc_type>/<loc_id>/', views.geo_map, name='geo_map'),
-    path('<latitude>/<longitude>/', views.map_view, name='map_view')
+    path('cities/', views.CitiesListView.as_view(), name='cities-list'),
+    path('events.geojson', views.events_geojson, name='events_geojson'),
+    path('events/clusters/', views.event_clusters, name='event_clusters'),
+    path('events/counts/<place_type:place_type>/', views.event_counts, name='event_counts'),
+    path('<place_type:loc_type>/<int:loc_id>/geometry/', views.geometry_geojson, name='geometry_geojson'),
+    path('<place_type:loc_type>/<int:loc_id>/', views.geo_map, name='geo_map'),
+    path('<latitude:latitude>/<longitude:longitude>/', views.map_view, name='map_view'),
 ]
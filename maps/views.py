@@ -1,13 +1,28 @@
-from django.shortcuts import render, redirect
-from django.views.generic import ListView
+from math import log2
 
-import folium
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import render, redirect, get_object_or_404
+from django.utils.decorators import method_decorator
+from django.utils.html import escape
 
+from Data.extraction_queue import update_queue_metrics
 from Data.models import City, State, Country
-from maps.ExtData import get_city_geometry
-
-
-class StatesListView(ListView):
+from Data.rollups import rollup_counts
+from RUS_UKR_MAIN.db_routers import read_from_replica
+from helpers.clustering import CLUSTER_MAX_ZOOM, view_bbox
+from helpers.metrics import REGISTRY, timed
+from helpers.spatial import get_place_grid
+from maps.ExtData import aget_city_geometry
+from maps.pagination import KeysetListView
+from maps.events import parse_bbox, parse_date_param, filter_events, iter_event_features, get_cluster_index
+from maps.render_cache import MAP_LAYERS, map_cache_key, cached_map_response, acached_map_response
+
+
+@method_decorator(read_from_replica, name='dispatch')
+class StatesListView(KeysetListView):
     ''' Generic list view of all states '''
     template_name = 'maps/states.html'
     context_object_name = 'list_of_states'
@@ -15,23 +30,69 @@ class StatesListView(ListView):
     model = State
 
 
-def geo_map(request, loc_type, loc_id):
-    # Get location Data
-    if loc_type == 'city':
-        location = City.objects.get(id=loc_id)
-    if loc_type == 'state':
-        location = State.objects.get(id=loc_id)
-    if loc_type == 'country':
-        location = Country.objects.get(id=loc_id)
+@method_decorator(read_from_replica, name='dispatch')
+class CitiesListView(KeysetListView):
+    ''' Generic list view of all cities '''
+    template_name = 'maps/cities.html'
+    context_object_name = 'list_of_cities'
+    paginate_by = 25
+    model = City
+
+
+PLACE_MODELS = {'city': City, 'state': State, 'country': Country}
+DEFAULT_ZOOM = 4
+# Highest `?zoom=` served - past `CLUSTER_MAX_ZOOM` every event is on its own anyway
+MAX_ZOOM = CLUSTER_MAX_ZOOM + 4
+MAX_EVENTS_PAGE = 10000
+
+
+def get_location(loc_type, loc_id):
+    if loc_type not in PLACE_MODELS:
+        raise Http404(f'Unknown location type: {loc_type}')
+    return get_object_or_404(PLACE_MODELS[loc_type], id=loc_id)
+
+
+def get_zoom(request):
+    ''' Map zoom from the `?zoom=` parameter - clamped to 0..`MAX_ZOOM` (`2 ** zoom` is computed,
+        and every zoom renders & caches its own map)
+    '''
+    try:
+        zoom = int(request.GET.get('zoom', DEFAULT_ZOOM))
+    except ValueError:
+        return DEFAULT_ZOOM
+    return max(0, min(zoom, MAX_ZOOM))
 
-    # Get geojson data
-    geometry = get_city_geometry(location, True)
+
+async def geo_map(request, loc_type, loc_id):
+    ''' Map of one City/State/Country with its boundary and the events around it.
+        Async - while the geometry provider responds, no worker thread is held.
+    '''
+    zoom = get_zoom(request)
+    events_version, clusters = await sync_to_async(get_cluster_index)()
+
+    async def build_map_html():
+        # Get location Data
+        location = await sync_to_async(get_location)(loc_type, loc_id)
+
+        # Get geojson data - simplified to fit the zoom
+        geometry = await aget_city_geometry(location, zoom=zoom)
+
+        # folium rendering is CPU work - keep it off the event loop
+        return await sync_to_async(render_geo_map, thread_sensitive=False)(location, geometry, clusters, zoom)
+
+    key = map_cache_key('geo_map', loc_type, loc_id, zoom=zoom, events=events_version)
+    return await acached_map_response(request, key, build_map_html, 'maps/geomap.html')
+
+
+def render_geo_map(location, geometry, clusters, zoom: int):
+    ''' HTML of the `geo_map` folium map '''
+    import folium  # Only loaded by processes that render maps
 
     lat, lon = location.latitude, location.longitude
 
     coordinates = (lat, lon)
 
-    m = folium.Map(coordinates, zoom_start=4, tiles='Stamen Terrain')
+    m = folium.Map(coordinates, zoom_start=zoom, tiles='Stamen Terrain')
 
     # Popup for clicking on location
     popup_html = folium.Html(f'<b>{lat}</b><br/><b>{lon}</b>', True)
@@ -41,38 +102,149 @@ def geo_map(request, loc_type, loc_id):
     folium.Marker(coordinates, popup=popup).add_to(m)
 
     # GeoJson of location
-    folium.GeoJson(geometry, name=location.name).add_to(m)
+    if geometry:
+        folium.GeoJson(geometry, name=location.name).add_to(m)
+
+    # Events around the location - clustered for the zoom
+    add_event_clusters(m, clusters.clusters(zoom, view_bbox(lat, lon, zoom)))
 
     # Visual layers
-    folium.raster_layers.TileLayer('Stamen Terrain').add_to(m)
-    folium.raster_layers.TileLayer('Stamen Toner').add_to(m)
-    folium.raster_layers.TileLayer('Stamen Watercolor').add_to(m)
-    folium.LayerControl().add_to(m)
+    add_map_layers(m)
 
     # Get HTML of map
-    m = m._repr_html_()
+    with timed('folium_render'):
+        return m._repr_html_()
 
-    return render(request, 'maps/geomap.html', {'map': m})
 
+@read_from_replica
+def map_view(request, latitude: float, longitude: float):
+    ''' Map around a coordinate (floats in range - see `converters.LatitudeConverter`) with its nearest city '''
+    events_version, clusters = get_cluster_index()
 
-def map_view(request, latitude, longitude):
+    def build_map_html():
+        import folium  # Only loaded by processes that render maps
 
-    coordinates = (latitude, longitude)
+        coordinates = (latitude, longitude)
 
-    m = folium.Map(coordinates, zoom_start=4, tiles='Stamen Terrain')
+        m = folium.Map(coordinates, zoom_start=4, tiles='Stamen Terrain')
 
-    # Popup for clicking on location
-    popup_html = folium.Html(f'<b>{latitude}</b><br/><b>{longitude}</b>', True)
-    popup = folium.Popup(popup_html)
+        # Popup for clicking on location - with the nearest known city
+        popup_text = f'<b>{latitude}</b><br/><b>{longitude}</b>'
+        nearest = get_place_grid().nearest(latitude, longitude, k=1, model=City)
+        if nearest:
+            distance, (_, _, _, _, city_name) = nearest[0]
+            popup_text += f'<br/>{escape(city_name)} ({distance:.1f} km)'
+        popup_html = folium.Html(popup_text, True)
+        popup = folium.Popup(popup_html)
 
-    # Marker of specified location
-    folium.Marker(coordinates, popup=popup).add_to(m)
+        # Marker of specified location
+        folium.Marker(coordinates, popup=popup).add_to(m)
 
-    # Visual layers
-    folium.raster_layers.TileLayer('Stamen Terrain').add_to(m)
-    folium.raster_layers.TileLayer('Stamen Toner').add_to(m)
-    folium.raster_layers.TileLayer('Stamen Watercolor').add_to(m)
+        # Events around the location - clustered for the zoom
+        add_event_clusters(m, clusters.clusters(DEFAULT_ZOOM, view_bbox(latitude, longitude, DEFAULT_ZOOM)))
+
+        # Visual layers
+        add_map_layers(m)
+
+        with timed('folium_render'):
+            return m._repr_html_()
+
+    key = map_cache_key('map_view', latitude, longitude, events=events_version)
+    return cached_map_response(request, key, build_map_html, 'maps/index.html')
+
+
+def add_event_clusters(m, clusters):
+    ''' One circle per event cluster (sized by its count) in a toggleable "Events" layer '''
+    import folium
+
+    events_layer = folium.FeatureGroup(name='Events')
+    for cluster in clusters:
+        count = cluster['count']
+        folium.CircleMarker((cluster['latitude'], cluster['longitude']),
+                            radius=5 + 3 * log2(count),
+                            tooltip=f'{count} event{"s" if count > 1 else ""}',
+                            color='crimson', fill=True).add_to(events_layer)
+    events_layer.add_to(m)
+
+
+def add_map_layers(m):
+    ''' Tile layers + LayerControl shared by every map '''
+    import folium
+
+    for tiles in MAP_LAYERS:
+        folium.raster_layers.TileLayer(tiles).add_to(m)
     folium.LayerControl().add_to(m)
 
-    m = m._repr_html_()
-    return render(request, 'maps/index.html', {'map': m})
+
+async def geometry_geojson(request, loc_type, loc_id):
+    ''' Boundary GeoJSON of a location, simplified for `?zoom=` '''
+    location = await sync_to_async(get_location)(loc_type, loc_id)
+    geometry = await aget_city_geometry(location, zoom=get_zoom(request))
+    if not geometry:
+        raise Http404(f'No geometry for {loc_type}: {loc_id}')
+    return JsonResponse(geometry)
+
+
+@read_from_replica
+def events_geojson(request):
+    ''' `MessageEvent`s as a streamed GeoJSON FeatureCollection.
+        Query params: bbox=west,south,east,north  start/end (ISO dates)  classification (ie: ACTA)
+                      limit (events per page)  cursor (`next` of the previous page)
+    '''
+    try:
+        bbox = parse_bbox(request.GET.get('bbox'))
+        limit = int(request.GET.get('limit', 1000))
+        if limit < 1:
+            raise ValueError(f'Invalid limit: {limit} - must be at least 1')
+        limit = min(limit, MAX_EVENTS_PAGE)
+        events = filter_events(bbox=bbox,
+                               start=request.GET.get('start'),
+                               end=request.GET.get('end'),
+                               classification=request.GET.get('classification'),
+                               cursor=request.GET.get('cursor'))
+    except (ValueError, ValidationError) as err:
+        # Checked before the response starts streaming - a 400, not a broken 200
+        return JsonResponse({'error': str(err)}, status=400)
+
+    return StreamingHttpResponse(iter_event_features(events, bbox, limit), content_type='application/geo+json')
+
+
+@read_from_replica
+def event_counts(request, place_type):
+    ''' {place id: number of events} for `place_type` - from the precomputed `EventRollup` rows.
+        Query params: start/end (ISO dates)  classification (ie: ACTA)
+    '''
+    if place_type not in PLACE_MODELS:
+        raise Http404(f'Unknown location type: {place_type}')
+    try:
+        start = parse_date_param(request.GET.get('start'), 'start')
+        end = parse_date_param(request.GET.get('end'), 'end')
+    except ValueError as err:
+        return JsonResponse({'error': str(err)}, status=400)
+
+    counts = rollup_counts(place_type, start=start, end=end, classification=request.GET.get('classification'))
+    return JsonResponse({str(place_id): total for place_id, total in counts.items()})
+
+
+@read_from_replica
+def event_clusters(request):
+    ''' Event clusters for a map view - `?zoom=` and `?bbox=west,south,east,north`.
+        Single events (and every event above `CLUSTER_MAX_ZOOM`) carry their event `id`.
+    '''
+    try:
+        bbox = parse_bbox(request.GET.get('bbox'))
+    except ValueError as err:
+        return JsonResponse({'error': str(err)}, status=400)
+
+    events_version, clusters = get_cluster_index()
+    return JsonResponse({'version': events_version,
+                         'clusters': clusters.clusters(get_zoom(request), bbox)})
+
+
+def metrics(request):
+    ''' Request & pipeline metrics of this process as Prometheus text - only for `settings.METRICS_ALLOWED_IPS` '''
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise Http404()
+    # Queue gauges are read from the db - every process reports the same depth
+    update_queue_metrics()
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')